@@ -0,0 +1,190 @@
+# async_file_ops.py
+import asyncio
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+from file_ops import FileManager, _key_ref
+
+class AsyncFileManager:
+    """
+    asyncio front end to FileManager for services that serve many clients from one event loop.
+
+    Database calls run on one DB thread and crypto and file I/O on a separate pool, with at most
+    max_concurrency operations in flight.
+
+        async with AsyncFileManager(storage_path, db_manager) as files:
+            await asyncio.gather(*(files.upload('alice', path) for path in paths))
+    """
+
+    def __init__(self, base_directory, db_manager, logger=None, dedup=False, compression='auto',
+                 max_concurrency=None, crypto_workers=None, delta=False):
+        """
+        :param max_concurrency: operations in flight at once, defaults to twice the crypto workers
+        :param crypto_workers: threads for encryption and file I/O, defaults to the CPU count
+        """
+        self.file_manager = FileManager(base_directory, db_manager, logger, dedup=dedup, compression=compression,
+                                        delta=delta)
+        self.db_manager = db_manager
+        self.logger = self.file_manager.logger
+        crypto_workers = crypto_workers or os.cpu_count()
+        self._db = ThreadPoolExecutor(max_workers=1, thread_name_prefix='gicsfs-db')
+        self._crypto = ThreadPoolExecutor(max_workers=crypto_workers, thread_name_prefix='gicsfs-crypto')
+        self._slots = asyncio.Semaphore(max_concurrency or 2 * crypto_workers)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def close(self):
+        """Wait for running work, stop the worker threads and zeroize cached keys."""
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, functools.partial(self._crypto.shutdown, wait=True))
+        await loop.run_in_executor(None, functools.partial(self._db.shutdown, wait=True))
+        self.file_manager.close()
+
+    async def _run_db(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._db, functools.partial(fn, *args))
+
+    async def _run_crypto(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._crypto, functools.partial(fn, *args))
+
+    async def upload(self, username, source_path):
+        """Encrypt and upload a file."""
+        async with self._slots:
+            try:
+                files = self.file_manager
+                key_id = await self._run_db(files._ensure_user_key, username)
+                filename = os.path.basename(source_path)
+                previous = await self._run_db(self.db_manager.retrieve_file_metadata, username, filename)
+                use_blocks, target_path, known = await self._run_db(files._plan_version, username, filename,
+                                                                    previous)
+
+                if use_blocks:
+                    block_key = await self._run_db(files._block_key_ref, username)
+                    key_row = await self._run_db(files._load_key, username, block_key)
+                    block_encryptor = await self._run_crypto(files._get_block_encryptor, username, block_key, key_row)
+                    manifest, new_blocks, codec = await self._run_crypto(files._upload_blocks, block_encryptor,
+                                                                         source_path, known)
+                    await self._run_db(files._commit_manifests, username, key_id, block_key, block_encryptor,
+                                       [(filename, source_path, manifest, codec)])
+                    self.logger.info("File '%s' uploaded to the block store (%s of %s chunks new).",
+                                     filename, new_blocks, len(manifest))
+                    return
+
+                encryptor = files._new_data_key()
+                try:
+                    codec = await self._run_crypto(files._upload_file, encryptor, source_path, target_path, key_id)
+                except BaseException:
+                    encryptor.zeroize()
+                    raise
+                await self._run_db(files._commit_files, username, [(filename, target_path, codec, encryptor)])
+                self.logger.info("File '%s' uploaded and encrypted successfully.", filename)
+            except Exception as e:
+                self.logger.error("Error during async file upload: %s", e)
+                raise
+
+    async def download(self, username, filename, output_dir=None, version=None):
+        """Decrypt a file, or an older version of it, into output_dir, returning its path or None if it is missing."""
+        async with self._slots:
+            try:
+                output_path, file_id = await self._restore(username, filename, username, output_dir, version)
+                if output_path:
+                    await self._run_db(self.db_manager.update_download_date, username, filename, file_id)
+                return output_path
+            except Exception as e:
+                self.logger.error("Error during async file download: %s", e)
+                raise
+
+    async def download_shared_file(self, owner_username, filename, requesting_username, output_dir=None):
+        """Decrypt a file shared with requesting_username, returning its path, or None if it is not shared."""
+        async with self._slots:
+            try:
+                output_path, _ = await self._restore(owner_username, filename, requesting_username, output_dir)
+                return output_path
+            except Exception as e:
+                self.logger.error("Error during async shared file download: %s", e)
+                raise
+
+    async def _restore(self, owner_username, filename, requesting_username, output_dir, version=None):
+        """Fetch the metadata and key on the DB thread, then decrypt on the crypto pool.
+
+        Returns (output_path, file_id) of the version restored, or (None, None) if it is not found.
+        """
+        files = self.file_manager
+        if owner_username == requesting_username:
+            file_metadata = await self._run_db(self.db_manager.retrieve_file_metadata, owner_username, filename,
+                                               version)
+        else:
+            file_metadata = await self._run_db(self.db_manager.get_shared_file_metadata, owner_username, filename,
+                                               requesting_username)
+        if not file_metadata:
+            self.logger.warning("File '%s' not found for user '%s'.", filename, requesting_username)
+            return None, None
+
+        key_id = _key_ref(file_metadata)
+        key_row = await self._run_db(files._load_key, owner_username, key_id)
+        output_path = os.path.join(output_dir or os.getcwd(), filename)
+        if file_metadata[8] == 'blocks':
+            manifest = await self._run_db(self.db_manager.get_file_chunks, file_metadata[0])
+            block_encryptor = await self._run_crypto(files._get_block_encryptor, owner_username, key_id, key_row)
+            await self._run_crypto(files._restore_blocks, block_encryptor, file_metadata[0], output_path, manifest)
+        else:
+            get_encryptor = functools.partial(files._get_encryptor, owner_username, key_id, key_row=key_row)
+            await self._run_crypto(files._decrypt_to, get_encryptor, file_metadata[2], output_path,
+                                   file_metadata[9])
+        self.logger.info("File '%s' decrypted and downloaded successfully.", filename)
+        return output_path, file_metadata[0]
+
+    async def read_range(self, username, filename, offset, length, version=None):
+        """Return up to length bytes of a stored file starting at offset, or None if it does not exist."""
+        if offset < 0 or length < 0:
+            raise ValueError("Offset and length must not be negative.")
+        async with self._slots:
+            try:
+                files = self.file_manager
+                file_metadata = await self._run_db(self.db_manager.retrieve_file_metadata, username, filename,
+                                                   version)
+                if not file_metadata:
+                    self.logger.warning("File '%s' not found or deleted.", filename)
+                    return None
+                key_row = await self._run_db(files._load_key, username, _key_ref(file_metadata))
+                manifest = None
+                if file_metadata[8] == 'blocks':
+                    manifest = await self._run_db(self.db_manager.get_file_chunks, file_metadata[0])
+                return await self._run_crypto(files._read_range, username, file_metadata, offset, length, key_row,
+                                              manifest)
+            except Exception as e:
+                self.logger.error("Error reading range of '%s': %s", filename, e)
+                raise
+
+    async def delete(self, username, filename):
+        """Delete a file, returning True if it was deleted."""
+        async with self._slots:
+            return await self._run_db(self.file_manager.delete, username, filename)
+
+    async def list_files(self, username):
+        """Return the metadata rows of the user's files."""
+        async with self._slots:
+            return await self._run_db(self.db_manager.list_user_files, username)
+
+    async def list_versions(self, username, filename):
+        """Return the stored versions of a file, newest first."""
+        async with self._slots:
+            return await self._run_db(self.db_manager.list_file_versions, username, filename)
+
+    async def list_shared_with_me(self, username):
+        """Return the metadata rows of the files other users have shared with this user."""
+        async with self._slots:
+            return await self._run_db(self.db_manager.list_shared_with_me, username)
+
+    async def share(self, username, filename, shared_users):
+        """Share a file with other users, returning False if it does not exist."""
+        async with self._slots:
+            return await self._run_db(self.file_manager.share, username, filename, shared_users)
+
+    async def unshare_all(self, username, filename):
+        """Remove all sharing for a file, returning False if it does not exist."""
+        async with self._slots:
+            return await self._run_db(self.file_manager.unshare_all, username, filename)
@@ -1,37 +1,155 @@
 # auth.py
-import webbrowser
-import requests
-from requests_oauthlib import OAuth2Session
-import logging
+import json
+import os
+import threading
+import time
+from logger import get_logger
+
+# Environment overrides for the GitHub endpoints, e.g. to point at a local stub server
+ENDPOINT_ENV = {
+    'auth_url': 'GICSFS_GITHUB_AUTH_URL',
+    'token_url': 'GICSFS_GITHUB_TOKEN_URL',
+    'api_url': 'GICSFS_GITHUB_API_URL',
+}
+
+# Seconds a validated session is trusted before it is revalidated in the background
+DEFAULT_SESSION_TTL = 3600
+
+def endpoints_from_env():
+    """Return the GitHubAuth endpoint overrides set in the environment."""
+    return {name: os.environ[variable] for name, variable in ENDPOINT_ENV.items() if os.environ.get(variable)}
+
+def validate_access_token(token, api_url=None, timeout=10):
+    """Validate the GitHub OAuth access token by checking it with GitHub's API."""
+    import requests  # Deferred: a cached session needs no network, and requests is slow to import
+    url = f"{(api_url or GitHubAuth.API_URL).rstrip('/')}/user"
+    headers = {'Authorization': f'token {token}'}
+    response = requests.get(url, headers=headers, timeout=timeout)
+    return response
 
 class GitHubAuth:
     AUTH_URL = "https://github.com/login/oauth/authorize"
     TOKEN_URL = "https://github.com/login/oauth/access_token"
+    API_URL = "https://api.github.com"
     REDIRECT_URI = "https://localhost"  # Use https as github does not allow http
-    
-    SCOPE = "read:user,repo" 
 
-    def __init__(self, client_id, client_secret, logger=None):
+    SCOPE = "read:user,repo"
+
+    def __init__(self, client_id, client_secret, logger=None, auth_url=None, token_url=None, api_url=None):
+        """
+        :param auth_url: OAuth authorize endpoint, defaults to GitHub's
+        :param token_url: OAuth token endpoint, defaults to GitHub's
+        :param api_url: REST API root used to resolve the user, defaults to GitHub's
+        """
         self.client_id = client_id
         self.client_secret = client_secret
         self.session = None
-        self.logger = logger or logging.getLogger("SecureFileStorage")
+        self.logger = get_logger('auth', logger)
+        self.auth_url = auth_url or self.AUTH_URL
+        self.token_url = token_url or self.TOKEN_URL
+        self.api_url = api_url or self.API_URL
 
     def authenticate(self):
         """Authenticate the user using GitHub OAuth."""
+        import webbrowser
+        from requests_oauthlib import OAuth2Session
         try:
             # Pass the scope as a space-separated string
             oauth = OAuth2Session(self.client_id, redirect_uri=self.REDIRECT_URI, scope=self.SCOPE.split())
-            auth_url, state = oauth.authorization_url(self.AUTH_URL)
+            auth_url, state = oauth.authorization_url(self.auth_url)
             print(f"Please go to {auth_url} and authorize access.")
             webbrowser.open(auth_url)
 
             # GitHub returns a URL with the authorization code after login
             redirect_response = input("Paste the full redirect URL here, https://localhost/?code=<code>&state=<state>: ")
-            token = oauth.fetch_token(self.TOKEN_URL, client_secret=self.client_secret, authorization_response=redirect_response)
+            token = oauth.fetch_token(self.token_url, client_secret=self.client_secret, authorization_response=redirect_response)
             self.session = oauth
             self.logger.info("OAuth2 authentication successful.")
             return token["access_token"]
         except Exception as e:
-            self.logger.error(f"Authentication failed: {e}")
+            self.logger.error("Authentication failed: %s", e)
             raise
+
+    def resolve_user(self, token):
+        """
+        Return the login name the token belongs to, or None if GitHub rejects it.
+
+        Network errors are raised so callers can tell "revoked" from "offline".
+        """
+        response = validate_access_token(token, self.api_url)
+        self.logger.info("Access token validation response: %s", response.status_code)
+        if response.status_code != 200:
+            return None
+        return response.json()['login']
+
+class SessionCache:
+    """
+    The GitHub token and username of the last login, encrypted with the master-password-derived key.
+
+    A session validated within ttl seconds is trusted as-is; older ones should be revalidated.
+    """
+
+    def __init__(self, config_manager, encryptor, ttl=DEFAULT_SESSION_TTL, logger=None):
+        self.config_manager = config_manager
+        self.encryptor = encryptor
+        self.ttl = ttl
+        self.logger = get_logger('auth', logger)
+
+    def load(self):
+        """Return the cached session as a dict with token, username and validated_at, or None."""
+        encrypted = self.config_manager.get_github_session()
+        if not encrypted:
+            return None
+        try:
+            session = json.loads(self.encryptor.decrypt(encrypted))
+            return session if session.get('token') and session.get('username') else None
+        except Exception as e:
+            # Stale entry from another master password or a corrupted file
+            self.logger.warning("Discarding unreadable cached GitHub session: %s", e)
+            self.clear()
+            return None
+
+    def save(self, token, username):
+        session = {'token': token, 'username': username, 'validated_at': time.time()}
+        self.config_manager.set_github_session(self.encryptor.encrypt(json.dumps(session)))
+        self.logger.info("Cached GitHub session for %s.", username)
+        return session
+
+    def clear(self):
+        self.config_manager.clear_github_session()
+
+    def is_fresh(self, session):
+        return time.time() - session.get('validated_at', 0) < self.ttl
+
+class SessionRevalidator:
+    """
+    Revalidate a cached session on a daemon thread, clearing the cache and setting revoked if GitHub rejects it.
+    """
+
+    def __init__(self, github_auth, cache, session, logger=None):
+        self.github_auth = github_auth
+        self.cache = cache
+        self.session = session
+        self.logger = get_logger('auth', logger)
+        self.revoked = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='github-revalidate', daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def join(self, timeout=None):
+        self._thread.join(timeout)
+
+    def _run(self):
+        try:
+            username = self.github_auth.resolve_user(self.session['token'])
+        except Exception as e:
+            self.logger.warning("Could not revalidate GitHub session, keeping it: %s", e)
+            return
+        if username == self.session['username']:
+            self.cache.save(self.session['token'], username)
+        else:
+            self.logger.warning("Cached GitHub session for %s is no longer valid.", self.session['username'])
+            self.cache.clear()
+            self.revoked.set()
@@ -0,0 +1,36 @@
+# benchmarks/bench_crypto.py
+import io
+import os
+
+from encryption import AESEncryptor, read_segments
+from benchmarks.harness import measure, result
+
+def _drain(records):
+    for _ in records:
+        pass
+
+def run(options):
+    """Benchmark key derivation and stream encryption/decryption."""
+    results = []
+    password = b'benchmark-password'
+    salt = os.urandom(16)
+    samples = measure(lambda: AESEncryptor(password, salt, None), options.kdf_iterations, warmup=0)
+    results.append(result('crypto.derive_key', samples))
+
+    key = os.urandom(32)
+    samples = measure(lambda: AESEncryptor.from_raw_key(key), 1000)
+    results.append(result('crypto.from_raw_key', samples))
+
+    encryptor = AESEncryptor.from_raw_key(key)
+    for size in options.payload_sizes:
+        payload = os.urandom(size)
+        iterations = max(3, min(200, (64 << 20) // size))
+
+        samples = measure(lambda: _drain(encryptor.encrypt_stream(read_segments(io.BytesIO(payload)))),
+                          iterations)
+        results.append(result('crypto.encrypt_stream', samples, bytes_per_sample=size, size=size))
+
+        sealed = b''.join(bytes(record) for record in encryptor.encrypt_stream(read_segments(io.BytesIO(payload))))
+        samples = measure(lambda: _drain(encryptor.decrypt_stream(io.BytesIO(sealed))), iterations)
+        results.append(result('crypto.decrypt_stream', samples, bytes_per_sample=size, size=size))
+    return results
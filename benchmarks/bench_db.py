@@ -0,0 +1,78 @@
+# benchmarks/bench_db.py
+import os
+import random
+import shutil
+import tempfile
+
+from db_manager import SQLiteManager
+from benchmarks.harness import measure, result, timed
+
+FILES_PER_USER = 1000
+BATCH_SIZE = 10000
+
+def _populate(db_manager, rows):
+    """Insert rows files spread over rows // FILES_PER_USER users, returning the batch timings."""
+    users = [f"user{i}" for i in range(max(1, rows // FILES_PER_USER))]
+    for username in users:
+        db_manager.initialize_user_tables(username)
+    pending = [(users[i % len(users)], f"file{i}.dat") for i in range(rows)]
+    samples = []
+    for start in range(0, rows, BATCH_SIZE):
+        # Grouped per user before timing, so only the inserts are measured
+        grouped = {}
+        for owner, name in pending[start:start + BATCH_SIZE]:
+            grouped.setdefault(owner, []).append((name, f"/bench/{name}.enc", None, 'none'))
+        def insert_batch():
+            with db_manager.transaction():
+                for username, entries in grouped.items():
+                    db_manager.insert_file_metadata_many(username, entries)
+        elapsed, _ = timed(insert_batch)
+        samples.append(elapsed)
+    return users, pending, samples
+
+def run(options):
+    """Benchmark inserts, lookups, listings and shares at each configured table size."""
+    results = []
+    rng = random.Random(0)
+    for rows in options.rows:
+        directory = tempfile.mkdtemp(prefix='gicsfs-bench-db-')
+        db_manager = SQLiteManager(os.path.join(directory, 'bench.db'))
+        try:
+            db_manager.connect(options.password)
+            users, files, samples = _populate(db_manager, rows)
+            results.append(result('db.insert_batch', samples, ops_per_sample=rows / len(samples), rows=rows))
+
+            # Distinct files, with the metadata cache emptied before each lookup
+            sample = rng.sample(files, min(options.lookups, len(files)))
+            samples = []
+            for lookup in sample:
+                db_manager.cache.clear()
+                elapsed, _ = timed(db_manager.retrieve_file_metadata, *lookup)
+                samples.append(elapsed)
+            results.append(result('db.retrieve_file_metadata', samples, rows=rows))
+
+            # Lookups that fit in the session's metadata cache, answered from it after a first pass
+            cached = sample[:max(1, db_manager.cache.max_entries // 2)]
+            for lookup in cached:
+                db_manager.retrieve_file_metadata(*lookup)
+            lookups = iter(cached)
+            samples = measure(lambda: db_manager.retrieve_file_metadata(*next(lookups)), len(cached), warmup=0)
+            results.append(result('db.retrieve_file_metadata.cached', samples, rows=rows))
+
+            grants = iter(sample)
+            samples = measure(lambda: db_manager.share_file(*next(grants), [rng.choice(users)]), len(sample),
+                              warmup=0)
+            results.append(result('db.share_file', samples, rows=rows))
+
+            listed = [rng.choice(users) for _ in range(min(options.lookups, 100))]
+            listings = iter(listed)
+            samples = measure(lambda: db_manager.list_user_files(next(listings)), len(listed), warmup=0)
+            results.append(result('db.list_user_files', samples, ops_per_sample=FILES_PER_USER, rows=rows))
+
+            listings = iter(listed)
+            samples = measure(lambda: db_manager.list_shared_with_me(next(listings)), len(listed), warmup=0)
+            results.append(result('db.list_shared_with_me', samples, rows=rows))
+        finally:
+            db_manager.close()
+            shutil.rmtree(directory, ignore_errors=True)
+    return results
@@ -0,0 +1,62 @@
+# benchmarks/bench_files.py
+import os
+import shutil
+import tempfile
+
+from db_manager import SQLiteManager
+from file_ops import FileManager
+from benchmarks.harness import result, timed
+
+USERNAME = 'bench'
+
+def _make_payload(kind, size, seed):
+    """Random bytes, or log-like text that compresses about as well as real logs."""
+    if kind == 'random':
+        return os.urandom(size)
+    lines = (f"2026-01-01 12:00:{seed % 60:02d} INFO request id={seed}-{i} path=/api/v1/items/{i % 977} "
+             f"status={200 + i % 3} duration_ms={i % 250}\n" for i in range(size // 60 + 1))
+    return ''.join(lines).encode()[:size]
+
+def run(options):
+    """Benchmark FileManager upload and download end to end for each backend and payload kind."""
+    results = []
+    cwd = os.getcwd()
+    for backend in ('file', 'blocks'):
+        for kind in ('random', 'text'):
+            for size in options.file_sizes:
+                directory = tempfile.mkdtemp(prefix='gicsfs-bench-files-')
+                storage = os.path.join(directory, 'storage')
+                sources = os.path.join(directory, 'sources')
+                output = os.path.join(directory, 'output')
+                for path in (storage, sources, output):
+                    os.makedirs(path)
+                db_manager = SQLiteManager(os.path.join(directory, 'bench.db'))
+                file_manager = FileManager(storage, db_manager, dedup=backend == 'blocks')
+                try:
+                    db_manager.connect(options.password)
+                    names = []
+                    for i in range(options.file_iterations):
+                        name = f"{kind}-{i}.dat"
+                        with open(os.path.join(sources, name), 'wb') as f:
+                            f.write(_make_payload(kind, size, i))
+                        names.append(name)
+
+                    upload = [timed(file_manager.upload, USERNAME, os.path.join(sources, name))[0]
+                              for name in names]
+                    results.append(result('files.upload', upload, bytes_per_sample=size,
+                                          backend=backend, kind=kind, size=size))
+
+                    os.chdir(output)
+                    download = [timed(file_manager.download, USERNAME, name)[0] for name in names]
+                    results.append(result('files.download', download, bytes_per_sample=size,
+                                          backend=backend, kind=kind, size=size))
+
+                    stored = sum(os.path.getsize(os.path.join(root, name))
+                                 for root, _, files in os.walk(storage) for name in files)
+                    results[-2]['stored_ratio'] = stored / (size * len(names))
+                finally:
+                    os.chdir(cwd)
+                    file_manager.close()
+                    db_manager.close()
+                    shutil.rmtree(directory, ignore_errors=True)
+    return results
@@ -0,0 +1,62 @@
+# benchmarks/bench_startup.py
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from benchmarks.harness import result, timed
+
+CLI = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'cli.py')
+
+# Modules that commands doing no crypto should never import
+HEAVY_MODULES = ('Crypto', 'pysqlcipher3', 'requests', 'requests_oauthlib', 'webbrowser', 'zstandard')
+
+# Startup scenarios: CLI arguments and the input typed at the first prompt
+SCENARIOS = {
+    'help': (['--help'], ''),
+    'exit': ([], 'exit\n'),
+}
+
+def parse_importtime(stderr):
+    """Parse `python -X importtime` output into (module, depth, cumulative microseconds) tuples."""
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or line.endswith('imported package'):
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        if not cumulative.strip().isdigit():
+            continue  # Header line
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        imports.append((name.strip(), depth, int(cumulative)))
+    return imports
+
+def run_cli(arguments, stdin, cwd, *flags):
+    """Run the CLI once to completion, returning its stderr."""
+    completed = subprocess.run([sys.executable, *flags, CLI, *arguments], input=stdin, cwd=cwd,
+                               capture_output=True, text=True, timeout=60)
+    return completed.stderr
+
+def run(options):
+    """Benchmark CLI cold start to the first prompt for commands that do no crypto."""
+    results = []
+    # A scratch working directory keeps config.json and the log out of the repository
+    directory = tempfile.mkdtemp(prefix='gicsfs-bench-startup-')
+    try:
+        for scenario, (arguments, stdin) in SCENARIOS.items():
+            run_cli(arguments, stdin, directory)  # Warm the OS file cache and bytecode
+            samples = [timed(run_cli, arguments, stdin, directory)[0] for _ in range(options.startup_iterations)]
+            entry = result('startup.wall', samples, scenario=scenario)
+            # The CLI runs in child processes, so report their peak RSS rather than the runner's
+            entry['peak_rss_kb'] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+
+            imports = parse_importtime(run_cli(arguments, stdin, directory, '-X', 'importtime'))
+            top_level = sorted(((name, us) for name, depth, us in imports if depth == 0), key=lambda item: -item[1])
+            entry['import_ms'] = sum(us for _, us in top_level) / 1000
+            entry['slowest_imports_ms'] = {name: us / 1000 for name, us in top_level[:10]}
+            entry['heavy_imports'] = sorted({name.split('.')[0] for name, _, _ in imports} & set(HEAVY_MODULES))
+            results.append(entry)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    return results
@@ -0,0 +1,92 @@
+# benchmarks/harness.py
+import math
+import resource
+import sys
+import time
+
+def timed(fn, *args, **kwargs):
+    """Run fn once, returning (elapsed seconds, result)."""
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+def measure(fn, iterations, warmup=1):
+    """Call fn() iterations times after warmup calls, returning the durations in seconds."""
+    for _ in range(warmup):
+        fn()
+    samples = []
+    for _ in range(iterations):
+        elapsed, _ = timed(fn)
+        samples.append(elapsed)
+    return samples
+
+def percentile(samples, pct):
+    """Nearest-rank percentile of a list of samples."""
+    ordered = sorted(samples)
+    rank = max(1, math.ceil(pct / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+def peak_rss_kb():
+    """Peak resident set size of this process so far, in KiB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reports bytes, Linux KiB
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+def result(name, samples, ops_per_sample=1, bytes_per_sample=0, **params):
+    """
+    Summarize timing samples as one JSON-ready benchmark result.
+
+    :param ops_per_sample: operations covered by one sample, e.g. rows in a batch insert
+    :param bytes_per_sample: payload bytes processed by one sample, for MB/s
+    """
+    total = sum(samples)
+    if params:
+        # Parameters are part of the name so a baseline lines up run to run
+        name = f"{name}[{','.join(f'{key}={value}' for key, value in params.items())}]"
+    entry = {
+        'name': name,
+        'params': params,
+        'iterations': len(samples),
+        'ops_per_sec': ops_per_sample * len(samples) / total if total else None,
+        'p50_ms': percentile(samples, 50) * 1000,
+        'p99_ms': percentile(samples, 99) * 1000,
+        'mean_ms': total / len(samples) * 1000,
+        'peak_rss_kb': peak_rss_kb(),
+    }
+    if bytes_per_sample:
+        entry['mb_per_sec'] = bytes_per_sample * len(samples) / total / 1e6 if total else None
+    return entry
+
+# Metrics compared against a baseline, and whether higher values are better
+COMPARED_METRICS = {
+    'ops_per_sec': True,
+    'mb_per_sec': True,
+    'p50_ms': False,
+    'p99_ms': False,
+    'peak_rss_kb': False,
+}
+
+def compare(results, baseline, threshold=0.10):
+    """
+    Return one dict per metric worse than in baseline by more than threshold, a fraction.
+    """
+    previous = {entry['name']: entry for entry in baseline.get('results', [])}
+    regressions = []
+    for entry in results:
+        old = previous.get(entry['name'])
+        if old is None:
+            continue
+        for metric, higher_is_better in COMPARED_METRICS.items():
+            new_value, old_value = entry.get(metric), old.get(metric)
+            if not new_value or not old_value:
+                continue
+            change = (new_value - old_value) / old_value
+            if (higher_is_better and change < -threshold) or (not higher_is_better and change > threshold):
+                regressions.append({
+                    'name': entry['name'],
+                    'metric': metric,
+                    'baseline': old_value,
+                    'current': new_value,
+                    'change': change,
+                })
+    return regressions
@@ -0,0 +1,104 @@
+# benchmarks/run.py
+"""
+Benchmark runner for the crypto, database and file pipelines.
+
+    python -m benchmarks.run --output results.json
+    python -m benchmarks.run --suite db --rows 1000 1000000
+    python -m benchmarks.run --baseline results.json --threshold 0.1
+    python -m benchmarks.run --suite startup
+
+Each suite runs in a fresh process so its peak RSS is its own. Everything
+uses a temporary SQLCipher database and storage directory; no GitHub login
+is involved.
+"""
+import argparse
+import contextlib
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import sys
+
+# Allow running as a script as well as with -m from the repository root
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_ROOT not in sys.path:
+    sys.path.insert(0, REPO_ROOT)
+
+from benchmarks.harness import compare
+
+SUITES = ('crypto', 'db', 'files', 'startup')
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Benchmark GIC's Secure File Storage.")
+    parser.add_argument('--suite', nargs='+', choices=SUITES, default=list(SUITES), help='Suites to run')
+    parser.add_argument('--output', help='Write the JSON results to this file instead of stdout')
+    parser.add_argument('--baseline', help='Compare against a previous JSON results file')
+    parser.add_argument('--threshold', type=float, default=0.10,
+                        help='Relative change that counts as a regression (default: 0.10)')
+    parser.add_argument('--password', default='benchmark-master-password', help='Master password for the temp DB')
+    parser.add_argument('--log-file', help='Log to this file while benchmarking; logging is off by default')
+    parser.add_argument('--kdf-iterations', type=int, default=5, help='PBKDF2 key derivations to time')
+    parser.add_argument('--payload-sizes', type=int, nargs='+', default=[4096, 65536, 1 << 20, 16 << 20],
+                        help='Payload sizes in bytes for the crypto suite')
+    parser.add_argument('--rows', type=int, nargs='+', default=[1000, 10000, 100000],
+                        help='Table sizes for the db suite (up to 1000000)')
+    parser.add_argument('--lookups', type=int, default=1000, help='Lookups and shares timed per table size')
+    parser.add_argument('--file-sizes', type=int, nargs='+', default=[65536, 1 << 20, 16 << 20],
+                        help='File sizes in bytes for the files suite')
+    parser.add_argument('--file-iterations', type=int, default=5, help='Files uploaded per size')
+    parser.add_argument('--startup-iterations', type=int, default=10,
+                        help='CLI launches timed per startup scenario')
+    return parser
+
+def run_suite(suite, options):
+    """Run one suite in this process and return its results."""
+    from logger import Logger
+    if options.log_file:
+        Logger(options.log_file)
+    module = __import__(f"benchmarks.bench_{suite}", fromlist=['run'])
+    # FileManager reports progress on stdout, which carries the JSON output
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        return module.run(options)
+
+def main(argv=None):
+    options = build_parser().parse_args(argv)
+    results = []
+    context = multiprocessing.get_context('spawn')
+    for suite in options.suite:
+        print(f"Running {suite} benchmarks...", file=sys.stderr)
+        with context.Pool(1) as pool:
+            results.extend(pool.apply(run_suite, (suite, options)))
+
+    report = {
+        'meta': {
+            'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'suites': options.suite,
+        },
+        'results': results,
+    }
+
+    status = 0
+    if options.baseline:
+        with open(options.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, options.threshold)
+        report['regressions'] = regressions
+        for regression in regressions:
+            print(f"REGRESSION {regression['name']} {regression['metric']}: {regression['baseline']:.4g} -> "
+                  f"{regression['current']:.4g} ({regression['change']:+.1%})", file=sys.stderr)
+        status = 1 if regressions else 0
+
+    output = json.dumps(report, indent=2)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+    return status
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,167 @@
+# block_store.py
+import os
+from logger import get_logger
+import hashlib
+import zlib
+from compressor import CODECS, MIN_RATIO, compress, decompress
+
+MIN_CHUNK_SIZE = 256 * 1024
+AVG_CHUNK_SIZE = 1024 * 1024
+MAX_CHUNK_SIZE = 4 * 1024 * 1024
+
+# Boundary detection runs in two stages so the per-byte work stays in C:
+# every byte is mapped to a pseudo-random bit with bytes.translate and
+# bytes.find looks for a fixed bit pattern, then each candidate is confirmed
+# by a CRC-32 over the preceding WINDOW_SIZE bytes. Both stages only look at
+# a small window of content, so boundaries resynchronise after an edit.
+BIT_TABLE = bytes(hashlib.sha256(bytes([i])).digest()[0] & 1 for i in range(256))
+PREFILTER_PATTERN = b'\x01\x00\x01\x01\x00\x00\x01\x00'
+PREFILTER_BITS = len(PREFILTER_PATTERN)
+WINDOW_SIZE = 32
+
+class BlockStore:
+    """Content-addressed, deduplicating storage for encrypted file chunks under base_directory/.blocks/ab/cd/.
+
+    The database keeps the per-file manifests and a reference count per block.
+    """
+
+    def __init__(self, base_directory, logger=None, min_size=MIN_CHUNK_SIZE, avg_size=AVG_CHUNK_SIZE,
+                 max_size=MAX_CHUNK_SIZE):
+        if not min_size < avg_size < max_size:
+            raise ValueError("Chunk sizes must satisfy min_size < avg_size < max_size.")
+        self.block_directory = os.path.join(base_directory, '.blocks')
+        self.logger = get_logger('blocks', logger)
+        self.min_size = min_size
+        self.avg_size = avg_size
+        self.max_size = max_size
+        # A boundary is expected once every 2**bits bytes past min_size; the
+        # prefilter accounts for PREFILTER_BITS of them and the CRC for the rest.
+        bits = max(PREFILTER_BITS + 1, (avg_size - min_size).bit_length() - 1)
+        self._cut_mask = (1 << (bits - PREFILTER_BITS)) - 1
+
+    def block_path(self, address, codec='none'):
+        """Return the on-disk path of a block."""
+        name = address if codec == 'none' else f"{address}.{codec}"
+        return os.path.join(self.block_directory, address[:2], address[2:4], name)
+
+    def _find_block(self, address):
+        """Return (path, codec) of the stored copy of a block, or (None, None)."""
+        for codec in ('none', *CODECS):
+            path = self.block_path(address, codec)
+            if os.path.exists(path):
+                return path, codec
+        return None, None
+
+    def chunks(self, reader):
+        """Yield a binary file as content-defined chunks."""
+        buffer = bytearray()
+        eof = False
+        while True:
+            while not eof and len(buffer) < self.max_size:
+                data = reader.read(self.max_size)
+                if data:
+                    buffer += data
+                else:
+                    eof = True
+            if not buffer:
+                return
+            cut = self._find_cut(buffer)
+            yield bytes(buffer[:cut])
+            del buffer[:cut]
+
+    def _find_cut(self, buffer):
+        """Return the length of the next chunk at the start of buffer."""
+        end = min(len(buffer), self.max_size)
+        if end <= self.min_size:
+            return end
+        start = max(self.min_size, WINDOW_SIZE) - PREFILTER_BITS
+        bits = buffer[start:end].translate(BIT_TABLE)
+        crc32, cut_mask = zlib.crc32, self._cut_mask
+        position = bits.find(PREFILTER_PATTERN)
+        while position != -1:
+            cut = start + position + PREFILTER_BITS
+            if not crc32(buffer[cut - WINDOW_SIZE:cut]) & cut_mask:
+                return cut
+            position = bits.find(PREFILTER_PATTERN, position + 1)
+        return end
+
+    def store(self, block_encryptor, source_path, codec='none', known=None):
+        """Chunk, compress where it pays, encrypt and store a file, skipping blocks in known or on disk.
+
+        :return: (manifest, new_blocks) where manifest is a list of (address, length, stored_size, codec) tuples
+        """
+        manifest, new_blocks = [], 0
+        with open(source_path, 'rb') as src:
+            for chunk in self.chunks(src):
+                address = block_encryptor.address(chunk)
+                if known and address in known:
+                    manifest.append((address, len(chunk), *known[address]))
+                    continue
+                path, block_codec = self._find_block(address)
+                if path:
+                    manifest.append((address, len(chunk), os.path.getsize(path), block_codec))
+                    continue
+                payload, block_codec = chunk, 'none'
+                if codec != 'none':
+                    compressed = compress(chunk, codec)
+                    if len(compressed) < len(chunk) * MIN_RATIO:
+                        payload, block_codec = compressed, codec
+                blob = block_encryptor.seal(address, payload, block_codec)
+                self._write_block(self.block_path(address, block_codec), blob)
+                manifest.append((address, len(chunk), len(blob), block_codec))
+                new_blocks += 1
+        self.logger.info("Stored %s chunks (%s new) for '%s'.", len(manifest), new_blocks, source_path)
+        return manifest, new_blocks
+
+    def _write_block(self, path, blob):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(temp_path, 'wb') as dst:
+                dst.write(blob)
+            os.replace(temp_path, path)
+        except Exception:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    def read_chunks(self, block_encryptor, manifest):
+        """Yield the decrypted chunks of a manifest of (address, length, codec) tuples in order."""
+        for address, length, codec in manifest:
+            with open(self.block_path(address, codec), 'rb') as src:
+                chunk = block_encryptor.open(address, src.read(), codec)
+            if codec != 'none':
+                chunk = decompress(chunk, codec, limit=length)
+            if len(chunk) != length:
+                raise ValueError(f"Block {address} has unexpected length.")
+            yield chunk
+
+    def restore(self, block_encryptor, manifest, output_path):
+        """Reassemble a file from its manifest into output_path."""
+        temp_path = f"{output_path}.tmp"
+        try:
+            with open(temp_path, 'wb') as dst:
+                for chunk in self.read_chunks(block_encryptor, manifest):
+                    dst.write(chunk)
+            os.replace(temp_path, output_path)
+        except Exception:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    def missing(self, addresses):
+        """Return the addresses whose block file is not on disk."""
+        return [address for address in addresses if self._find_block(address)[0] is None]
+
+    def remove(self, addresses):
+        """Delete unreferenced blocks from disk."""
+        for address in addresses:
+            for codec in ('none', *CODECS):
+                try:
+                    os.remove(self.block_path(address, codec))
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    self.logger.warning("Could not remove block %s: %s", address, e)
+        if addresses:
+            self.logger.info("Garbage collected %s blocks.", len(addresses))
@@ -1,17 +1,15 @@
 # cli.py
 import argparse
-from encryption import AESEncryptor
-from file_ops import FileManager
+import contextlib
+import json
 from config_manager import ConfigManager
-from db_manager import SQLiteManager
 from logger import Logger
-from auth import GitHubAuth
-import requests
 import os
 import sys
-from pysqlcipher3 import dbapi2 as sqlite
 import getpass
 import re
+import glob
+import fnmatch
 
 def prompt_for_github_client_id():
     return input("Enter GitHub Client ID: ")
@@ -22,27 +20,56 @@ def prompt_for_github_client_secret():
 def prompt_for_master_password():
     return getpass.getpass("Enter your master password: ")
 
+# encryption, db_manager, file_ops and auth pull in PyCryptodome, SQLCipher and
+# requests, which take longer to import than the rest of the CLI takes to start.
+# They are imported where first needed so prompts, --help and exit stay fast.
+
+# Non-interactive credentials for scripted runs
+MASTER_PASSWORD_ENV = 'GICSFS_MASTER_PASSWORD'
+GITHUB_TOKEN_ENV = 'GICSFS_GITHUB_TOKEN'
+KEYRING_SERVICE = 'gicsfs'
+
+def read_keyring(name):
+    """Read a secret from the system keyring, if the optional keyring package is installed."""
+    try:
+        import keyring
+    except ImportError:
+        return None
+    try:
+        return keyring.get_password(KEYRING_SERVICE, name)
+    except Exception:
+        return None
+
+def get_master_password():
+    """Master password from $GICSFS_MASTER_PASSWORD, the keyring, or a prompt when attached to a terminal."""
+    master_password = os.environ.get(MASTER_PASSWORD_ENV) or read_keyring('master-password')
+    if not master_password and sys.stdin.isatty():
+        master_password = prompt_for_master_password()
+    return master_password
+
+def get_github_token():
+    """A GitHub token from $GICSFS_GITHUB_TOKEN or the keyring, so scripted runs can skip the OAuth flow."""
+    return os.environ.get(GITHUB_TOKEN_ENV) or read_keyring('github-token')
+
+def confirm_cached_session(username):
+    answer = input(f"Continue as GitHub user {username}? Enter n to log in as someone else [Y/n]: ")
+    return answer.strip().lower() in ('', 'y', 'yes')
+
 def prompt_for_storage_path():
     return input("Enter the storage path: ")
 
-def validate_access_token(token):
-    """Validate the GitHub OAuth access token by checking it with GitHub's API."""
-    url = "https://api.github.com/user"
-    headers = {'Authorization': f'token {token}'}
-    response = requests.get(url, headers=headers)
-    return response
-
 def setup_database(master_password, logger):
+    from db_manager import SQLiteManager
     db_path = 'storage.db'
     try:
-        conn = sqlite.connect(db_path)
-        conn.execute(f"PRAGMA key = '{master_password}'")
-        conn.execute("CREATE TABLE IF NOT EXISTS users (username TEXT PRIMARY KEY, salt TEXT, aes_key TEXT)")
-        conn.close()
+        # Connecting creates the schema through SQLiteManager's migrations
+        db_manager = SQLiteManager(db_path, logger)
+        db_manager.connect(master_password)
+        db_manager.close()
         logger.info("Database setup completed successfully.")
         return True
     except Exception as e:
-        logger.error(f"Error setting up database: {e}")
+        logger.error("Error setting up database: %s", e)
         return False
 
 def validate_input(input_string, input_type, logger):
@@ -75,18 +102,18 @@ def validate_input(input_string, input_type, logger):
         username_pattern = r'^[a-zA-Z_][\w\d.]*$'
         if input_type == 'username':
             if re.match(username_pattern, input_string):
-                logger.info(f"Valid username: {input_string}")
+                logger.info("Valid username: %s", input_string)
                 return input_string
         else:  # usernames
             usernames = [username.strip() for username in input_string.split(',')]
             valid_usernames = [username for username in usernames if re.match(username_pattern, username)]
             invalid_usernames = [username for username in usernames if username not in valid_usernames]
             if invalid_usernames:
-                logger.warning(f"Invalid usernames: {', '.join(invalid_usernames)}")
+                logger.warning("Invalid usernames: %s", ', '.join(invalid_usernames))
             return valid_usernames  # Return the list even if it's empty
     elif input_type == 'command':
         # Allow only specific commands
-        valid_commands = ['upload', 'download', 'list', 'delete', 'share', 'shared_file', 'exit', 'admin', 'login', 're-register', 'list-users', 'register']
+        valid_commands = ['upload', 'download', 'list', 'delete', 'share', 'shared_file', 'ls-shared', 'exit', 'admin', 'login', 're-register', 'list-users', 'register', 'migrate', 'relayout', 'scrub']
         if input_string.lower() in valid_commands:
             return input_string.lower()
 
@@ -94,19 +121,395 @@ def validate_input(input_string, input_type, logger):
 
 def verify_master_password(db_manager, master_password):
     try:
-        # Attempt to connect to the database with the provided master password
+        # Attempt to connect to the database with the provided master password.
+        # The connection stays open so the session only unlocks the database once.
         db_manager.connect(master_password)
-        # If successful, close the connection and return True
-        db_manager.conn.close()
         return True
     except Exception as e:
         # If connection fails, the master password is incorrect
         return False
 
-def main():
+def open_user_session(config_manager, master_password, logger, db_manager=None, access_token=None, confirm=False):
+    """
+    Unlock the database and authenticate the user with GitHub.
+
+    The OS user's cached GitHub session is reused, and revalidated in the background once past its TTL.
+
+    :param db_manager: an already unlocked SQLiteManager to reuse, if any
+    :param access_token: an existing GitHub token to use instead of the cached session or the OAuth flow
+    :param confirm: ask before reusing the cached session, running the OAuth flow if declined
+    :return: (db_manager, username, revalidator), or (None, None, None) if any step fails; revalidator
+             is the running SessionRevalidator, or None if the session needed no revalidation
+    """
+    from auth import GitHubAuth, SessionCache, SessionRevalidator, endpoints_from_env
+    from db_manager import SQLiteManager
+    from encryption import AESEncryptor
+
+    # Connect to the database
+    try:
+        db_manager = db_manager or SQLiteManager('storage.db', logger)
+        db_manager.connect(master_password)
+    except Exception as e:
+        print(f"Failed to connect to the database: {e}")
+        logger.error("Database connection failed: %s", e)
+        return None, None, None
+
+    # Decrypt the GitHub credentials and cached session with the master password
+    encryptor = AESEncryptor(master_password, config_manager.get_salt(), config_manager, logger)
+    client_id = config_manager.get_client_id()
+    encrypted_client_secret = config_manager.get_encrypted_client_secret()
+    github_auth = GitHubAuth(client_id, encryptor.decrypt(encrypted_client_secret), logger, **endpoints_from_env())
+    cache = SessionCache(config_manager, encryptor, config_manager.get_session_ttl(), logger)
+
+    session = cache.load()
+    if session and access_token is None and confirm and not confirm_cached_session(session['username']):
+        # Replaced once the new login succeeds
+        session = None
+    if session and access_token in (None, session['token']):
+        logger.info("Reusing cached GitHub session for %s.", session['username'])
+        if cache.is_fresh(session):
+            return db_manager, session['username'], None
+        return db_manager, session['username'], SessionRevalidator(github_auth, cache, session, logger).start()
+
+    if access_token is None:
+        # Perform GitHub OAuth once, at the start of the session
+        try:
+            access_token = github_auth.authenticate()
+            logger.info("GitHub OAuth authentication successful.")
+        except Exception as e:
+            print(f"GitHub authentication failed: {e}")
+            logger.error("GitHub authentication failed: %s", e)
+            db_manager.close()  # Close the database connection before continuing
+            return None, None, None
+
+    # Validate the access token
+    try:
+        username = github_auth.resolve_user(access_token)
+    except Exception as e:
+        print(f"Could not reach GitHub to validate the access token: {e}")
+        logger.error("Access token validation failed: %s", e)
+        username = None
+    if not username:
+        print("Invalid access token. Please try again.")
+        db_manager.close()  # Close the database connection before continuing
+        return None, None, None
+
+    cache.save(access_token, username)
+    return db_manager, username, None
+
+def session_revoked(revalidator):
+    """Report whether background revalidation found the cached GitHub session revoked."""
+    if revalidator is not None and revalidator.revoked.is_set():
+        print("Your GitHub session is no longer valid. Please log in again.", file=sys.stderr)
+        return True
+    return False
+
+def build_parser():
+    """Build the parser for the non-interactive subcommands."""
+    parser = argparse.ArgumentParser(
+        description="GIC's Secure File Storage CLI. Run without a command to start the interactive session.",
+        epilog=f"Credentials for scripted use come from ${MASTER_PASSWORD_ENV} and ${GITHUB_TOKEN_ENV}, "
+               f"or the '{KEYRING_SERVICE}' keyring service if the keyring package is installed.")
+    subparsers = parser.add_subparsers(dest='command')
+
+    # Options shared by every subcommand
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--json', action='store_true', help='Print a JSON report on stdout; messages go to stderr.')
+    jobs = argparse.ArgumentParser(add_help=False)
+    jobs.add_argument('--jobs', type=int, default=None, help='Number of worker threads (default: CPU count).')
+
+    upload_parser = subparsers.add_parser('upload', parents=[common, jobs],
+                                          help='Encrypt and upload files matching paths or glob patterns.')
+    upload_parser.add_argument('paths', nargs='+', help='File paths or glob patterns to upload.')
+
+    download_parser = subparsers.add_parser('download', parents=[common, jobs],
+                                            help='Decrypt and download stored files matching names or glob patterns.')
+    download_parser.add_argument('filenames', nargs='+', help='Stored file names or glob patterns to download.')
+    download_parser.add_argument('--output-dir', default=None, help='Directory to write files to (default: current directory).')
+    download_parser.add_argument('--version', type=int, default=None,
+                                 help='Download this version of the files instead of the current one.')
+
+    subparsers.add_parser('list', parents=[common], help='List your stored files.')
+
+    versions_parser = subparsers.add_parser('versions', parents=[common], help='List the stored versions of a file.')
+    versions_parser.add_argument('filename', help='Stored file name.')
+
+    delete_parser = subparsers.add_parser('delete', parents=[common],
+                                          help='Delete stored files matching names or glob patterns.')
+    delete_parser.add_argument('filenames', nargs='+', help='Stored file names or glob patterns to delete.')
+
+    share_parser = subparsers.add_parser('share', parents=[common],
+                                         help='Set who stored files matching names or glob patterns are shared with.')
+    share_parser.add_argument('filenames', nargs='+', help='Stored file names or glob patterns to share.')
+    share_group = share_parser.add_mutually_exclusive_group(required=True)
+    share_group.add_argument('--with', dest='users', help='Comma-separated GitHub usernames to share with.')
+    share_group.add_argument('--unshare-all', action='store_true', help='Remove all sharing from the files.')
+
+    subparsers.add_parser('ls-shared', parents=[common], help='List files other users have shared with you.')
+    subparsers.add_parser('rotate-key', parents=[common],
+                          help='Replace your encryption key, re-wrapping the per-file keys without re-encrypting files.')
+    subparsers.add_parser('logout', help='Forget the cached GitHub session.')
+
+    # Options of the resumable admin jobs over the whole store
+    throttle = argparse.ArgumentParser(add_help=False, parents=[jobs])
+    throttle.add_argument('--rate-limit', type=float, default=None,
+                          help='Cap disk I/O at this many MiB per second (default: unlimited).')
+    throttle.add_argument('--cpu-share', type=float, default=1.0,
+                          help='Fraction of the time each worker may be busy, in (0, 1] (default: 1).')
+    throttle.add_argument('--restart', action='store_true', help='Ignore the saved checkpoint and start over.')
+
+    migrate_parser = subparsers.add_parser('migrate', parents=[throttle],
+                                           help='Admin: re-encrypt stored files in the background, resumably.')
+    migrate_parser.add_argument('--all', action='store_true',
+                                help='Re-encrypt every stored file, not only those without their own data key.')
+    subparsers.add_parser('relayout', parents=[throttle],
+                          help='Admin: move files stored before the sharded layout into it, resumably.')
+    subparsers.add_parser('scrub', parents=[common, throttle],
+                          help='Admin: verify every stored file and report missing, corrupt and orphaned ones.')
+    return parser
+
+def expand_upload_paths(patterns, logger):
+    """Expand glob patterns into validated local file paths.
+
+    :return: (paths, failed) where failed holds (path, error) for invalid paths
+    """
+    paths, failed = [], []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern)) or [pattern]
+        for match in matches:
+            path = validate_input(match, 'path', logger)
+            if not path or not os.path.isfile(path):
+                print(f"Skipping invalid file path: {match}")
+                logger.warning("Skipping invalid file path: %s", match)
+                failed.append((match, "not a valid file path"))
+                continue
+            paths.append(path)
+    return list(dict.fromkeys(paths)), failed
+
+def expand_stored_filenames(db_manager, username, patterns, logger):
+    """Expand glob patterns against the user's stored file names.
+
+    :return: (filenames, failed) where failed holds (pattern, error) for patterns matching nothing
+    """
+    stored = [file['file_name'] for file in db_manager.list_user_files(username)]
+    filenames, failed = [], []
+    for pattern in patterns:
+        matches = fnmatch.filter(stored, pattern)
+        if not matches:
+            print(f"No stored files match '{pattern}'.")
+            logger.warning("No stored files match '%s'.", pattern)
+            failed.append((pattern, "no matching stored file"))
+        filenames.extend(matches)
+    return list(dict.fromkeys(filenames)), failed
+
+def print_progress(done, total, name):
+    print(f"[{done}/{total}] {name}")
+
+def batch_upload(args, file_manager, db_manager, username, logger):
+    paths, invalid = expand_upload_paths(args.paths, logger)
+    succeeded, failed = file_manager.upload_many(username, paths, jobs=args.jobs, progress=print_progress)
+    return succeeded, invalid + failed
+
+def batch_download(args, file_manager, db_manager, username, logger):
+    filenames, unmatched = expand_stored_filenames(db_manager, username, args.filenames, logger)
+    succeeded, failed = file_manager.download_many(username, filenames, jobs=args.jobs, progress=print_progress,
+                                                   output_dir=args.output_dir, version=args.version)
+    return succeeded, unmatched + failed
+
+def batch_delete(args, file_manager, db_manager, username, logger):
+    filenames, failed = expand_stored_filenames(db_manager, username, args.filenames, logger)
+    succeeded = []
+    for filename in filenames:
+        try:
+            if file_manager.delete(username, filename):
+                succeeded.append(filename)
+            else:
+                failed.append((filename, "not found"))
+        except Exception as e:
+            failed.append((filename, str(e)))
+    return succeeded, failed
+
+def batch_share(args, file_manager, db_manager, username, logger):
+    users = []
+    if not args.unshare_all:
+        users = validate_input(args.users, 'usernames', logger)
+        if not users:
+            raise ValueError("No valid usernames provided.")
+    filenames, failed = expand_stored_filenames(db_manager, username, args.filenames, logger)
+    succeeded = []
+    with db_manager.transaction():
+        for filename in filenames:
+            shared = file_manager.unshare_all(username, filename) if args.unshare_all else \
+                file_manager.share(username, filename, users)
+            if shared:
+                succeeded.append(filename)
+            else:
+                failed.append((filename, "not found"))
+    return succeeded, failed
+
+def batch_list(args, file_manager, db_manager, username, logger):
+    if not args.json:
+        file_manager.list_files(username)
+    return db_manager.list_user_files(username)
+
+def batch_list_versions(args, file_manager, db_manager, username, logger):
+    if not args.json:
+        file_manager.list_versions(username, args.filename)
+    return db_manager.list_file_versions(username, args.filename)
+
+def batch_list_shared(args, file_manager, db_manager, username, logger):
+    if not args.json:
+        file_manager.list_shared_with_me(username)
+    return db_manager.list_shared_with_me(username)
+
+def batch_rotate_key(args, file_manager, db_manager, username, logger):
+    file_manager.rotate_key(username)
+    return [username], []
+
+# Subcommand -> handler. Handlers of commands that act on many files return
+# (succeeded, failed); listing commands return their rows.
+BATCH_COMMANDS = {
+    'upload': batch_upload,
+    'download': batch_download,
+    'delete': batch_delete,
+    'share': batch_share,
+    'list': batch_list,
+    'versions': batch_list_versions,
+    'ls-shared': batch_list_shared,
+    'rotate-key': batch_rotate_key,
+}
+
+def run_batch_command(args, config_manager, logger):
+    """Run a non-interactive subcommand and return the process exit code."""
+    if not config_manager.get_registration_complete():
+        print("Application is not registered. Run the CLI without a command to register first.", file=sys.stderr)
+        return 1
+
+    master_password = get_master_password()
+    if not master_password:
+        print(f"No master password: set ${MASTER_PASSWORD_ENV} or store it in the keyring.", file=sys.stderr)
+        return 1
+
+    # With --json, stdout carries only the report
+    messages = sys.stderr if args.json else sys.stdout
+    with contextlib.redirect_stdout(messages):
+        db_manager, username, revalidator = open_user_session(config_manager, master_password, logger,
+                                                              access_token=get_github_token())
+    if not db_manager:
+        return 1
+
+    from file_ops import FileManager
+    file_manager = FileManager(config_manager.get_storage_path(), db_manager, logger,
+                               dedup=config_manager.get_storage_backend() == 'blocks',
+                               compression=config_manager.get_compression(),
+                               delta=config_manager.get_delta_uploads())
+    try:
+        if revalidator is not None:
+            # A stale session is only trusted once GitHub confirms it is still valid
+            revalidator.join()
+            if session_revoked(revalidator):
+                return 1
+        with contextlib.redirect_stdout(messages):
+            outcome = BATCH_COMMANDS[args.command](args, file_manager, db_manager, username, logger)
+        if args.command in ('list', 'versions', 'ls-shared'):
+            if args.json:
+                print(json.dumps({'command': args.command, 'user': username, 'files': outcome}, indent=2, default=str))
+            return 0
+
+        succeeded, failed = outcome
+        if args.json:
+            print(json.dumps({
+                'command': args.command,
+                'user': username,
+                'succeeded': succeeded,
+                'failed': [{'name': name, 'error': error} for name, error in failed],
+            }, indent=2))
+        else:
+            for name, error in failed:
+                print(f"Failed: {name}: {error}")
+            print(f"{args.command.capitalize()} complete: {len(succeeded)} succeeded, {len(failed)} failed.")
+        return 0 if not failed else 1
+    except Exception as e:
+        print(f"Error during {args.command}: {e}", file=sys.stderr)
+        logger.error("Error during batch %s: %s", args.command, e)
+        return 1
+    finally:
+        file_manager.close()
+        db_manager.close()
+
+def run_storage_job(command, config_manager, db_manager, logger, restart=False, rate_limit=None, json_output=False,
+                    **options):
+    """Run the migrate, relayout or scrub job over every user's stored files, returning the process exit code.
+
+    rate_limit is in MiB per second; the remaining options go to the job.
+    """
+    from file_ops import FileManager
+    from migration import Migrator, Relayout
+    from scrub import Scrubber
+    job_class = {'migrate': Migrator, 'relayout': Relayout, 'scrub': Scrubber}[command]
+    # With json_output, stdout carries only the report
+    messages = sys.stderr if json_output else sys.stdout
+    file_manager = FileManager(config_manager.get_storage_path(), db_manager, logger)
+    try:
+        job = job_class(file_manager, rate_limit=int(rate_limit * 1024 * 1024) if rate_limit else None,
+                        logger=logger, **options)
+        with contextlib.redirect_stdout(messages):
+            outcome = job.run(restart=restart, progress=lambda processed, failed, position: print(
+                f"Processed {processed} files, {failed} failed (up to file {position})."))
+        problems = outcome.get('problems', [])
+        if json_output:
+            print(json.dumps({'command': command, **outcome}, indent=2))
+        else:
+            for problem in problems:
+                where = problem['path']
+                if problem['file_id'] is not None:
+                    where = f"file {problem['file_id']} ('{problem['file_name']}' of {problem['owner']}) at {where}"
+                print(f"{problem['kind'].capitalize()}: {where}: {problem['error']}")
+            print(f"The {command} job is complete: {outcome['processed']} files processed, {outcome['failed']} failed"
+                  + (f", {len(problems)} problems found." if command == 'scrub' else "."))
+        return 1 if outcome['failed'] or problems else 0
+    except KeyboardInterrupt:
+        print(f"The {command} job was interrupted. Run it again to resume from the last checkpoint.")
+        return 130
+    finally:
+        file_manager.close()
+
+def run_storage_command(args, config_manager, logger):
+    """Run the migrate, relayout or scrub subcommand, which needs the master password but no GitHub login."""
+    if not config_manager.get_registration_complete():
+        print("Application is not registered. Run the CLI without a command to register first.", file=sys.stderr)
+        return 1
+    master_password = get_master_password()
+    if not master_password:
+        print(f"No master password: set ${MASTER_PASSWORD_ENV} or store it in the keyring.", file=sys.stderr)
+        return 1
+    from db_manager import SQLiteManager
+    db_manager = SQLiteManager('storage.db', logger)
+    if not verify_master_password(db_manager, master_password):
+        print("Incorrect master password.", file=sys.stderr)
+        return 1
+    try:
+        options = {'reencrypt_all': args.all} if args.command == 'migrate' else {}
+        return run_storage_job(args.command, config_manager, db_manager, logger, args.restart, args.rate_limit,
+                               getattr(args, 'json', False), jobs=args.jobs, cpu_share=args.cpu_share, **options)
+    finally:
+        db_manager.close()
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
     logger = Logger('GICSFS-CLI.log').logger
     config_manager = ConfigManager(logger)
 
+    if args.command == 'logout':
+        config_manager.clear_github_session()
+        print("Cached GitHub session cleared.")
+        logger.info("Cached GitHub session cleared.")
+        return 0
+    if args.command in ('migrate', 'relayout', 'scrub'):
+        return run_storage_command(args, config_manager, logger)
+    if args.command:
+        return run_batch_command(args, config_manager, logger)
+
     # Continuous CLI session
     while True:
         if not config_manager.get_registration_complete():
@@ -130,23 +533,26 @@ def main():
 
             master_password = prompt_for_master_password()
             if setup_database(master_password, logger):
-                salt = AESEncryptor.generate_key_and_salt()
-                config_manager.set_salt(salt[1])
-                
-                github_client_id = prompt_for_github_client_id()
-                config_manager.set_client_id(github_client_id)
-                
-                github_client_secret = prompt_for_github_client_secret()
-                encryptor = AESEncryptor(master_password, salt[1], config_manager, logger)
-                encrypted_client_secret = encryptor.encrypt(github_client_secret)
-                config_manager.set_encrypted_client_secret(encrypted_client_secret)
-                
-                storage_path = prompt_for_storage_path()
-                config_manager.set_storage_path(storage_path)
-                
+                from encryption import AESEncryptor
+                # Everything is written to config.json at once, when registration completes
+                with config_manager.batch():
+                    salt = AESEncryptor.generate_key_and_salt()
+                    config_manager.set_salt(salt[1])
+
+                    github_client_id = prompt_for_github_client_id()
+                    config_manager.set_client_id(github_client_id)
+
+                    github_client_secret = prompt_for_github_client_secret()
+                    encryptor = AESEncryptor(master_password, salt[1], config_manager, logger)
+                    encrypted_client_secret = encryptor.encrypt(github_client_secret)
+                    config_manager.set_encrypted_client_secret(encrypted_client_secret)
+
+                    storage_path = prompt_for_storage_path()
+                    config_manager.set_storage_path(storage_path)
+
+                    config_manager.set_registration_complete(True)
                 print("Registration completed successfully.")
                 logger.info("Registration completed successfully.")
-                config_manager.set_registration_complete(True)
             else:
                 print("Registration failed. Please try again.")
             continue
@@ -161,6 +567,7 @@ def main():
             
             if user_input in ['admin', 'login']:
                 master_password = prompt_for_master_password()
+                from db_manager import SQLiteManager
                 db_manager = SQLiteManager('storage.db', logger)
                 if not verify_master_password(db_manager, master_password):
                     print("Incorrect master password. Please try again.")
@@ -170,10 +577,11 @@ def main():
             if user_input == 'admin':
                 print("Admin mode enabled.")
                 while True:  # Start an admin mode loop
-                    print("What would you like to do? Type re-register to re-register the application, type list-users to list all users, or type exit to quit admin mode.")
+                    print("What would you like to do? Type re-register to re-register the application, type list-users to list all users, type migrate to re-encrypt stored files, type relayout to move old files into the sharded layout, type scrub to verify stored files, or type exit to quit admin mode.")
                     admin_input = validate_input(input("GICSFS Admin> ").strip().lower(), 'command', logger)
                     if admin_input == 're-register':
                         print("Re-registering the application.")
+                        db_manager.close()
                         os.remove('storage.db')
                         os.remove('config.json')
                         config_manager.set_registration_complete(False)
@@ -181,13 +589,14 @@ def main():
                         return  # Exit the main function
                     elif admin_input == 'list-users':
                         print("Listing all users.")
-                        db_manager = SQLiteManager('storage.db', logger)
-                        db_manager.connect(master_password)
                         users = db_manager.list_all_users()
                         print("Users:", ', '.join(users))
-                        db_manager.conn.close()
+                    elif admin_input in ('migrate', 'relayout', 'scrub'):
+                        print("Processing stored files. Press Ctrl+C to pause; the next run resumes.")
+                        run_storage_job(admin_input, config_manager, db_manager, logger)
                     elif admin_input == 'exit':
                         print("Exiting admin mode.")
+                        db_manager.close()
                         break  # Break out of the admin mode loop
                     else:
                         print("Invalid admin command. Please try again.")
@@ -204,53 +613,26 @@ def main():
                 logger.error("Invalid command. Only acceptable commands are 'admin' or 'login'.")
                 continue
 
-            # Initialize the encryptor with the master password and load GitHub credentials from config
-            encryptor = AESEncryptor(master_password, config_manager.get_salt(), config_manager, logger)
-
-            client_id = config_manager.get_client_id()
-            encrypted_client_secret = config_manager.get_encrypted_client_secret()
-            client_secret = encryptor.decrypt(encrypted_client_secret)
-
-            # Connect to the database
-            try:
-                db_manager = SQLiteManager('storage.db', logger)
-                db_manager.connect(master_password)
-            except Exception as e:
-                print(f"Failed to connect to the database: {e}")
-                logger.error(f"Database connection failed: {e}")
-                continue
-
-            # Perform GitHub OAuth once, at the start of the session
-            github_auth = GitHubAuth(client_id, client_secret, logger)
-            try:
-                access_token = github_auth.authenticate()
-                logger.info("GitHub OAuth authentication successful.")
-            except Exception as e:
-                print(f"GitHub authentication failed: {e}")
-                logger.error(f"GitHub authentication failed: {e}")
-                db_manager.conn.close()  # Close the database connection before continuing
-                continue  
-
-            # Validate the access token
-            response = validate_access_token(access_token)
-            logger.info(f"Access token validation response: {response.status_code}")
-
-            if response.status_code != 200:
-                print("Invalid access token. Please try again.")
-                db_manager.conn.close()  # Close the database connection before continuing
+            db_manager, username, revalidator = open_user_session(config_manager, master_password, logger, db_manager,
+                                                                  confirm=True)
+            if not db_manager:
                 continue
 
-            username = response.json()['login']
+            from file_ops import FileManager
             storage_path = config_manager.get_storage_path()
-            file_manager = FileManager(storage_path, db_manager, logger)
+            file_manager = FileManager(storage_path, db_manager, logger,
+                                       dedup=config_manager.get_storage_backend() == 'blocks',
+                                       compression=config_manager.get_compression(),
+                                       delta=config_manager.get_delta_uploads())
             print(f"Authenticated as {username}. You can now upload, download, list, or delete files. Type 'exit' to quit.")
 
             while True:
-                operation_input = validate_input(input("Enter command (upload, download, list, delete, share, shared_file, exit): ").strip().lower(), 'command', logger)
+                operation_input = validate_input(input("Enter command (upload, download, list, delete, share, shared_file, ls-shared, exit): ").strip().lower(), 'command', logger)
 
-                if operation_input == 'exit':
+                if operation_input == 'exit' or session_revoked(revalidator):
                     print("Exiting the session.")
-                    db_manager.conn.close()  # Close the database connection
+                    file_manager.close()  # Zeroize cached keys
+                    db_manager.close()  # Close the database connection
                     break
                 elif not operation_input:
                     print("Invalid command. Please try again.")
@@ -305,6 +687,8 @@ def main():
                             
                             file_manager.share(username, filename, valid_shared_users)
                             print(f"File '{filename}' shared with: {', '.join(valid_shared_users)}")
+                    elif operation_input == 'ls-shared':
+                        file_manager.list_shared_with_me(username)
                     elif operation_input == 'shared_file':
                         owner_username = validate_input(input("Enter the file owner's username: ").strip(), 'username', logger)
                         if not owner_username:
@@ -317,11 +701,11 @@ def main():
                         file_manager.download_shared_file(owner_username, filename, username)
                 except Exception as e:
                     print(f"Error during operation: {e}")
-                    logger.error(f"Error during operation: {e}")
+                    logger.error("Error during operation: %s", e)
 
             # If we break out of the loop, ensure the database connection is closed
-            if db_manager and db_manager.conn:
-                db_manager.conn.close()
+            if db_manager:
+                db_manager.close()
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
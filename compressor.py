@@ -0,0 +1,221 @@
+# compressor.py
+import os
+import lzma
+import struct
+import zlib
+from collections import namedtuple
+from itertools import accumulate
+from logger import get_logger
+
+try:
+    import zstandard
+except ImportError:  # optional dependency
+    zstandard = None
+
+# Bytes read from each sampled region of a file when choosing a codec
+SAMPLE_SIZE = 64 * 1024
+SAMPLE_COUNT = 4
+# Compress only when the sample shrinks below this fraction of its size
+MIN_RATIO = 0.9
+# Most bytes of output decompressing yields at once, however well the input compressed
+OUTPUT_SIZE = 1024 * 1024
+# Uncompressed bytes per independently compressed frame of a framed stream
+FRAME_SIZE = 1024 * 1024
+# Ends a framed stream, after one '<I' compressed size per frame: frame size, frame count
+FRAME_FOOTER = struct.Struct('<II')
+
+# Frame layout of a framed stream: offsets[i] is where frame i starts, offsets[-1] where the index does
+FrameIndex = namedtuple('FrameIndex', ['frame_size', 'offsets'])
+
+logger = get_logger('compress')
+
+def _zlib_compressor():
+    return zlib.compressobj(6)
+
+def _zlib_decompress(chunks):
+    decompressor = zlib.decompressobj()
+    for chunk in chunks:
+        while True:
+            data = decompressor.decompress(chunk, OUTPUT_SIZE)
+            if data:
+                yield data
+            chunk = decompressor.unconsumed_tail
+            if not chunk and len(data) < OUTPUT_SIZE:
+                break
+
+def _lzma_compressor():
+    return lzma.LZMACompressor(preset=6)
+
+def _lzma_decompress(chunks):
+    decompressor = lzma.LZMADecompressor()
+    for chunk in chunks:
+        data = decompressor.decompress(chunk, OUTPUT_SIZE)
+        while True:
+            if data:
+                yield data
+            if decompressor.needs_input or decompressor.eof:
+                break
+            data = decompressor.decompress(b'', OUTPUT_SIZE)
+
+def _zstd_compressor():
+    return zstandard.ZstdCompressor(level=3).compressobj()
+
+def _zstd_decompress(chunks):
+    reader = zstandard.ZstdDecompressor().stream_reader(_ChunkReader(chunks))
+    while True:
+        data = reader.read(OUTPUT_SIZE)
+        if not data:
+            break
+        yield data
+
+class _ChunkReader:
+    """File-like read() over an iterable of byte chunks."""
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buffer = b''
+
+    def read(self, size=-1):
+        while not self._buffer:
+            self._buffer = next(self._chunks, None)
+            if self._buffer is None:
+                self._buffer = b''
+                return b''
+        if size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+# Codec name -> (compressor factory, decompressing generator). The name is what
+# gets recorded in file metadata, so entries must never be renamed.
+CODECS = {
+    'zlib': (_zlib_compressor, _zlib_decompress),
+    'lzma': (_lzma_compressor, _lzma_decompress),
+}
+if zstandard is not None:
+    CODECS['zstd'] = (_zstd_compressor, _zstd_decompress)
+
+# Used by 'auto' for data that compresses well
+PREFERRED_CODEC = 'zstd' if 'zstd' in CODECS else 'zlib'
+
+def check_codec(codec):
+    """Raise if codec cannot be handled by this installation."""
+    if codec != 'none' and codec not in CODECS:
+        raise ValueError(f"Compression codec '{codec}' is not available.")
+
+def compresses_well(sample):
+    """Return True if a quick zlib pass shrinks sample below MIN_RATIO."""
+    if not sample:
+        return False
+    return len(zlib.compress(sample, 1)) < len(sample) * MIN_RATIO
+
+def choose_codec(source_path, mode='auto'):
+    """Pick the codec for a file; mode is 'auto', 'none' or a codec name, and 'auto' samples a few regions."""
+    if mode != 'auto':
+        check_codec(mode)
+        return mode
+    size = os.path.getsize(source_path)
+    with open(source_path, 'rb') as src:
+        samples = []
+        for i in range(SAMPLE_COUNT):
+            src.seek(max(0, size - SAMPLE_SIZE) * i // max(1, SAMPLE_COUNT - 1))
+            samples.append(src.read(SAMPLE_SIZE))
+    codec = PREFERRED_CODEC if compresses_well(b''.join(samples)) else 'none'
+    logger.debug("Chose codec '%s' for '%s'.", codec, source_path)
+    return codec
+
+def compress_chunks(chunks, codec):
+    """Compress an iterable of byte chunks as one stream."""
+    if codec == 'none':
+        yield from chunks
+        return
+    compressor = CODECS[codec][0]()
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    data = compressor.flush()
+    if data:
+        yield data
+
+def decompress_chunks(chunks, codec):
+    """Decompress an iterable of byte chunks produced by compress_chunks(), at most OUTPUT_SIZE bytes at a time."""
+    if codec == 'none':
+        yield from chunks
+        return
+    check_codec(codec)
+    yield from CODECS[codec][1](chunks)
+
+def compress(data, codec):
+    """Compress a single buffer."""
+    return b''.join(compress_chunks([data], codec))
+
+def decompress(data, codec, limit=None):
+    """Decompress a single buffer, raising ValueError if it inflates past limit bytes."""
+    output = bytearray()
+    for data in decompress_chunks([data], codec):
+        output += data
+        if limit is not None and len(output) > limit:
+            raise ValueError("Decompressed data is larger than expected.")
+    return bytes(output)
+
+def compress_frames(chunks, codec, frame_size=FRAME_SIZE):
+    """Compress an iterable of byte chunks as independent frames of frame_size bytes, followed by their index."""
+    check_codec(codec)
+    sizes, frame = [], bytearray()
+    for chunk in chunks:
+        frame += chunk
+        while len(frame) >= frame_size:
+            data = compress(bytes(frame[:frame_size]), codec)
+            del frame[:frame_size]
+            sizes.append(len(data))
+            yield data
+    if frame:
+        data = compress(bytes(frame), codec)
+        sizes.append(len(data))
+        yield data
+    yield struct.pack(f'<{len(sizes)}I', *sizes) + FRAME_FOOTER.pack(frame_size, len(sizes))
+
+def read_frame_index(read_at, size):
+    """Read the index of a framed stream of size bytes; read_at(offset, length) returns those bytes of it."""
+    if size < FRAME_FOOTER.size:
+        raise ValueError("Compressed frame index is truncated.")
+    frame_size, count = FRAME_FOOTER.unpack(read_at(size - FRAME_FOOTER.size, FRAME_FOOTER.size))
+    index_size = 4 * count + FRAME_FOOTER.size
+    if not frame_size or index_size > size:
+        raise ValueError("Compressed frame index is invalid.")
+    sizes = struct.unpack(f'<{count}I', read_at(size - index_size, 4 * count))
+    offsets = [0, *accumulate(sizes)]
+    if offsets[-1] != size - index_size:
+        raise ValueError("Compressed frame index does not match the stream size.")
+    return FrameIndex(frame_size, offsets)
+
+def decompress_frames(chunks, codec, index):
+    """Decompress the frames of a framed stream read as an iterable of byte chunks, ignoring the index."""
+    check_codec(codec)
+    frame_number, frame = 0, bytearray()
+    for chunk in chunks:
+        position = 0
+        while position < len(chunk) and frame_number < len(index.offsets) - 1:
+            wanted = index.offsets[frame_number + 1] - index.offsets[frame_number] - len(frame)
+            frame += chunk[position:position + wanted]
+            position += wanted
+            if len(frame) == index.offsets[frame_number + 1] - index.offsets[frame_number]:
+                yield from decompress_chunks([bytes(frame)], codec)
+                frame.clear()
+                frame_number += 1
+
+def read_frames(read_at, codec, index, offset, length):
+    """Return up to length uncompressed bytes from offset, reading and decompressing only the frames they span."""
+    first = offset // index.frame_size
+    last = min((offset + length - 1) // index.frame_size + 1, len(index.offsets) - 1)
+    if not length or first >= last:
+        return b''
+    data = read_at(index.offsets[first], index.offsets[last] - index.offsets[first])
+    output, position = bytearray(), first * index.frame_size
+    for number in range(first, last):
+        start, end = (index.offsets[i] - index.offsets[first] for i in (number, number + 1))
+        frame = decompress(data[start:end], codec, limit=index.frame_size)
+        output += frame[max(0, offset - position):offset + length - position]
+        position += len(frame)
+    return bytes(output)
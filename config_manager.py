@@ -1,43 +1,152 @@
 # config_manager.py
+import contextlib
+import getpass
 import json
 import os
-import logging
+import tempfile
+from logger import get_logger
+
+def current_os_user():
+    """Name of the OS account running this process, which cached GitHub sessions are kept under."""
+    try:
+        return getpass.getuser()
+    except Exception:
+        return str(os.getuid()) if hasattr(os, 'getuid') else 'default'
 
 class ConfigManager:
     CONFIG_FILE = 'config.json'
 
+    # Parsed config per absolute path, with the stamp it was read at, shared by
+    # every ConfigManager in the process so the file is read and parsed only once
+    _loaded = {}
+
     def __init__(self, logger=None):
-        self.logger = logger or logging.getLogger("SecureFileStorage")
+        self.logger = get_logger('config', logger)
         self.config = {}
+        self._stamp_loaded = None
+        self._batch_depth = 0
+        self._dirty = False
         if os.path.exists(self.CONFIG_FILE):
             self.load_config()
 
     def load_config(self):
-        """Load configuration from the config file."""
+        """Load configuration from the config file, unless this process already parsed it unchanged."""
         try:
+            path = os.path.abspath(self.CONFIG_FILE)
+            stamp = self._stamp(path)
+            cached = self._loaded.get(path)
+            if cached and cached[0] == stamp:
+                self.config = dict(cached[1])
+                self._stamp_loaded = stamp
+                return
             with open(self.CONFIG_FILE, 'r') as file:
                 self.config = json.load(file)
+            self._stamp_loaded = stamp
+            self._loaded[path] = (stamp, dict(self.config))
             self.logger.info("Configuration file loaded successfully.")
         except Exception as e:
-            self.logger.error(f"Error loading configuration file: {e}")
+            self.logger.error("Error loading configuration file: %s", e)
             raise
 
+    def refresh(self):
+        """Reload the configuration if the file was rewritten since it was loaded, e.g. by another process."""
+        if self._batch_depth:
+            return  # Keep pending changes; the batch writes them out as a whole
+        try:
+            stamp = self._stamp(os.path.abspath(self.CONFIG_FILE))
+        except FileNotFoundError:
+            return
+        if stamp != self._stamp_loaded:
+            self.load_config()
+
     def save_config(self):
-        """Save configuration to the config file."""
+        """
+        Atomically replace the config file via a fsynced temp file; inside batch() the write is deferred.
+        """
+        if self._batch_depth:
+            self._dirty = True
+            return
         try:
-            with open(self.CONFIG_FILE, 'w') as file:
-                json.dump(self.config, file, indent=4)
+            path = os.path.abspath(self.CONFIG_FILE)
+            directory = os.path.dirname(path)
+            fd, temp_path = tempfile.mkstemp(prefix='.config.', suffix='.tmp', dir=directory)
+            try:
+                with os.fdopen(fd, 'w') as file:
+                    json.dump(self.config, file, indent=4)
+                    file.flush()
+                    os.fsync(file.fileno())
+                os.replace(temp_path, path)
+            except BaseException:
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(temp_path)
+                raise
+            self._fsync_directory(directory)
+            self._stamp_loaded = self._stamp(path)
+            self._loaded[path] = (self._stamp_loaded, dict(self.config))
             self.logger.info("Configuration file saved successfully.")
         except Exception as e:
-            self.logger.error(f"Error saving configuration file: {e}")
+            self.logger.error("Error saving configuration file: %s", e)
             raise
 
+    @contextlib.contextmanager
+    def batch(self):
+        """
+        Group several setter calls into a single write of the config file.
+
+        Nested batches join the outermost one; if the block raises, its changes are rolled back unwritten.
+        """
+        if self._batch_depth:
+            yield self
+            return
+        self.refresh()
+        snapshot = dict(self.config)
+        self._batch_depth = 1
+        try:
+            yield self
+        except BaseException:
+            self.config = snapshot
+            raise
+        finally:
+            self._batch_depth = 0
+            dirty, self._dirty = self._dirty, False
+        if dirty:
+            self.save_config()
+
+    def get(self, key, default=None):
+        """Retrieve a configuration value, reloading the file first if it changed on disk."""
+        self.refresh()
+        return self.config.get(key, default)
+
+    def set(self, key, value):
+        """Store a configuration value and save the configuration."""
+        self.refresh()
+        self.config[key] = value
+        self.save_config()
+
+    @staticmethod
+    def _stamp(path):
+        # The inode changes on every atomic replace, even within the mtime granularity
+        stat = os.stat(path)
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    @staticmethod
+    def _fsync_directory(directory):
+        """Persist the rename itself; directories cannot be opened for fsync on Windows."""
+        if not hasattr(os, 'O_DIRECTORY'):
+            return
+        fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
     def get_client_id(self):
         """Retrieve the GitHub client ID from the configuration."""
-        return self.config.get('client_id')
+        return self.get('client_id')
 
     def get_registration_complete(self):
         """Check if registration is complete."""
+        self.refresh()
         if (self.config.get('client_id') and
             self.config.get('encrypted_client_secret') and
         self.config.get('storage_path') and
@@ -50,36 +159,82 @@ class ConfigManager:
 
     def set_client_id(self, client_id):
         """Store the GitHub client ID in the configuration."""
-        self.config['client_id'] = client_id
-        self.save_config()
+        self.set('client_id', client_id)
 
     def get_encrypted_client_secret(self):
         """Retrieve the encrypted GitHub client secret from the configuration."""
-        return self.config.get('encrypted_client_secret')
+        return self.get('encrypted_client_secret')
 
     def set_encrypted_client_secret(self, encrypted_secret):
         """Store the encrypted GitHub client secret in the configuration."""
-        self.config['encrypted_client_secret'] = encrypted_secret
-        self.save_config()
+        self.set('encrypted_client_secret', encrypted_secret)
 
     def get_salt(self):
         """Retrieve the salt from the configuration."""
-        return self.config.get('salt')
+        return self.get('salt')
 
     def set_salt(self, salt):
         """Store the salt in the configuration."""
-        self.config['salt'] = salt
-        self.save_config()
+        self.set('salt', salt)
     def get_storage_path(self):
         """Retrieve the storage path from the configuration."""
-        return self.config.get('storage_path')
+        return self.get('storage_path')
 
     def set_storage_path(self, storage_path):
         """Store the storage path in the configuration."""
-        self.config['storage_path'] = storage_path
-        self.save_config()
+        self.set('storage_path', storage_path)
     def set_registration_complete(self, registration_complete):
         """Store the registration complete status in the configuration."""
-        self.config['registration_complete'] = registration_complete
-        self.save_config()
+        self.set('registration_complete', registration_complete)
+
+
+    def get_storage_backend(self):
+        """Retrieve the storage backend for new uploads: 'file' or 'blocks'."""
+        return self.get('storage_backend', 'file')
+
+    def set_storage_backend(self, storage_backend):
+        """Store the storage backend for new uploads in the configuration."""
+        if storage_backend not in ('file', 'blocks'):
+            raise ValueError(f"Unknown storage backend '{storage_backend}'.")
+        self.set('storage_backend', storage_backend)
+
+    def get_compression(self):
+        """Retrieve the compression mode for new uploads: 'auto', 'none' or a codec name."""
+        return self.get('compression', 'auto')
+
+    def set_compression(self, compression):
+        """Store the compression mode for new uploads in the configuration."""
+        self.set('compression', compression)
+
+    def get_delta_uploads(self):
+        """Retrieve whether new versions of files are stored as deltas against the previous version."""
+        return self.get('delta_uploads', False)
+
+    def set_delta_uploads(self, delta_uploads):
+        """Store whether new versions of files are stored as deltas in the configuration."""
+        self.set('delta_uploads', bool(delta_uploads))
+
+    def get_github_session(self, os_user=None):
+        """Retrieve the encrypted cached GitHub session of an OS user, by default the current one."""
+        return self.get('github_sessions', {}).get(os_user or current_os_user())
+
+    def set_github_session(self, encrypted_session, os_user=None):
+        """Store the encrypted cached GitHub session of an OS user in the configuration."""
+        sessions = dict(self.get('github_sessions', {}))
+        sessions[os_user or current_os_user()] = encrypted_session
+        self.config.pop('github_session', None)
+        self.set('github_sessions', sessions)
+
+    def clear_github_session(self, os_user=None):
+        """Forget the cached GitHub session of an OS user, and any session cached before they were kept per user."""
+        self.refresh()
+        sessions = dict(self.config.get('github_sessions', {}))
+        cleared = sessions.pop(os_user or current_os_user(), None) is not None
+        cleared |= self.config.pop('github_session', None) is not None
+        if cleared:
+            self.config['github_sessions'] = sessions
+            self.save_config()
 
+    def get_session_ttl(self):
+        """Retrieve how many seconds a validated GitHub session is trusted without revalidation."""
+        return self.get('session_ttl', 3600)
@@ -1,268 +1,1353 @@
 # db_manager.py
 from pysqlcipher3 import dbapi2 as sqlite
-import logging
-import base64
+from logger import get_logger
+import hashlib
+import os
+import time
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+# Grantees of a file as a comma-joined string, as the old shared_user column held.
+SHARED_USERS = "(SELECT group_concat(grantee, ',') FROM file_shares WHERE file_id = files.id)"
+
+# Columns returned for a file row. FileManager indexes these positionally,
+# so the order matches the original per-user files table.
+FILE_COLUMNS = (f"id, file_name, encrypted_path, key_id, uploaded_at, download_date, delete_date, {SHARED_USERS}, "
+                "storage, codec, version, data_key_id")
+
+# A file's current version: not deleted and not replaced by a newer upload.
+CURRENT_FILE = "delete_date IS NULL AND superseded_at IS NULL"
+
+# Returned by MetadataCache.get() on a miss, since None is a cacheable result
+MISSING = object()
+
+# SQLCipher's KDF per major version, for libraries that do not report their defaults
+KDF_DEFAULTS = {'3': ('PBKDF2_HMAC_SHA1', 64000), '4': ('PBKDF2_HMAC_SHA512', 256000)}
+KDF_SALT_SIZE = 16
+
+class MetadataCache:
+    """Session-scoped, bounded LRU cache of lookup results, grouped by what a mutator invalidates at once.
+
+    put() drops results whose lookup started before the last invalidation of their group.
+    """
+
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._groups = {}
+        self._lock = threading.Lock()
+
+    def get(self, group, subkey):
+        """Return the cached value, or MISSING."""
+        with self._lock:
+            value = self._entries.get((group, subkey), MISSING)
+            if value is MISSING:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._entries.move_to_end((group, subkey))
+            return value
+
+    def put(self, group, subkey, value, generation):
+        """Cache a value looked up in generation, evicting the least recently used entries if full."""
+        with self._lock:
+            if generation != self.generation or not self.max_entries:
+                return
+            self._entries[(group, subkey)] = value
+            self._entries.move_to_end((group, subkey))
+            self._groups.setdefault(group, set()).add(subkey)
+            while len(self._entries) > self.max_entries:
+                (evicted_group, evicted_subkey), _ = self._entries.popitem(last=False)
+                subkeys = self._groups[evicted_group]
+                subkeys.discard(evicted_subkey)
+                if not subkeys:
+                    del self._groups[evicted_group]
+
+    def invalidate(self, group):
+        """Drop every entry of a group."""
+        with self._lock:
+            self.generation += 1
+            for subkey in self._groups.pop(group, ()):
+                del self._entries[(group, subkey)]
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+            self._groups.clear()
+
+class ConnectionPool:
+    """SQLCipher connections for one database: a shared writer behind write_lock and one reader per thread.
+
+    The master password is stretched once, here, and every connection is keyed with the raw key.
+    cipher_page_size and kdf_iter must match the database, so they are only applied when given.
+    """
+
+    def __init__(self, db_path, master_password, logger=None, cipher_page_size=None, kdf_iter=None,
+                 cache_size=-16000):
+        self.db_path = db_path
+        self.logger = get_logger('db', logger)
+        self.cipher_page_size = cipher_page_size
+        self.kdf_iter = kdf_iter
+        self.cache_size = cache_size
+        self.write_lock = threading.RLock()
+        self._raw_key = self._derive_key(master_password)
+        self._writer = None
+        self._local = threading.local()
+        self._readers = []
+        self._readers_lock = threading.Lock()
+
+    def _derive_key(self, master_password):
+        """Run SQLCipher's passphrase KDF in Python, returning the raw key followed by the database's salt."""
+        conn = sqlite.connect(self.db_path)
+        try:
+            def pragma(name):
+                row = conn.execute(f"PRAGMA {name}").fetchone()
+                return row[0] if row else None
+            algorithm, iterations = KDF_DEFAULTS['3' if str(pragma('cipher_version')).startswith('3') else '4']
+            algorithm = pragma('cipher_default_kdf_algorithm') or algorithm
+            iterations = self.kdf_iter or int(pragma('cipher_default_kdf_iter') or iterations)
+        finally:
+            conn.close()
+        # A new database takes the salt its key is given with
+        salt = b''
+        if os.path.exists(self.db_path):
+            with open(self.db_path, 'rb') as f:
+                salt = f.read(KDF_SALT_SIZE)
+        if len(salt) < KDF_SALT_SIZE:
+            salt = os.urandom(KDF_SALT_SIZE)
+        key = hashlib.pbkdf2_hmac(algorithm.rsplit('_', 1)[1].lower(), master_password.encode(), salt, iterations, 32)
+        return bytearray(key + salt)
+
+    def _open(self, read_only):
+        """Open and unlock a connection with the raw key, applying the tuning pragmas."""
+        conn = sqlite.connect(self.db_path, check_same_thread=False, isolation_level=None)
+        try:
+            conn.execute(f"PRAGMA key = \"x'{self._raw_key.hex()}'\"")
+            if self.cipher_page_size:
+                conn.execute(f"PRAGMA cipher_page_size = {int(self.cipher_page_size)}")
+            # Verify the key
+            conn.execute("SELECT count(*) FROM sqlite_master")
+            if self.cache_size:
+                conn.execute(f"PRAGMA cache_size = {int(self.cache_size)}")
+            if read_only:
+                conn.execute("PRAGMA query_only = ON")
+        except Exception:
+            conn.close()
+            raise
+        return conn
+
+    def writer(self):
+        """Return the shared writer connection; hold write_lock while using it."""
+        with self.write_lock:
+            if self._writer is None:
+                self._writer = self._open(read_only=False)
+            return self._writer
+
+    def reader(self):
+        """Return this thread's read-only connection, opening it on first use."""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._open(read_only=True)
+            self._local.conn = conn
+            with self._readers_lock:
+                self._readers.append(conn)
+        return conn
+
+    def close(self):
+        """Close every connection handed out by the pool."""
+        with self.write_lock:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+        with self._readers_lock:
+            for conn in self._readers:
+                conn.close()
+            self._readers.clear()
+        self._local = threading.local()
+        self._raw_key[:] = bytes(len(self._raw_key))
+        self.logger.info("Database connection pool closed.")
 
 class SQLiteManager:
-    def __init__(self, db_path, logger=None):
+    # Ordered schema migrations; PRAGMA user_version records how many have run.
+    MIGRATIONS = [
+        '_migrate_consolidated_schema',
+        '_migrate_file_shares',
+        '_migrate_block_store',
+        '_migrate_compression',
+        '_migrate_file_versions',
+        '_migrate_envelope_keys',
+        '_migrate_job_checkpoints',
+        '_migrate_file_path_index',
+        '_migrate_retired_files',
+        '_migrate_deleted_file_keys',
+    ]
+
+    def __init__(self, db_path, logger=None, journal_mode='WAL', defer_commits=False,
+                 flush_threshold=256, flush_interval=5.0, read_only_connections=True,
+                 cipher_page_size=None, kdf_iter=None, cache_size=-16000, metadata_cache_size=1024):
+        """
+        :param journal_mode: SQLite journal mode applied on connect (WAL by default)
+        :param defer_commits: coalesce commits from individual mutators until a flush threshold is hit
+        :param flush_threshold: number of pending writes that triggers a flush
+        :param flush_interval: seconds after the first pending write that trigger a flush, even when idle
+        :param read_only_connections: serve lookups from per-thread read-only connections
+        :param cipher_page_size: SQLCipher page size; must match the database if set
+        :param kdf_iter: SQLCipher KDF iterations; must match the database if set
+        :param cache_size: SQLite page cache size per connection (negative values are KiB)
+        :param metadata_cache_size: key rows, users and file rows kept in the session's lookup cache; 0 disables it
+        """
         self.db_path = db_path
-        self.logger = logger or logging.getLogger("SecureFileStorage")
+        self.logger = get_logger('db', logger)
         self.conn = None
+        self.pool = None
+        self.journal_mode = journal_mode
+        self.defer_commits = defer_commits
+        self.flush_threshold = flush_threshold
+        self.flush_interval = flush_interval
+        self.read_only_connections = read_only_connections
+        self.pool_options = {'cipher_page_size': cipher_page_size, 'kdf_iter': kdf_iter, 'cache_size': cache_size}
+        self._in_transaction = False
+        self._transaction_depth = 0
+        self._transaction_owner = None
+        self._pending_commits = 0
+        self._pending_downloads = {}
+        self._pending_since = None
+        self._flush_timer = None
+        self.cache = MetadataCache(metadata_cache_size)
+        # Cache groups invalidated by the open transaction, invalidated again once it ends
+        self._dirty = set()
 
     def connect(self, master_password):
-        """Connect to the SQLCipher database using the master password."""
+        """Unlock the SQLCipher database once and open the session's connection pool."""
+        if self.conn is not None:
+            return
         try:
-            self.conn = sqlite.connect(self.db_path)
-            self.conn.execute(f"PRAGMA key = '{master_password}'")
-            # Verify the key
-            self.conn.execute("SELECT count(*) FROM sqlite_master")
+            self.pool = ConnectionPool(self.db_path, master_password, self.logger, **self.pool_options)
+            self.conn = self.pool.writer()
+            if self.journal_mode:
+                self.conn.execute(f"PRAGMA journal_mode = {self.journal_mode}")
+                if self.journal_mode.upper() == 'WAL':
+                    # WAL only needs an fsync at checkpoints with synchronous=NORMAL
+                    self.conn.execute("PRAGMA synchronous = NORMAL")
             self.logger.info("Connected to SQLCipher database successfully.")
+            self.migrate()
         except sqlite.DatabaseError as e:
-            self.logger.error(f"Failed to connect to SQLCipher database: {e}")
+            self.logger.error("Failed to connect to SQLCipher database: %s", e)
+            self._close_pool()
+            raise
+        except Exception as e:
+            self.logger.error("Unexpected error connecting to database: %s", e)
+            self._close_pool()
             raise
+
+    def close(self):
+        """Flush any coalesced writes and close every pooled connection."""
+        if self.conn is None:
+            return
+        self._cancel_flush_timer()
+        try:
+            self.flush()
+        finally:
+            self._close_pool()
+
+    def _close_pool(self):
+        if self.pool is not None:
+            self.pool.close()
+        self.pool = None
+        self.conn = None
+        self._in_transaction = False
+        self.cache.clear()
+
+    @contextmanager
+    def _reading(self):
+        """Yield a cursor for a lookup.
+
+        Lookups use this thread's read-only connection unless they must see
+        writes that are not committed yet: inside this thread's transaction,
+        or while deferred commits are pending.
+        """
+        if (self.read_only_connections and self._transaction_owner != threading.get_ident()
+                and not self._in_transaction):
+            yield self.pool.reader().cursor()
+        else:
+            with self.pool.write_lock:
+                yield self.conn.cursor()
+
+    def _begin(self):
+        if not self._in_transaction:
+            self.conn.execute("BEGIN")
+            self._in_transaction = True
+
+    def _end(self, statement):
+        if self._in_transaction:
+            self._in_transaction = False
+            self.conn.execute(statement)
+            # A reader may have cached a row the transaction changed between
+            # its invalidation and the commit; drop such rows again now
+            for group in self._dirty:
+                self.cache.invalidate(group)
+            self._dirty.clear()
+
+    def _invalidate(self, *group):
+        """Drop cached lookups a mutation makes stale."""
+        self.cache.invalidate(group)
+        if self._in_transaction:
+            self._dirty.add(group)
+
+    def _cached(self, group, subkey, load):
+        """Return a cached lookup, calling load() and caching its result on a miss."""
+        value = self.cache.get(group, subkey)
+        if value is MISSING:
+            generation = self.cache.generation
+            value = load()
+            self.cache.put(group, subkey, value, generation)
+        return value
+
+    @contextmanager
+    def transaction(self):
+        """Group the mutations made inside the block into a single commit, holding the writer lock throughout.
+
+        Transactions nest; only the outermost block commits or rolls back.
+        """
+        with self.pool.write_lock:
+            outermost = self._transaction_depth == 0
+            if outermost:
+                self._begin()
+                self.conn.execute("SAVEPOINT block")
+                self._transaction_owner = threading.get_ident()
+            self._transaction_depth += 1
+            try:
+                yield self
+            except Exception:
+                self._transaction_depth -= 1
+                if outermost:
+                    self._transaction_owner = None
+                    self.conn.execute("ROLLBACK TO block")
+                    self.conn.execute("RELEASE block")
+                    # Lookups inside the block may have cached rows that no longer exist
+                    self.cache.clear()
+                    if not self._pending_commits:
+                        self._end("ROLLBACK")
+                raise
+            self._transaction_depth -= 1
+            if outermost:
+                self._transaction_owner = None
+                self.conn.execute("RELEASE block")
+                self._commit()
+
+    def _commit(self):
+        """Commit the finished block now, or leave it for the next flush in deferred mode."""
+        if not self.defer_commits:
+            self._end("COMMIT")
+        else:
+            self._pending_commits += 1
+        # Download dates recorded inside the block are pending either way
+        self._maybe_flush()
+
+    def _maybe_flush(self):
+        """Flush coalesced writes once the size or time threshold is reached."""
+        pending = self._pending_commits + len(self._pending_downloads)
+        if not pending:
+            return
+        if self._pending_since is None:
+            self._pending_since = time.monotonic()
+            # An idle session gets no further write to check the time on
+            self._flush_timer = threading.Timer(self.flush_interval, self._flush_on_timer)
+            self._flush_timer.daemon = True
+            self._flush_timer.start()
+        if pending >= self.flush_threshold or time.monotonic() - self._pending_since >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """Write coalesced download dates and commit everything pending."""
+        with self.pool.write_lock:
+            if self._transaction_depth:
+                return
+            try:
+                if self._pending_downloads:
+                    self._begin()
+                    cursor = self.conn.cursor()
+                    cursor.executemany(f'''
+                        UPDATE files
+                        SET download_date = ?
+                        WHERE owner = ? AND file_name = ? AND {CURRENT_FILE}
+                    ''', [(downloaded_at, owner, file_name)
+                          for (owner, file_name, file_id), downloaded_at in self._pending_downloads.items()
+                          if file_id is None])
+                    cursor.executemany('''
+                        UPDATE files
+                        SET download_date = ?
+                        WHERE owner = ? AND file_name = ? AND id = ?
+                    ''', [(downloaded_at, *key)
+                          for key, downloaded_at in self._pending_downloads.items() if key[2] is not None])
+                    for owner, file_name, _ in self._pending_downloads:
+                        self._invalidate('file', owner, file_name)
+                if self._in_transaction:
+                    self._end("COMMIT")
+                    self.logger.info("Flushed %s download dates and %s deferred commits.",
+                                     len(self._pending_downloads), self._pending_commits)
+                self._pending_downloads.clear()
+                self._pending_commits = 0
+                self._pending_since = None
+                self._cancel_flush_timer()
+            except Exception as e:
+                self.logger.error("Error flushing pending writes: %s", e)
+                raise
+
+    def _flush_on_timer(self):
+        """Flush writes still pending flush_interval seconds after the first one."""
+        pool = self.pool
+        if pool is None:
+            return
+        with pool.write_lock:
+            if self.pool is not pool or self._pending_since is None:
+                return
+            try:
+                self.flush()
+            except Exception:
+                # Logged by flush(); the writes stay pending for the next flush
+                pass
+
+    def _cancel_flush_timer(self):
+        if self._flush_timer is not None:
+            self._flush_timer.cancel()
+            self._flush_timer = None
+
+    def migrate(self):
+        """Apply any pending schema migrations, each in its own transaction."""
+        cursor = self.conn.cursor()
+        current_version = cursor.execute("PRAGMA user_version").fetchone()[0]
+        pending = self.MIGRATIONS[current_version:]
+        if not pending:
+            return
+
+        # The writer is in autocommit mode, so DDL only commits with the explicit COMMIT
+        try:
+            for version, migration in enumerate(pending, start=current_version + 1):
+                cursor.execute("BEGIN")
+                try:
+                    getattr(self, migration)(cursor)
+                    cursor.execute(f"PRAGMA user_version = {version}")
+                    cursor.execute("COMMIT")
+                except Exception:
+                    cursor.execute("ROLLBACK")
+                    raise
+                self.logger.info("Database schema migrated to version %s (%s).", version, migration)
         except Exception as e:
-            self.logger.error(f"Unexpected error connecting to database: {e}")
+            self.logger.error("Error migrating database schema: %s", e)
             raise
 
+    def _migrate_consolidated_schema(self, cursor):
+        """Version 1: replace per-user {username}_keys/_files tables with shared, indexed tables."""
+        # Registration used to create an unused users table with a different layout
+        legacy_users = []
+        columns = [row[1] for row in cursor.execute("PRAGMA table_info(users)").fetchall()]
+        if columns and 'created_at' not in columns:
+            legacy_users = [row[0] for row in cursor.execute("SELECT username FROM users").fetchall()]
+            cursor.execute("DROP TABLE users")
+
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS users (
+                username TEXT PRIMARY KEY,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS keys (
+                id INTEGER PRIMARY KEY,
+                owner TEXT NOT NULL REFERENCES users(username),
+                aes_key TEXT NOT NULL,
+                salt TEXT NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS files (
+                id INTEGER PRIMARY KEY,
+                owner TEXT NOT NULL REFERENCES users(username),
+                file_name TEXT NOT NULL,
+                encrypted_path TEXT NOT NULL,
+                key_id INTEGER REFERENCES keys(id),
+                uploaded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                download_date TIMESTAMP,
+                delete_date TIMESTAMP,
+                shared_user TEXT
+            )
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_keys_owner_created ON keys (owner, created_at)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_files_owner_name_deleted ON files (owner, file_name, delete_date)")
+
+        cursor.executemany("INSERT OR IGNORE INTO users (username) VALUES (?)", [(user,) for user in legacy_users])
+
+        # Move every legacy per-user table pair into the shared tables
+        legacy_tables = [row[0] for row in cursor.execute(
+            "SELECT name FROM sqlite_master WHERE type='table' AND name LIKE '%\\_files' ESCAPE '\\'").fetchall()]
+        for files_table in legacy_tables:
+            username = files_table[:-len('_files')]
+            keys_table = f"{username}_keys"
+            cursor.execute("INSERT OR IGNORE INTO users (username) VALUES (?)", (username,))
+
+            key_ids = {}
+            has_keys = cursor.execute(
+                "SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (keys_table,)).fetchone()
+            if has_keys:
+                for old_id, aes_key, salt, created_at in cursor.execute(
+                        f'SELECT id, aes_key, salt, created_at FROM "{keys_table}" ORDER BY id').fetchall():
+                    cursor.execute(
+                        "INSERT INTO keys (owner, aes_key, salt, created_at) VALUES (?, ?, ?, ?)",
+                        (username, aes_key, salt, created_at))
+                    key_ids[old_id] = cursor.lastrowid
+
+            rows = cursor.execute(f'''
+                SELECT file_name, encrypted_path, key_id, uploaded_at, download_date, delete_date, shared_user
+                FROM "{files_table}" ORDER BY id
+            ''').fetchall()
+            cursor.executemany('''
+                INSERT INTO files (owner, file_name, encrypted_path, key_id, uploaded_at,
+                                   download_date, delete_date, shared_user)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ''', [(username, row[0], row[1], key_ids.get(row[2]), *row[3:]) for row in rows])
+
+            cursor.execute(f'DROP TABLE "{files_table}"')
+            if has_keys:
+                cursor.execute(f'DROP TABLE "{keys_table}"')
+            self.logger.info("Migrated legacy tables for %s (%s keys, %s files).", username, len(key_ids), len(rows))
+
+    def _migrate_file_shares(self, cursor):
+        """Version 2: move the comma-joined files.shared_user column into a file_shares table."""
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS file_shares (
+                file_id INTEGER NOT NULL REFERENCES files(id),
+                grantee TEXT NOT NULL,
+                PRIMARY KEY (file_id, grantee)
+            )
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_file_shares_grantee ON file_shares (grantee)")
+
+        grants = []
+        for file_id, shared_user in cursor.execute(
+                "SELECT id, shared_user FROM files WHERE shared_user IS NOT NULL AND shared_user != ''").fetchall():
+            grants.extend((file_id, grantee.strip()) for grantee in shared_user.split(',') if grantee.strip())
+        cursor.executemany("INSERT OR IGNORE INTO file_shares (file_id, grantee) VALUES (?, ?)", grants)
+        cursor.execute("UPDATE files SET shared_user = NULL")
+        self.logger.info("Moved %s share grants into file_shares.", len(grants))
+
+    def _migrate_block_store(self, cursor):
+        """Version 3: add reference-counted blocks and chunk manifests for deduplicated files."""
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS blocks (
+                address TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                refcount INTEGER NOT NULL DEFAULT 0
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS file_chunks (
+                file_id INTEGER NOT NULL REFERENCES files(id),
+                seq INTEGER NOT NULL,
+                address TEXT NOT NULL REFERENCES blocks(address),
+                length INTEGER NOT NULL,
+                PRIMARY KEY (file_id, seq)
+            )
+        ''')
+        # 'file' rows point at a .enc file; 'blocks' rows are assembled from file_chunks
+        cursor.execute("ALTER TABLE files ADD COLUMN storage TEXT NOT NULL DEFAULT 'file'")
+
+    def _migrate_compression(self, cursor):
+        """Version 4: record the compression codec of each file and block; existing data is uncompressed."""
+        cursor.execute("ALTER TABLE files ADD COLUMN codec TEXT NOT NULL DEFAULT 'none'")
+        cursor.execute("ALTER TABLE blocks ADD COLUMN codec TEXT NOT NULL DEFAULT 'none'")
+
+    def _migrate_file_versions(self, cursor):
+        """Version 5: chain re-uploads of a file name into numbered versions instead of duplicate live rows."""
+        cursor.execute("ALTER TABLE files ADD COLUMN version INTEGER NOT NULL DEFAULT 1")
+        cursor.execute("ALTER TABLE files ADD COLUMN previous_version_id INTEGER REFERENCES files(id)")
+        cursor.execute("ALTER TABLE files ADD COLUMN superseded_at TIMESTAMP")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_files_previous_version ON files (previous_version_id)")
+
+        # Earlier re-uploads left several live rows per name; the newest one becomes current
+        chains = {}
+        for file_id, owner, file_name in cursor.execute(
+                "SELECT id, owner, file_name FROM files WHERE delete_date IS NULL ORDER BY id").fetchall():
+            chains.setdefault((owner, file_name), []).append(file_id)
+        updates = []
+        for file_ids in chains.values():
+            for version, file_id in enumerate(file_ids[1:], start=2):
+                updates.append((version, file_ids[version - 2], file_id))
+        cursor.executemany("UPDATE files SET version = ?, previous_version_id = ? WHERE id = ?", updates)
+        cursor.executemany("UPDATE files SET superseded_at = CURRENT_TIMESTAMP WHERE id = ?",
+                           [(file_id,) for file_ids in chains.values() for file_id in file_ids[:-1]])
+        self.logger.info("Chained %s re-uploaded files into versions.", len(updates))
+
+    def _migrate_envelope_keys(self, cursor):
+        """Version 6: per-file data keys wrapped by the user's key, so rotating it only re-wraps these rows."""
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS data_keys (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                owner TEXT NOT NULL REFERENCES users(username),
+                kek_id INTEGER NOT NULL REFERENCES keys(id),
+                purpose TEXT NOT NULL DEFAULT 'file',
+                wrapped_key BLOB NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_data_keys_owner_purpose ON data_keys (owner, purpose)")
+        # NULL for files encrypted directly with a key from the keys table
+        cursor.execute("ALTER TABLE files ADD COLUMN data_key_id INTEGER REFERENCES data_keys(id)")
+
+    def _migrate_job_checkpoints(self, cursor):
+        """Version 7: progress of resumable background jobs over the files table."""
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS job_checkpoints (
+                job TEXT PRIMARY KEY,
+                position INTEGER NOT NULL DEFAULT 0,
+                processed INTEGER NOT NULL DEFAULT 0,
+                failed INTEGER NOT NULL DEFAULT 0,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+
+    def _migrate_file_path_index(self, cursor):
+        """Version 8: look up rows by encrypted_path; versions uploaded before version 5 can share one .enc file."""
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_files_encrypted_path ON files (encrypted_path)")
+
+    def _migrate_retired_files(self, cursor):
+        """Version 9: files and data keys a background job has replaced, until they are safe to delete."""
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS retired_files (
+                id INTEGER PRIMARY KEY,
+                job TEXT NOT NULL,
+                file_id INTEGER NOT NULL,
+                encrypted_path TEXT NOT NULL,
+                data_key_id INTEGER,
+                retired_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_retired_files_job ON retired_files (job, file_id)")
+
+    def _migrate_deleted_file_keys(self, cursor):
+        """Version 10: delete the data keys of deleted files, which deletion used to keep."""
+        cursor.execute('''
+            DELETE FROM data_keys WHERE purpose = 'file'
+            AND id NOT IN (SELECT data_key_id FROM files WHERE delete_date IS NULL AND data_key_id IS NOT NULL)
+            AND id NOT IN (SELECT data_key_id FROM retired_files WHERE data_key_id IS NOT NULL)
+        ''')
+
     def initialize_user_tables(self, username):
-        """Create tables for storing user keys and file metadata if they don't exist."""
-        try:
-            cursor = self.conn.cursor()
-
-            # Create the key management table
-            cursor.execute(f'''
-                CREATE TABLE IF NOT EXISTS {username}_keys (
-                    id INTEGER PRIMARY KEY,
-                    aes_key TEXT NOT NULL,
-                    salt TEXT NOT NULL,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
-
-            # Create the file metadata table
-            cursor.execute(f'''
-                CREATE TABLE IF NOT EXISTS {username}_files (
-                    id INTEGER PRIMARY KEY,
-                    file_name TEXT NOT NULL,
-                    encrypted_path TEXT NOT NULL,
-                    key_id INTEGER,
-                    uploaded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    download_date TIMESTAMP,
-                    delete_date TIMESTAMP,
-                    shared_user TEXT,
-                    FOREIGN KEY (key_id) REFERENCES {username}_keys(id)
-                )
-            ''')
-
-            self.conn.commit()
-            self.logger.info(f"User tables created for {username}.")
-        except Exception as e:
-            self.logger.error(f"Error initializing user tables: {e}")
+        """Register the user so their keys and file metadata can be stored."""
+        if self.cache.get(('user', username), None) is True:
+            return
+        try:
+            generation = self.cache.generation
+            with self.transaction():
+                cursor = self.conn.cursor()
+                cursor.execute("INSERT OR IGNORE INTO users (username) VALUES (?)", (username,))
+            self.cache.put(('user', username), None, True, generation)
+            self.logger.info("User %s initialized.", username)
+        except Exception as e:
+            self.logger.error("Error initializing user tables: %s", e)
             raise
 
     def insert_user_key_and_salt(self, username, aes_key, salt):
         """Insert a user's AES key and salt into the database."""
         try:
-            cursor = self.conn.cursor()
-            cursor.execute(f'''
-                INSERT INTO {username}_keys (aes_key, salt)
-                VALUES (?, ?)
-            ''', (aes_key, salt))
-            self.conn.commit()
-            self.logger.info(f"User AES key and salt inserted for {username}.")
+            with self.transaction():
+                cursor = self.conn.cursor()
+                cursor.execute('''
+                    INSERT INTO keys (owner, aes_key, salt)
+                    VALUES (?, ?, ?)
+                ''', (username, aes_key, salt))
+                self._invalidate('key', username)
+            self.logger.info("User AES key and salt inserted for %s.", username)
         except Exception as e:
-            self.logger.error(f"Error inserting AES key and salt for {username}: {e}")
+            self.logger.error("Error inserting AES key and salt for %s: %s", username, e)
             raise
 
-    def get_user_key_and_salt(self, username):
-        """Retrieve the AES key and salt for a specific user."""
+    def get_user_key(self, username, key_id=None):
+        """Retrieve (key_id, aes_key, salt) for one of a user's keys, or their newest key if key_id is None.
+
+        Returns (None, None, None) if there is no such key. Key rows are
+        served from the session cache after the first lookup.
+        """
         try:
-            cursor = self.conn.cursor()
-            cursor.execute(f'''
-                SELECT aes_key, salt FROM {username}_keys ORDER BY created_at DESC LIMIT 1
-            ''')
-            result = cursor.fetchone()
-            if result:
-                return result[0], result[1]  # Return the AES key and salt
-            return None, None
+            return self._cached(('key', username), key_id, lambda: self._load_user_key(username, key_id))
         except Exception as e:
-            self.logger.error(f"Error retrieving AES key and salt for {username}: {e}")
+            self.logger.error("Error retrieving AES key %s for %s: %s", key_id, username, e)
             raise
 
+    def _load_user_key(self, username, key_id):
+        with self._reading() as cursor:
+            if key_id is None:
+                cursor.execute('''
+                    SELECT id, aes_key, salt FROM keys WHERE owner = ?
+                    ORDER BY created_at DESC, id DESC LIMIT 1
+                ''', (username,))
+            else:
+                cursor.execute("SELECT id, aes_key, salt FROM keys WHERE id = ? AND owner = ?", (key_id, username))
+            return cursor.fetchone() or (None, None, None)
+
+    def get_current_key_id(self, username):
+        """Read the user's newest key ID on the write connection, bypassing the session cache.
+
+        Call this inside the transaction that uses the key, so a rotation committed by another session is seen.
+        """
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT id FROM keys WHERE owner = ? ORDER BY created_at DESC, id DESC LIMIT 1", (username,))
+        row = cursor.fetchone()
+        key_id = row[0] if row else None
+        cached = self.cache.get(('key', username), None)
+        if cached is not MISSING and cached[0] != key_id:
+            self._invalidate('key', username)
+        return key_id
+
+    def get_user_key_and_salt(self, username):
+        """Retrieve the AES key and salt for a specific user."""
+        return self.get_user_key(username)[1:]
+
     def get_user_key_id(self, username):
         """Retrieve the key ID for a specific user."""
+        return self.get_user_key(username)[0]
+
+    def get_user_key_by_id(self, username, key_id):
+        """Retrieve the AES key and salt stored under a specific key ID."""
+        return self.get_user_key(username, key_id)[1:]
+
+    def get_data_key(self, username, data_key_id):
+        """Retrieve (kek_id, wrapped_key) for one of a user's data keys, or (None, None)."""
+        try:
+            return self._cached(('data_key', username), data_key_id,
+                                lambda: self._load_data_key(username, data_key_id))
+        except Exception as e:
+            self.logger.error("Error retrieving data key %s for %s: %s", data_key_id, username, e)
+            raise
+
+    def _load_data_key(self, username, data_key_id):
+        with self._reading() as cursor:
+            cursor.execute("SELECT kek_id, wrapped_key FROM data_keys WHERE id = ? AND owner = ?",
+                           (data_key_id, username))
+            return cursor.fetchone() or (None, None)
+
+    def get_block_data_key_id(self, username):
+        """Retrieve the ID of the data key the user's block store is sealed with, or None."""
+        try:
+            return self._cached(('data_key', username), 'blocks', lambda: self._load_block_data_key_id(username))
+        except Exception as e:
+            self.logger.error("Error retrieving block data key for %s: %s", username, e)
+            raise
+
+    def _load_block_data_key_id(self, username):
+        with self._reading() as cursor:
+            cursor.execute("SELECT id FROM data_keys WHERE owner = ? AND purpose = 'blocks' ORDER BY id LIMIT 1",
+                           (username,))
+            row = cursor.fetchone()
+            return row[0] if row else None
+
+    def insert_block_data_key(self, username, kek_id, wrapped_key):
+        """Store the user's block data key, returning its ID; an existing one wins over wrapped_key."""
+        try:
+            with self.transaction():
+                cursor = self.conn.cursor()
+                data_key_id = self._load_block_data_key_id(username)
+                if data_key_id is None:
+                    data_key_id = self._insert_data_key(cursor, username, kek_id, wrapped_key, 'blocks')
+                    self._invalidate('data_key', username)
+            self.logger.info("Block data key %s stored for %s.", data_key_id, username)
+            return data_key_id
+        except Exception as e:
+            self.logger.error("Error storing block data key for %s: %s", username, e)
+            raise
+
+    def list_data_keys(self, username):
+        """Return (id, kek_id, wrapped_key) for the data keys of a user's live files and block store."""
+        try:
+            with self._reading() as cursor:
+                cursor.execute('''
+                    SELECT id, kek_id, wrapped_key FROM data_keys WHERE owner = ? AND (purpose != 'file'
+                    OR id IN (SELECT data_key_id FROM files WHERE owner = ? AND delete_date IS NULL))
+                    ORDER BY id
+                ''', (username, username))
+                return cursor.fetchall()
+        except Exception as e:
+            self.logger.error("Error listing data keys for %s: %s", username, e)
+            raise
+
+    def rotate_user_key(self, username, aes_key, salt, rewrapped):
+        """Make a new key the user's current one and re-wrap their data keys under it, in one transaction.
+
+        rewrapped holds (data_key_id, wrapped_key) pairs for the new key.
+        Older keys that no data key and no directly encrypted file still
+        use are deleted. Returns (new key ID, deleted key IDs).
+        """
         try:
-            cursor = self.conn.cursor()
-            cursor.execute(f'''
-                SELECT id FROM {username}_keys ORDER BY created_at DESC LIMIT 1
-            ''')
-            result = cursor.fetchone()
-            if result:
-                return result[0]  # Return the key ID
-            return None
+            with self.transaction():
+                cursor = self.conn.cursor()
+                cursor.execute("INSERT INTO keys (owner, aes_key, salt) VALUES (?, ?, ?)", (username, aes_key, salt))
+                key_id = cursor.lastrowid
+                cursor.executemany("UPDATE data_keys SET kek_id = ?, wrapped_key = ? WHERE id = ? AND owner = ?",
+                                   [(key_id, wrapped_key, data_key_id, username)
+                                    for data_key_id, wrapped_key in rewrapped])
+                cursor.execute('''
+                    SELECT id FROM keys WHERE owner = ? AND id != ?
+                    AND id NOT IN (SELECT kek_id FROM data_keys WHERE owner = ?)
+                    AND id NOT IN (SELECT key_id FROM files WHERE owner = ? AND data_key_id IS NULL
+                                   AND key_id IS NOT NULL AND delete_date IS NULL)
+                ''', (username, key_id, username, username))
+                retired = [row[0] for row in cursor.fetchall()]
+                cursor.executemany("DELETE FROM keys WHERE id = ?", [(retired_id,) for retired_id in retired])
+                self._invalidate('key', username)
+                self._invalidate('data_key', username)
+            self.logger.info("Rotated key for %s to %s: %s data keys re-wrapped, %s old keys deleted.",
+                             username, key_id, len(rewrapped), len(retired))
+            return key_id, retired
         except Exception as e:
-            self.logger.error(f"Error retrieving AES key ID for {username}: {e}")
+            self.logger.error("Error rotating key for %s: %s", username, e)
             raise
 
-    def insert_file_metadata(self, username, file_name, encrypted_path, key_id):
-        """Insert file metadata for a user."""
+    def _insert_file_version(self, cursor, username, file_name, encrypted_path, key_id, storage, codec,
+                             data_key_id=None):
+        """Insert a file row as the next version of file_name, superseding the current one.
+
+        Shares carry over to the new version. Returns the new file ID.
+        """
+        cursor.execute(f"SELECT id, version FROM files WHERE owner = ? AND file_name = ? AND {CURRENT_FILE}",
+                       (username, file_name))
+        previous = cursor.fetchone()
+        previous_id, version = (previous[0], previous[1] + 1) if previous else (None, 1)
+        cursor.execute('''
+            INSERT INTO files (owner, file_name, encrypted_path, key_id, storage, codec, version, previous_version_id,
+                               data_key_id)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (username, file_name, encrypted_path, key_id, storage, codec, version, previous_id, data_key_id))
+        file_id = cursor.lastrowid
+        self._invalidate('file', username, file_name)
+        if previous_id is not None:
+            cursor.execute("UPDATE files SET superseded_at = CURRENT_TIMESTAMP WHERE id = ?", (previous_id,))
+            cursor.execute("INSERT INTO file_shares (file_id, grantee) SELECT ?, grantee FROM file_shares "
+                           "WHERE file_id = ?", (file_id, previous_id))
+        return file_id
+
+    def _insert_data_key(self, cursor, username, kek_id, wrapped_key, purpose='file'):
+        """Store a data key wrapped by the user's key kek_id, returning its ID."""
+        cursor.execute("INSERT INTO data_keys (owner, kek_id, purpose, wrapped_key) VALUES (?, ?, ?, ?)",
+                       (username, kek_id, purpose, wrapped_key))
+        return cursor.lastrowid
+
+    def insert_file_metadata(self, username, file_name, encrypted_path, key_id, codec='none', wrapped_key=None):
+        """Insert file metadata for a user, as a new version if the file already exists.
+
+        wrapped_key is the file's own data key wrapped by key_id; without it
+        the file is taken to be encrypted with key_id directly.
+        """
+        self.insert_file_metadata_many(username, [(file_name, encrypted_path, key_id, codec, wrapped_key)])
+
+    def insert_file_metadata_many(self, username, rows):
+        """Insert (file_name, encrypted_path, key_id, codec[, wrapped_key]) rows in a single transaction."""
         try:
-            cursor = self.conn.cursor()
-            cursor.execute(f'''
-                INSERT INTO {username}_files (file_name, encrypted_path, key_id)
-                VALUES (?, ?, ?)
-            ''', (file_name, encrypted_path, key_id))
-            self.conn.commit()
-            self.logger.info(f"File metadata inserted for {file_name} in user {username}'s table.")
+            with self.transaction():
+                cursor = self.conn.cursor()
+                for file_name, encrypted_path, key_id, codec, *wrapped_key in rows:
+                    data_key_id = None
+                    if wrapped_key and wrapped_key[0] is not None:
+                        data_key_id = self._insert_data_key(cursor, username, key_id, wrapped_key[0])
+                    self._insert_file_version(cursor, username, file_name, encrypted_path, key_id, 'file', codec,
+                                              data_key_id)
+            self.logger.info("File metadata inserted for %s files owned by %s.", len(rows), username)
         except Exception as e:
-            self.logger.error(f"Error inserting file metadata: {e}")
+            self.logger.error("Error inserting file metadata: %s", e)
             raise
 
-    def retrieve_file_metadata(self, username, file_name):
-        """Retrieve metadata for a specific file."""
+    def retrieve_file_metadata(self, username, file_name, version=None):
+        """Retrieve metadata for the current version of a file, or for an older version if given."""
         try:
-            cursor = self.conn.cursor()
-            cursor.execute(f'''
-                SELECT * FROM {username}_files WHERE file_name=? AND delete_date IS NULL
-            ''', (file_name,))
-            file_metadata = cursor.fetchone()
-            return file_metadata
+            return self._cached(('file', username, file_name), version,
+                                lambda: self._load_file_metadata(username, file_name, version))
         except Exception as e:
-            self.logger.error(f"Error retrieving file metadata for {file_name}: {e}")
+            self.logger.error("Error retrieving file metadata for %s: %s", file_name, e)
             raise
 
-    def update_download_date(self, username, file_name):
-        """Update the download date for a file."""
+    def _load_file_metadata(self, username, file_name, version):
+        with self._reading() as cursor:
+            if version is None:
+                cursor.execute(f'''
+                    SELECT {FILE_COLUMNS} FROM files
+                    WHERE owner = ? AND file_name = ? AND {CURRENT_FILE}
+                ''', (username, file_name))
+            else:
+                cursor.execute(f'''
+                    SELECT {FILE_COLUMNS} FROM files
+                    WHERE owner = ? AND file_name = ? AND version = ? AND delete_date IS NULL
+                ''', (username, file_name, version))
+            return cursor.fetchone()
+
+    def list_file_versions(self, username, file_name):
+        """List the stored versions of a file, newest first."""
         try:
-            cursor = self.conn.cursor()
-            cursor.execute(f'''
-                UPDATE {username}_files
-                SET download_date=CURRENT_TIMESTAMP
-                WHERE file_name=? AND delete_date IS NULL
-            ''', (file_name,))
-            self.conn.commit()
-            self.logger.info(f"Download date updated for {file_name}.")
+            self.flush()
+            with self._reading() as cursor:
+                cursor.execute('''
+                    SELECT id, version, encrypted_path, storage, codec, uploaded_at, download_date, superseded_at
+                    FROM files
+                    WHERE owner = ? AND file_name = ? AND delete_date IS NULL
+                    ORDER BY version DESC
+                ''', (username, file_name))
+                return [{
+                    'id': row[0],
+                    'version': row[1],
+                    'encrypted_path': row[2],
+                    'storage': row[3],
+                    'codec': row[4],
+                    'uploaded_at': row[5],
+                    'download_date': row[6],
+                    'superseded_at': row[7],
+                } for row in cursor.fetchall()]
         except Exception as e:
-            self.logger.error(f"Error updating download date: {e}")
+            self.logger.error("Error listing versions of %s: %s", file_name, e)
             raise
 
+    def update_download_date(self, username, file_name, file_id=None):
+        """Record a download of the version with file_id, or of the current one; written on the next flush."""
+        self.update_download_dates(username, [file_name], None if file_id is None else [file_id])
+
+    def update_download_dates(self, username, file_names, file_ids=None):
+        """Record downloads of several files; timestamps are coalesced and written on the next flush.
+
+        file_ids, if given, parallels file_names with the ID of the version each download read.
+        """
+        # Same format as CURRENT_TIMESTAMP
+        downloaded_at = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime())
+        file_ids = file_ids if file_ids is not None else [None] * len(file_names)
+        with self.pool.write_lock:
+            for file_name, file_id in zip(file_names, file_ids):
+                self._pending_downloads[(username, file_name, file_id)] = downloaded_at
+            self.logger.info("Download date recorded for %s files.", len(file_names))
+            if not self._transaction_depth:
+                self._maybe_flush()
+
     def mark_file_deleted(self, username, file_name):
-        """Mark a file as deleted."""
+        """Mark a file as deleted and delete the data keys of its versions, leaving their contents unreadable."""
         try:
-            cursor = self.conn.cursor()
-            cursor.execute(f'''
-                UPDATE {username}_files
-                SET delete_date=CURRENT_TIMESTAMP
-                WHERE file_name=?
-            ''', (file_name,))
-            self.conn.commit()
-            self.logger.info(f"File {file_name} marked as deleted.")
+            with self.transaction():
+                cursor = self.conn.cursor()
+                cursor.execute('''
+                    UPDATE files
+                    SET delete_date=CURRENT_TIMESTAMP
+                    WHERE owner = ? AND file_name = ?
+                ''', (username, file_name))
+                # Every version has its own data key; a background job may still need the one it retired
+                cursor.execute('''
+                    DELETE FROM data_keys WHERE owner = ? AND purpose = 'file'
+                    AND id IN (SELECT data_key_id FROM files WHERE owner = ? AND file_name = ?)
+                    AND id NOT IN (SELECT data_key_id FROM retired_files WHERE data_key_id IS NOT NULL)
+                ''', (username, username, file_name))
+                self._invalidate('file', username, file_name)
+                self._invalidate('data_key', username)
+            self.logger.info("File %s marked as deleted.", file_name)
         except Exception as e:
-            self.logger.error(f"Error marking file as deleted: {e}")
+            self.logger.error("Error marking file as deleted: %s", e)
+            raise
+
+    def insert_file_manifest(self, username, file_name, key_id, manifest, codec='none', data_key_id=None):
+        """Insert a block-store file, taking a reference on each (address, length, size, codec) chunk.
+
+        data_key_id names the block data key the chunks are sealed with, if
+        not key_id itself. The file becomes the next version if it already
+        exists. Returns the new file ID.
+        """
+        try:
+            with self.transaction():
+                cursor = self.conn.cursor()
+                file_id = self._insert_file_version(cursor, username, file_name, '', key_id, 'blocks', codec,
+                                                    data_key_id)
+                cursor.executemany("INSERT OR IGNORE INTO blocks (address, size, codec) VALUES (?, ?, ?)",
+                                   [(address, size, block_codec) for address, _, size, block_codec in manifest])
+                cursor.executemany("UPDATE blocks SET refcount = refcount + 1 WHERE address = ?",
+                                   [(address,) for address, *_ in manifest])
+                cursor.executemany('''
+                    INSERT INTO file_chunks (file_id, seq, address, length) VALUES (?, ?, ?, ?)
+                ''', [(file_id, seq, address, length) for seq, (address, length, *_) in enumerate(manifest)])
+            self.logger.info("File manifest inserted for %s owned by %s (%s chunks).",
+                             file_name, username, len(manifest))
+            return file_id
+        except Exception as e:
+            self.logger.error("Error inserting file manifest: %s", e)
+            raise
+
+    def get_file_blocks(self, file_id):
+        """Return {address: (stored size, codec)} for the blocks a block-store file references."""
+        try:
+            with self._reading() as cursor:
+                cursor.execute('''
+                    SELECT DISTINCT blocks.address, size, codec FROM file_chunks
+                    JOIN blocks ON blocks.address = file_chunks.address
+                    WHERE file_id = ?
+                ''', (file_id,))
+                return {address: (size, codec) for address, size, codec in cursor.fetchall()}
+        except Exception as e:
+            self.logger.error("Error retrieving blocks for file %s: %s", file_id, e)
+            raise
+
+    def get_file_chunks(self, file_id):
+        """Return a block-store file's manifest as ordered (address, length, codec) tuples."""
+        try:
+            with self._reading() as cursor:
+                cursor.execute('''
+                    SELECT file_chunks.address, length, codec FROM file_chunks
+                    JOIN blocks ON blocks.address = file_chunks.address
+                    WHERE file_id = ? ORDER BY seq
+                ''', (file_id,))
+                return cursor.fetchall()
+        except Exception as e:
+            self.logger.error("Error retrieving chunks for file %s: %s", file_id, e)
+            raise
+
+    def release_file_chunks(self, username, file_name):
+        """Drop the chunk references held by every live version of the owner's file_name.
+
+        Blocks left without references are removed from the blocks table and
+        their addresses returned so the caller can delete them from disk.
+        """
+        try:
+            with self.transaction():
+                cursor = self.conn.cursor()
+                file_ids = self._live_file_ids(cursor, username, file_name, all_versions=True)
+                placeholders = ', '.join('?' * len(file_ids))
+                cursor.execute(f'''
+                    SELECT address, COUNT(*) FROM file_chunks
+                    WHERE file_id IN ({placeholders}) GROUP BY address
+                ''', file_ids)
+                references = cursor.fetchall()
+                cursor.executemany("UPDATE blocks SET refcount = refcount - ? WHERE address = ?",
+                                   [(count, address) for address, count in references])
+                cursor.execute(f"DELETE FROM file_chunks WHERE file_id IN ({placeholders})", file_ids)
+                orphaned = []
+                for address, _ in references:
+                    cursor.execute("SELECT refcount FROM blocks WHERE address = ?", (address,))
+                    if cursor.fetchone()[0] <= 0:
+                        orphaned.append(address)
+                cursor.executemany("DELETE FROM blocks WHERE address = ?", [(address,) for address in orphaned])
+            self.logger.info("Released %s blocks of %s; %s now unreferenced.",
+                             len(references), file_name, len(orphaned))
+            return orphaned
+        except Exception as e:
+            self.logger.error("Error releasing chunks of %s: %s", file_name, e)
             raise
     def list_user_files(self, username):
         """List all metadata for current files of a user."""
         try:
-            cursor = self.conn.cursor()
-            cursor.execute(f'''
-                SELECT id, file_name, encrypted_path, key_id, uploaded_at, download_date, shared_user
-                FROM {username}_files 
-                WHERE delete_date IS NULL
-            ''')
-            files = cursor.fetchall()
-            
-            # Convert the results to a list of dictionaries for easier handling
-            file_list = []
-            for file in files:
-                file_dict = {
-                    'id': file[0],
-                    'file_name': file[1],
-                    'encrypted_path': file[2],
-                    'key_id': file[3],
-                    'uploaded_at': file[4],
-                    'download_date': file[5],
-                    'shared_user': file[6]
-                }
-                file_list.append(file_dict)
-            
-            return file_list
-        except Exception as e:
-            self.logger.error(f"Error listing files for {username}: {e}")
+            # Make coalesced download dates visible
+            self.flush()
+            with self._reading() as cursor:
+                cursor.execute(f'''
+                    SELECT id, file_name, encrypted_path, key_id, uploaded_at, download_date, {SHARED_USERS}, version
+                    FROM files
+                    WHERE owner = ? AND {CURRENT_FILE}
+                ''', (username,))
+                files = cursor.fetchall()
+
+                # Convert the results to a list of dictionaries for easier handling
+                file_list = []
+                for file in files:
+                    file_dict = {
+                        'id': file[0],
+                        'file_name': file[1],
+                        'encrypted_path': file[2],
+                        'key_id': file[3],
+                        'uploaded_at': file[4],
+                        'download_date': file[5],
+                        'shared_user': file[6],
+                        'version': file[7]
+                    }
+                    file_list.append(file_dict)
+
+                return file_list
+        except Exception as e:
+            self.logger.error("Error listing files for %s: %s", username, e)
             raise
-    def list_all_users(self):
-        """List all users in the database."""
+
+    def get_checkpoint(self, job):
+        """Return a job's (position, processed, failed), or zeros if it has not run."""
+        try:
+            with self._reading() as cursor:
+                cursor.execute("SELECT position, processed, failed FROM job_checkpoints WHERE job = ?", (job,))
+                return cursor.fetchone() or (0, 0, 0)
+        except Exception as e:
+            self.logger.error("Error retrieving checkpoint of %s: %s", job, e)
+            raise
+
+    def save_checkpoint(self, job, position, processed, failed):
+        """Record how far a job has got: every file ID up to position has been handled."""
+        try:
+            with self.transaction():
+                self.conn.cursor().execute('''
+                    INSERT INTO job_checkpoints (job, position, processed, failed, updated_at)
+                    VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
+                    ON CONFLICT (job) DO UPDATE SET position = excluded.position, processed = excluded.processed,
+                        failed = excluded.failed, updated_at = excluded.updated_at
+                ''', (job, position, processed, failed))
+        except Exception as e:
+            self.logger.error("Error saving checkpoint of %s: %s", job, e)
+            raise
+
+    def clear_checkpoint(self, job):
+        """Forget a job's progress so it starts over."""
         try:
-            cursor = self.conn.cursor()
-            cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%' AND name NOT LIKE '%_keys'")
-            users = cursor.fetchall()
-            cleaned_users = []
-            for user in users:
-                if user[0].count('_') == 1:
-                    cleaned_users.append(user[0].split('_')[0])
+            with self.transaction():
+                self.conn.cursor().execute("DELETE FROM job_checkpoints WHERE job = ?", (job,))
+            self.logger.info("Checkpoint of %s cleared.", job)
+        except Exception as e:
+            self.logger.error("Error clearing checkpoint of %s: %s", job, e)
+            raise
 
+    def list_stored_files(self, after_id, limit, legacy_only=False, include_blocks=False):
+        """Return up to limit non-deleted .enc file rows of every user with IDs above after_id, in ID order.
 
-            return cleaned_users
+        Rows are (id, owner, file_name, encrypted_path, key_id, data_key_id, codec, storage), old versions included.
+        """
+        try:
+            with self._reading() as cursor:
+                cursor.execute(f'''
+                    SELECT id, owner, file_name, encrypted_path, key_id, data_key_id, codec, storage FROM files
+                    WHERE id > ? AND delete_date IS NULL
+                    {'' if include_blocks else "AND storage = 'file'"}
+                    {'AND data_key_id IS NULL' if legacy_only else ''}
+                    ORDER BY id LIMIT ?
+                ''', (after_id, limit))
+                return cursor.fetchall()
         except Exception as e:
-            self.logger.error(f"Error listing all users: {e}")  
+            self.logger.error("Error listing stored files after %s: %s", after_id, e)
+            raise
+
+    def list_file_paths(self, owner):
+        """Return the encrypted_path of every non-deleted .enc file the owner has, in any version."""
+        try:
+            with self._reading() as cursor:
+                cursor.execute('''
+                    SELECT encrypted_path FROM files WHERE owner = ? AND storage = 'file' AND delete_date IS NULL
+                ''', (owner,))
+                return [row[0] for row in cursor.fetchall()]
+        except Exception as e:
+            self.logger.error("Error listing file paths of %s: %s", owner, e)
+            raise
+
+    def referenced_paths(self, paths):
+        """Return the subset of paths that a non-deleted file row still names."""
+        try:
+            paths = list(dict.fromkeys(paths))
+            referenced = set()
+            with self._reading() as cursor:
+                for start in range(0, len(paths), 500):
+                    batch = paths[start:start + 500]
+                    cursor.execute(f'''
+                        SELECT DISTINCT encrypted_path FROM files
+                        WHERE encrypted_path IN ({', '.join('?' * len(batch))}) AND delete_date IS NULL
+                    ''', batch)
+                    referenced.update(row[0] for row in cursor.fetchall())
+            return referenced
+        except Exception as e:
+            self.logger.error("Error checking file path references: %s", e)
+            raise
+
+    def list_block_addresses(self, prefix):
+        """Return {address: codec} for the stored blocks whose address starts with the hex prefix."""
+        try:
+            # Bounded on the primary key: 'ab' <= address < 'ac'
+            upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+            with self._reading() as cursor:
+                cursor.execute("SELECT address, codec FROM blocks WHERE address >= ? AND address < ?",
+                               (prefix, upper))
+                return dict(cursor.fetchall())
+        except Exception as e:
+            self.logger.error("Error listing blocks under %s: %s", prefix, e)
+            raise
+
+    def replace_file_encryption(self, file_id, old_path, new_path, key_id, wrapped_key, job):
+        """Point a row still naming old_path at a re-encrypted copy, retiring the old file and data key under job.
+
+        Returns True if the row was updated.
+        """
+        try:
+            with self.transaction():
+                cursor = self.conn.cursor()
+                cursor.execute('''
+                    SELECT owner, file_name, data_key_id FROM files
+                    WHERE id = ? AND encrypted_path = ? AND delete_date IS NULL
+                ''', (file_id, old_path))
+                row = cursor.fetchone()
+                if row is None:
+                    return False
+                owner, file_name, old_data_key_id = row
+                data_key_id = self._insert_data_key(cursor, owner, key_id, wrapped_key)
+                cursor.execute('''
+                    UPDATE files SET encrypted_path = ?, key_id = ?, data_key_id = ? WHERE id = ?
+                ''', (new_path, key_id, data_key_id, file_id))
+                self._retire_file(cursor, job, file_id, old_path, old_data_key_id)
+                self._invalidate('file', owner, file_name)
+            return True
+        except Exception as e:
+            self.logger.error("Error replacing encryption of file %s: %s", file_id, e)
+            raise
+
+    def relocate_file(self, file_id, old_path, new_path, job):
+        """Point a row still naming old_path at new_path, retiring old_path under job.
+
+        Returns True if the row was updated.
+        """
+        try:
+            with self.transaction():
+                cursor = self.conn.cursor()
+                cursor.execute('''
+                    SELECT owner, file_name FROM files WHERE id = ? AND encrypted_path = ? AND delete_date IS NULL
+                ''', (file_id, old_path))
+                row = cursor.fetchone()
+                if row is None:
+                    return False
+                cursor.execute("UPDATE files SET encrypted_path = ? WHERE id = ?", (new_path, file_id))
+                self._retire_file(cursor, job, file_id, old_path)
+                self._invalidate('file', *row)
+            return True
+        except Exception as e:
+            self.logger.error("Error relocating file %s: %s", file_id, e)
+            raise
+
+    def _retire_file(self, cursor, job, file_id, encrypted_path, data_key_id=None):
+        cursor.execute("INSERT INTO retired_files (job, file_id, encrypted_path, data_key_id) VALUES (?, ?, ?, ?)",
+                       (job, file_id, encrypted_path, data_key_id))
+
+    def list_retired_files(self, job, up_to=None):
+        """Return (id, encrypted_path) of the files job has retired, from rows with IDs up to up_to if given."""
+        try:
+            with self._reading() as cursor:
+                if up_to is None:
+                    cursor.execute("SELECT id, encrypted_path FROM retired_files WHERE job = ? ORDER BY id", (job,))
+                else:
+                    cursor.execute('''
+                        SELECT id, encrypted_path FROM retired_files WHERE job = ? AND file_id <= ? ORDER BY id
+                    ''', (job, up_to))
+                return cursor.fetchall()
+        except Exception as e:
+            self.logger.error("Error listing files retired by %s: %s", job, e)
+            raise
+
+    def release_retired_file(self, retired_id):
+        """Forget a retired file once it is removed, deleting its data key unless a file row still uses it."""
+        try:
+            with self.transaction():
+                cursor = self.conn.cursor()
+                cursor.execute('''
+                    SELECT data_keys.id, data_keys.owner FROM retired_files
+                    JOIN data_keys ON data_keys.id = retired_files.data_key_id AND data_keys.purpose = 'file'
+                    WHERE retired_files.id = ?
+                    AND data_keys.id NOT IN (SELECT data_key_id FROM files WHERE data_key_id IS NOT NULL)
+                ''', (retired_id,))
+                row = cursor.fetchone()
+                if row is not None:
+                    cursor.execute("DELETE FROM data_keys WHERE id = ?", (row[0],))
+                    self._invalidate('data_key', row[1])
+                cursor.execute("DELETE FROM retired_files WHERE id = ?", (retired_id,))
+        except Exception as e:
+            self.logger.error("Error releasing retired file %s: %s", retired_id, e)
+            raise
+
+    def list_all_users(self):
+        """List all users in the database."""
+        try:
+            with self._reading() as cursor:
+                cursor.execute("SELECT username FROM users ORDER BY username")
+                return [row[0] for row in cursor.fetchall()]
+        except Exception as e:
+            self.logger.error("Error listing all users: %s", e)
+            raise
+
+    def _live_file_ids(self, cursor, owner_username, file_name, all_versions=False):
+        """Return the IDs of the owner's current row for file_name, or of every non-deleted version."""
+        cursor.execute(f'''
+            SELECT id FROM files
+            WHERE owner = ? AND file_name = ? AND {'delete_date IS NULL' if all_versions else CURRENT_FILE}
+        ''', (owner_username, file_name))
+        file_ids = [row[0] for row in cursor.fetchall()]
+        if not file_ids:
+            raise Exception(f"File '{file_name}' not found for user '{owner_username}'")
+        return file_ids
 
     def share_file(self, owner_username, file_name, shared_users):
-        """Add shared users to a file's metadata."""
-        try:
-            cursor = self.conn.cursor()
-            # First, get the current shared users
-            cursor.execute(f'''
-                SELECT shared_user FROM {owner_username}_files
-                WHERE file_name = ? AND delete_date IS NULL
-            ''', (file_name,))
-            result = cursor.fetchone()
-            if not result:
-                raise Exception(f"File '{file_name}' not found for user '{owner_username}'")
-            
-            current_shared_users = result[0] or ""
-            new_shared_users = current_shared_users.split(',') if current_shared_users else []
-            for user in shared_users:
-                if user not in new_shared_users:
-                    new_shared_users.append(user)
-            
-            updated_shared_users = ','.join(new_shared_users)
-            
-            cursor.execute(f'''
-                UPDATE {owner_username}_files
-                SET shared_user = ?
-                WHERE file_name = ? AND delete_date IS NULL
-            ''', (updated_shared_users, file_name))
-            self.conn.commit()
-            self.logger.info(f"File '{file_name}' shared with users: {shared_users}")
-        except Exception as e:
-            self.logger.error(f"Error sharing file: {e}")
+        """Grant additional users access to a file, keeping existing grants."""
+        try:
+            with self.transaction():
+                cursor = self.conn.cursor()
+                file_ids = self._live_file_ids(cursor, owner_username, file_name)
+                self._invalidate('file', owner_username, file_name)
+                cursor.executemany('''
+                    INSERT OR IGNORE INTO file_shares (file_id, grantee) VALUES (?, ?)
+                ''', [(file_id, user) for file_id in file_ids for user in set(shared_users)])
+            self.logger.info("File '%s' shared with users: %s", file_name, shared_users)
+        except Exception as e:
+            self.logger.error("Error sharing file: %s", e)
             raise
 
     def get_shared_file_metadata(self, owner_username, file_name, requesting_username):
-        """Retrieve metadata for a shared file."""
+        """Retrieve metadata for a file the requesting user has been granted access to."""
         try:
-            cursor = self.conn.cursor()
-            cursor.execute(f'''
-                SELECT * FROM {owner_username}_files
-                WHERE file_name = ? AND delete_date IS NULL AND shared_user LIKE ?
-            ''', (file_name, f"%{requesting_username}%"))
-            file_metadata = cursor.fetchone()
-            return file_metadata
+            with self._reading() as cursor:
+                cursor.execute(f'''
+                    SELECT {FILE_COLUMNS} FROM files
+                    JOIN file_shares ON file_shares.file_id = files.id AND file_shares.grantee = ?
+                    WHERE owner = ? AND file_name = ? AND {CURRENT_FILE}
+                ''', (requesting_username, owner_username, file_name))
+                file_metadata = cursor.fetchone()
+                return file_metadata
         except Exception as e:
-            self.logger.error(f"Error retrieving shared file metadata: {e}")
+            self.logger.error("Error retrieving shared file metadata: %s", e)
             raise
 
     def update_shared_users(self, owner_username, filename, shared_users):
-        """Update the shared users for a file."""
-        try:
-            cursor = self.conn.cursor()
-            shared_users_str = ','.join(shared_users)
-            cursor.execute(f"""
-                UPDATE {owner_username}_files
-                SET shared_user = ?
-                WHERE file_name = ? AND delete_date IS NULL
-            """, (shared_users_str, filename))
-            self.conn.commit()
-            self.logger.info(f"Updated shared users for file '{filename}' owned by {owner_username}")
-        except Exception as e:
-            self.logger.error(f"Error updating shared users: {e}")
+        """Replace the set of users a file is shared with, touching only the grants that change."""
+        try:
+            with self.transaction():
+                cursor = self.conn.cursor()
+                wanted = set(shared_users)
+                self._invalidate('file', owner_username, filename)
+                for file_id in self._live_file_ids(cursor, owner_username, filename):
+                    cursor.execute("SELECT grantee FROM file_shares WHERE file_id = ?", (file_id,))
+                    current = {row[0] for row in cursor.fetchall()}
+                    cursor.executemany("DELETE FROM file_shares WHERE file_id = ? AND grantee = ?",
+                                       [(file_id, user) for user in current - wanted])
+                    cursor.executemany("INSERT INTO file_shares (file_id, grantee) VALUES (?, ?)",
+                                       [(file_id, user) for user in wanted - current])
+            self.logger.info("Updated shared users for file '%s' owned by %s", filename, owner_username)
+        except Exception as e:
+            self.logger.error("Error updating shared users: %s", e)
+            raise
+
+    def remove_all_shares(self, owner_username, filename):
+        """Revoke every grant on a file."""
+        try:
+            with self.transaction():
+                cursor = self.conn.cursor()
+                self._invalidate('file', owner_username, filename)
+                cursor.executemany("DELETE FROM file_shares WHERE file_id = ?",
+                                   [(file_id,) for file_id in self._live_file_ids(cursor, owner_username, filename)])
+            self.logger.info("Removed all shares for file '%s' owned by %s", filename, owner_username)
+        except Exception as e:
+            self.logger.error("Error removing shares: %s", e)
+            raise
+
+    def list_shared_with_me(self, username):
+        """List the live files other users have shared with username."""
+        try:
+            with self._reading() as cursor:
+                cursor.execute(f'''
+                    SELECT files.owner, files.file_name, files.uploaded_at
+                    FROM file_shares
+                    JOIN files ON files.id = file_shares.file_id
+                    WHERE file_shares.grantee = ? AND {CURRENT_FILE}
+                    ORDER BY files.owner, files.file_name
+                ''', (username,))
+                return [{'owner': row[0], 'file_name': row[1], 'uploaded_at': row[2]} for row in cursor.fetchall()]
+        except Exception as e:
+            self.logger.error("Error listing files shared with %s: %s", username, e)
             raise
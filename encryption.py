@@ -1,15 +1,42 @@
 # encryption.py
 from Crypto.Cipher import AES
 from Crypto.Random import get_random_bytes
-from Crypto.Protocol.KDF import PBKDF2
+from Crypto.Protocol.KDF import PBKDF2, HKDF
 from Crypto.Hash import SHA256
 import base64
-import logging
+import hashlib
+import hmac
+from logger import Summary, get_logger
+import struct
+import threading
+from collections import OrderedDict, namedtuple
+
+# Segmented on-disk format. Every stream starts with a common prefix:
+#   magic (4) | version (1) | flags (1)
+# Version 1 follows it with the segment size and stores each segment as
+# ``nonce + ciphertext + tag``. Version 2 (written today) follows it with the
+# segment size, the key ID and an 8-byte nonce prefix; segment nonces are the
+# prefix plus the segment index, so segments are stored as ``ciphertext + tag``.
+STREAM_MAGIC = b"GCFS"
+STREAM_VERSION = 2
+STREAM_PREFIX = struct.Struct(">4sBB")  # magic, version, flags
+STREAM_HEADER_V1 = struct.Struct(">4sBBI")  # ... segment size
+STREAM_HEADER_V2 = struct.Struct(">4sBBIQ8s")  # ... segment size, key ID, nonce prefix
+STREAM_HEADER_MAX_SIZE = STREAM_HEADER_V2.size
+SEGMENT_SIZE = 1024 * 1024
+NONCE_SIZE = 12
+NONCE_PREFIX_SIZE = 8
+TAG_SIZE = 16
+FLAG_RAW_KEY = 0x01  # data key used as-is, without PBKDF2 stretching
+FLAG_FRAMED = 0x02  # plaintext is compressed in independent frames followed by their index
+BLOCK_VERSION = b"\x02"  # first byte of blocks with a payload-derived nonce
+
+StreamHeader = namedtuple('StreamHeader', ['version', 'flags', 'segment_size', 'key_id', 'nonce_prefix', 'size'])
 
 class AESEncryptor:
     def __init__(self, password, salt, config_manager, logger=None):
         """Derive AES key from user password using PBKDF2 and store/retrieve salt."""
-        self.logger = logger or logging.getLogger("SecureFileStorage")
+        self.logger = get_logger('crypto', logger)
         try:
             if config_manager is not None:
                 salt = config_manager.get_salt()
@@ -17,46 +44,236 @@ class AESEncryptor:
                 salt = get_random_bytes(16)  # Generate a new salt
                 if config_manager is not None:
                     config_manager.set_salt(base64.b64encode(salt).decode('utf-8'))
-                self.logger.debug(f"New salt {salt} generated and stored in configuration.")
+                self.logger.debug("New salt %s generated and stored in configuration.", Summary(salt))
                 self.logger.info("New salt generated and stored in configuration.")
             elif isinstance(salt, str):
                 salt = base64.b64decode(salt.encode('utf-8'))
-                self.logger.debug(f"Salt {salt} loaded from configuration and decoded.")
+                self.logger.debug("Salt %s loaded from configuration and decoded.", Summary(salt))
             else:
-                self.logger.debug(f"Salt {salt} used as-is (assumed to be in bytes format).")
+                self.logger.debug("Salt %s used as-is (assumed to be in bytes format).", Summary(salt))
 
-            self.key = PBKDF2(password, salt, dkLen=32, count=100000, hmac_hash_module=SHA256)
+            self.key = bytearray(PBKDF2(password, salt, dkLen=32, count=100000, hmac_hash_module=SHA256))
             self.block_size = AES.block_size
-            self.logger.debug(f"AES encryption key derived successfully from user password.")
+            self.raw_key = False
+            self.logger.debug("AES encryption key derived successfully from user password.")
         except Exception as e:
-            self.logger.error(f"Error during AES key derivation: {e}")
+            self.logger.error("Error during AES key derivation: %s", e)
             raise
 
+    @classmethod
+    def from_raw_key(cls, key, logger=None):
+        """Build an encryptor from a random 32-byte data key, skipping PBKDF2.
+
+        Stretching only adds value for low-entropy passwords; data keys from
+        generate_key_and_salt() are already uniformly random.
+        """
+        encryptor = cls.__new__(cls)
+        encryptor.logger = get_logger('crypto', logger)
+        if isinstance(key, str):
+            key = base64.b64decode(key.encode('utf-8'))
+        if len(key) != 32:
+            raise ValueError("Raw AES key must be 32 bytes.")
+        encryptor.key = bytearray(key)
+        encryptor.block_size = AES.block_size
+        encryptor.raw_key = True
+        return encryptor
+
+    def zeroize(self):
+        """Overwrite the in-memory key so it cannot be recovered after use."""
+        self.key[:] = bytes(len(self.key))
+
     def encrypt(self, plaintext):
         """Encrypt the plaintext using AES-GCM."""
         try:
             cipher = AES.new(self.key, AES.MODE_GCM)
             ciphertext, tag = cipher.encrypt_and_digest(plaintext.encode())
             encrypted_text = base64.b64encode(cipher.nonce + tag + ciphertext).decode('utf-8')
-            self.logger.debug(f"Encryption successful with ciphertext: {encrypted_text}")
+            self.logger.debug("Encryption successful with ciphertext: %s", Summary(encrypted_text))
             self.logger.info("Encryption successful.")
             return encrypted_text
         except Exception as e:
-            self.logger.error(f"Error during encryption: {e}")
+            self.logger.error("Error during encryption: %s", e)
             raise
 
     def decrypt(self, encrypted_text):
         """Decrypt the ciphertext using AES-GCM."""
         try:
-            decoded_data = base64.b64decode(encrypted_text.encode())
-            nonce, tag, ciphertext = decoded_data[:self.block_size], decoded_data[self.block_size:self.block_size + 16], decoded_data[self.block_size + 16:]
-            cipher = AES.new(self.key, AES.MODE_GCM, nonce=nonce)
-            decrypted_text = cipher.decrypt_and_verify(ciphertext, tag).decode('utf-8')
+            decrypted_text = self.decrypt_bytes(encrypted_text).decode('utf-8')
             self.logger.info("Decryption successful.")
             return decrypted_text
         except Exception as e:
-            self.logger.error(f"Error during decryption: {e}")
+            self.logger.error("Error during decryption: %s", e)
+            raise
+
+    def decrypt_bytes(self, encrypted_text):
+        """Decrypt a legacy base64 blob produced by encrypt() and return raw bytes."""
+        if isinstance(encrypted_text, str):
+            encrypted_text = encrypted_text.encode()
+        decoded_data = base64.b64decode(encrypted_text)
+        nonce, tag, ciphertext = decoded_data[:self.block_size], decoded_data[self.block_size:self.block_size + 16], decoded_data[self.block_size + 16:]
+        cipher = AES.new(self.key, AES.MODE_GCM, nonce=nonce)
+        return cipher.decrypt_and_verify(ciphertext, tag)
+
+    def wrap_key(self, key, context):
+        """Encrypt a data key under this key, returning ``nonce + ciphertext + tag``.
+
+        context is authenticated alongside, so a wrapped key only unwraps for
+        the owner it was wrapped for.
+        """
+        cipher = AES.new(self.key, AES.MODE_GCM, nonce=get_random_bytes(NONCE_SIZE))
+        cipher.update(context)
+        ciphertext, tag = cipher.encrypt_and_digest(bytes(key))
+        return cipher.nonce + ciphertext + tag
+
+    def unwrap_key(self, wrapped, context):
+        """Decrypt and authenticate a data key produced by wrap_key()."""
+        wrapped = bytes(wrapped)
+        cipher = AES.new(self.key, AES.MODE_GCM, nonce=wrapped[:NONCE_SIZE])
+        cipher.update(context)
+        return cipher.decrypt_and_verify(wrapped[NONCE_SIZE:-TAG_SIZE], wrapped[-TAG_SIZE:])
+
+    def encrypt_stream(self, chunks, segment_size=SEGMENT_SIZE, key_id=0, flags=0):
+        """Encrypt an iterable of byte chunks into the segmented stream format, yielding the header and each segment.
+
+        Yielded ciphertext is a view of a reused buffer; consume it before requesting the next item.
+        """
+        try:
+            flags |= FLAG_RAW_KEY if self.raw_key else 0
+            nonce_prefix = get_random_bytes(NONCE_PREFIX_SIZE)
+            header = STREAM_HEADER_V2.pack(STREAM_MAGIC, STREAM_VERSION, flags, segment_size, key_id or 0, nonce_prefix)
+            yield header
+            output = bytearray(segment_size)
+            view = memoryview(output)
+            index = 0
+            for segment in _resegment(chunks, segment_size):
+                final = len(segment) < segment_size
+                cipher = AES.new(self.key, AES.MODE_GCM, nonce=_segment_nonce(nonce_prefix, index))
+                cipher.update(_segment_aad(header, index, final))
+                cipher.encrypt(segment, output=view[:len(segment)])
+                yield view[:len(segment)]
+                yield cipher.digest()
+                index += 1
+            self.logger.info("Stream encryption successful (%s segments).", index)
+        except Exception as e:
+            self.logger.error("Error during stream encryption: %s", e)
+            raise
+
+    def decrypt_stream(self, reader):
+        """Decrypt a segmented stream read from a binary file object, yielding each verified segment.
+
+        Yielded plaintext is a view of a reused buffer; raises ValueError on tampering or truncation.
+        """
+        try:
+            header_bytes, header = read_stream_header(reader)
+            if bool(header.flags & FLAG_RAW_KEY) != self.raw_key:
+                raise ValueError("Stream was encrypted with a different key type.")
+            record_size = _record_size(header)
+            record = memoryview(bytearray(record_size))
+            plaintext = memoryview(bytearray(header.segment_size))
+            index = 0
+            while True:
+                length = _read_full(reader, record)
+                final = length < record_size
+                written = self._open_segment(header_bytes, header, index, record[:length], final, plaintext)
+                yield plaintext[:written]
+                index += 1
+                if final:
+                    break
+            if reader.read(1):
+                raise ValueError("Unexpected data after the final segment.")
+            self.logger.info("Stream decryption successful (%s segments).", index)
+        except Exception as e:
+            self.logger.error("Error during stream decryption: %s", e)
             raise
+
+    def decrypt_stream_into(self, source, output):
+        """Decrypt a segmented stream held in a buffer, e.g. an mmap, into one of stream_plaintext_size() bytes.
+
+        Yields the (source, output) offsets after each verified segment; discard output if this raises.
+        """
+        try:
+            header = parse_stream_header(source)
+            if bool(header.flags & FLAG_RAW_KEY) != self.raw_key:
+                raise ValueError("Stream was encrypted with a different key type.")
+            if stream_plaintext_size(header, len(source)) != len(output):
+                raise ValueError("Output buffer does not match the stream's plaintext size.")
+            header_bytes = bytes(source[:header.size])
+            record_size = _record_size(header)
+            position, written, index = header.size, 0, 0
+            while True:
+                length = min(record_size, len(source) - position)
+                final = length < record_size
+                record = source[position:position + length]
+                written += self._open_segment(header_bytes, header, index, record, final, output[written:])
+                position += length
+                index += 1
+                yield position, written
+                if final:
+                    break
+            self.logger.info("Stream decryption successful (%s segments).", index)
+        except Exception as e:
+            self.logger.error("Error during stream decryption: %s", e)
+            raise
+        finally:
+            source = output = record = None  # See _open_segment
+
+    def decrypt_range(self, reader, offset, length):
+        """Decrypt bytes [offset, offset + length) of a segmented stream in a seekable binary file.
+
+        Only the segments overlapping the range are read; returns fewer bytes if it runs past the end.
+        """
+        try:
+            header_bytes, header = read_stream_header(reader)
+            if bool(header.flags & FLAG_RAW_KEY) != self.raw_key:
+                raise ValueError("Stream was encrypted with a different key type.")
+            size = stream_plaintext_size(header, reader.seek(0, 2))
+            end = min(offset + length, size)
+            if offset >= end:
+                return b''
+            segment_size, record_size = header.segment_size, _record_size(header)
+            first, last = offset // segment_size, (end - 1) // segment_size
+            final_index = size // segment_size
+
+            reader.seek(header.size + first * record_size)
+            records = memoryview(bytearray((last - first + 1) * record_size))
+            available = _read_full(reader, records)
+            plaintext = memoryview(bytearray((last - first + 1) * segment_size))
+            position = written = 0
+            for index in range(first, last + 1):
+                record = records[position:min(position + record_size, available)]
+                written += self._open_segment(header_bytes, header, index, record, index == final_index,
+                                              plaintext[written:])
+                position += record_size
+            start = offset - first * segment_size
+            self.logger.debug("Decrypted %s bytes at offset %s from %s segments.", end - offset, offset,
+                              last - first + 1)
+            return bytes(plaintext[start:start + end - offset])
+        except Exception as e:
+            self.logger.error("Error during range decryption: %s", e)
+            raise
+
+    def _open_segment(self, header_bytes, header, index, record, final, output):
+        """Decrypt and authenticate one segment record into output, returning the plaintext length."""
+        nonce_size = NONCE_SIZE if header.version == 1 else 0
+        if len(record) < nonce_size + TAG_SIZE:
+            raise ValueError("Encrypted stream is truncated.")
+        try:
+            if header.version == 1:
+                nonce = bytes(record[:NONCE_SIZE])
+            else:
+                nonce = _segment_nonce(header.nonce_prefix, index)
+            ciphertext = record[nonce_size:len(record) - TAG_SIZE]
+            cipher = AES.new(self.key, AES.MODE_GCM, nonce=nonce)
+            cipher.update(_segment_aad(header_bytes, index, final))
+            cipher.decrypt(ciphertext, output=output[:len(ciphertext)])
+            # A copy of the tag, so verify() holds no view into the caller's buffer
+            cipher.verify(bytes(record[len(record) - TAG_SIZE:]))
+            return len(ciphertext)
+        finally:
+            # Drop views into the caller's buffers, so an mmap can be closed even
+            # while a traceback still references this frame
+            record = output = ciphertext = None
+
     @staticmethod
     def generate_key_and_salt():
         """Generate a random AES key and salt."""
@@ -65,5 +282,209 @@ class AESEncryptor:
             salt = get_random_bytes(16)  # Generate a new salt (16 bytes)
             return base64.b64encode(key).decode('utf-8'), base64.b64encode(salt).decode('utf-8')
         except Exception as e:
-            logging.error(f"Error generating AES key and salt: {e}")
+            get_logger('crypto').error("Error generating AES key and salt: %s", e)
             raise
+
+
+class BlockEncryptor:
+    """Deterministic per-user encryption of chunks for the deduplicating block store.
+
+    Addresses are an HMAC of the plaintext and nonces one of the stored payload, under keys derived from the data key.
+    """
+
+    def __init__(self, encryptor):
+        self.address_key = bytearray(HKDF(bytes(encryptor.key), 32, None, SHA256, context=b"gicsfs block address"))
+        self.block_key = bytearray(HKDF(bytes(encryptor.key), 32, None, SHA256, context=b"gicsfs block encryption"))
+        self.nonce_key = bytearray(HKDF(bytes(encryptor.key), 32, None, SHA256, context=b"gicsfs block nonce"))
+
+    def address(self, chunk):
+        """Return the hex content address of a plaintext chunk."""
+        return hmac.new(self.address_key, chunk, hashlib.sha256).hexdigest()
+
+    def seal(self, address, payload, codec='none'):
+        """Encrypt a chunk's stored payload bound to its address and codec."""
+        associated_data = bytes.fromhex(address) + codec.encode()
+        nonce = hmac.new(self.nonce_key, associated_data + b'\0' + payload, hashlib.sha256).digest()[:NONCE_SIZE]
+        cipher = AES.new(self.block_key, AES.MODE_GCM, nonce=nonce)
+        cipher.update(associated_data)
+        ciphertext, tag = cipher.encrypt_and_digest(payload)
+        return BLOCK_VERSION + nonce + ciphertext + tag
+
+    def open(self, address, blob, codec='none'):
+        """Decrypt and authenticate a stored block."""
+        blob = memoryview(blob)
+        if blob[:1] != BLOCK_VERSION or len(blob) < 1 + NONCE_SIZE + TAG_SIZE:
+            raise ValueError("Unsupported block format.")
+        cipher = AES.new(self.block_key, AES.MODE_GCM, nonce=bytes(blob[1:1 + NONCE_SIZE]))
+        cipher.update(bytes.fromhex(address) + codec.encode())
+        return cipher.decrypt_and_verify(blob[1 + NONCE_SIZE:-TAG_SIZE], blob[-TAG_SIZE:])
+
+    def zeroize(self):
+        self.address_key[:] = bytes(len(self.address_key))
+        self.block_key[:] = bytes(len(self.block_key))
+        self.nonce_key[:] = bytes(len(self.nonce_key))
+
+
+class KeyCache:
+    """Session-scoped, bounded LRU cache of ready-to-use encryptors keyed by (username, key_id, kind).
+
+    Evicted and cleared entries have their key material zeroized.
+    """
+
+    def __init__(self, max_entries=64, logger=None):
+        self.max_entries = max_entries
+        self.logger = get_logger('crypto', logger)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, username, key_id, kind):
+        """Return the cached encryptor for a key, or None."""
+        with self._lock:
+            encryptor = self._entries.get((username, key_id, kind))
+            if encryptor is not None:
+                self._entries.move_to_end((username, key_id, kind))
+            return encryptor
+
+    def put(self, username, key_id, kind, encryptor):
+        """Cache an encryptor, evicting the least recently used entry if full."""
+        with self._lock:
+            previous = self._entries.pop((username, key_id, kind), None)
+            if previous is not None and previous is not encryptor:
+                previous.zeroize()
+            self._entries[(username, key_id, kind)] = encryptor
+            while len(self._entries) > self.max_entries:
+                _, evicted = self._entries.popitem(last=False)
+                evicted.zeroize()
+
+    def discard(self, username, key_id):
+        """Zeroize and drop every cached variant of one key."""
+        with self._lock:
+            for entry in [entry for entry in self._entries if entry[:2] == (username, key_id)]:
+                self._entries.pop(entry).zeroize()
+
+    def clear(self):
+        """Zeroize and drop every cached key."""
+        with self._lock:
+            for encryptor in self._entries.values():
+                encryptor.zeroize()
+            self._entries.clear()
+        self.logger.info("Derived key cache cleared.")
+
+
+def is_stream_format(prefix):
+    """Return True if ``prefix`` starts with the segmented stream magic."""
+    return bytes(prefix[:len(STREAM_MAGIC)]) == STREAM_MAGIC
+
+
+def stream_uses_raw_key(prefix):
+    """Return True if a segmented stream header says the raw data key was used."""
+    return is_stream_format(prefix) and bool(parse_stream_header(prefix).flags & FLAG_RAW_KEY)
+
+
+def stream_is_framed(prefix):
+    """Return True if a segmented stream header says the plaintext is compressed in frames."""
+    return is_stream_format(prefix) and bool(parse_stream_header(prefix).flags & FLAG_FRAMED)
+
+
+def parse_stream_header(data):
+    """Parse and validate the stream header at the start of ``data``."""
+    if len(data) < STREAM_PREFIX.size:
+        raise ValueError("Encrypted stream header is truncated.")
+    magic, version, flags = STREAM_PREFIX.unpack_from(data)
+    if magic != STREAM_MAGIC:
+        raise ValueError("Not a segmented encrypted stream.")
+    if version == 1:
+        layout = STREAM_HEADER_V1
+    elif version == 2:
+        layout = STREAM_HEADER_V2
+    else:
+        raise ValueError(f"Unsupported stream version {version}.")
+    if len(data) < layout.size:
+        raise ValueError("Encrypted stream header is truncated.")
+    fields = layout.unpack_from(data)
+    segment_size = fields[3]
+    if segment_size <= 0:
+        raise ValueError("Invalid segment size in stream header.")
+    key_id, nonce_prefix = fields[4:] if version == 2 else (None, None)
+    return StreamHeader(version, flags, segment_size, key_id, nonce_prefix, layout.size)
+
+
+def _record_size(header):
+    """Stored size of one full segment: its optional nonce, ciphertext and tag."""
+    return (NONCE_SIZE if header.version == 1 else 0) + header.segment_size + TAG_SIZE
+
+
+def stream_plaintext_size(header, stream_size):
+    """Plaintext size of a segmented stream of ``stream_size`` bytes, from its header alone."""
+    nonce_size = NONCE_SIZE if header.version == 1 else 0
+    full, last = divmod(stream_size - header.size, _record_size(header))
+    # Streams always end with a short final record, at least a tag long
+    if last < nonce_size + TAG_SIZE:
+        raise ValueError("Encrypted stream is truncated.")
+    return full * header.segment_size + last - nonce_size - TAG_SIZE
+
+
+def read_stream_header(reader):
+    """Read the stream header from a binary file object, returning (raw bytes, StreamHeader)."""
+    data = reader.read(STREAM_PREFIX.size)
+    if len(data) == STREAM_PREFIX.size and data[:len(STREAM_MAGIC)] == STREAM_MAGIC:
+        version = data[len(STREAM_MAGIC)]
+        if version == 1:
+            data += reader.read(STREAM_HEADER_V1.size - STREAM_PREFIX.size)
+        elif version == 2:
+            data += reader.read(STREAM_HEADER_V2.size - STREAM_PREFIX.size)
+    return data, parse_stream_header(data)
+
+
+def _segment_nonce(nonce_prefix, index):
+    """Per-segment GCM nonce for version 2 streams."""
+    return nonce_prefix + struct.pack(">I", index)
+
+
+def _segment_aad(header, index, final):
+    """Associated data binding a segment to its stream, position and finality."""
+    return bytes(header) + struct.pack(">QB", index, 1 if final else 0)
+
+
+def _read_full(reader, view):
+    """readinto() until ``view`` is full or the stream ends; return the bytes read."""
+    total = 0
+    while total < len(view):
+        count = reader.readinto(view[total:])
+        if not count:
+            break
+        total += count
+    return total
+
+
+def read_segments(reader, segment_size=SEGMENT_SIZE):
+    """Yield a binary file as views of one reused, segment-sized buffer.
+
+    Each view is only valid until the next one is requested.
+    """
+    view = memoryview(bytearray(segment_size))
+    while True:
+        length = _read_full(reader, view)
+        if not length:
+            return
+        yield view[:length]
+        if length < segment_size:
+            return
+
+
+def _resegment(chunks, segment_size):
+    """Regroup arbitrary byte chunks into full segments plus a short final one.
+
+    Chunks that already are exactly one segment are passed through without
+    copying, so readers that fill a reused buffer pay no extra copy.
+    """
+    buffer = bytearray()
+    for chunk in chunks:
+        if not buffer and len(chunk) == segment_size:
+            yield chunk
+            continue
+        buffer += chunk
+        while len(buffer) >= segment_size:
+            yield bytes(buffer[:segment_size])
+            del buffer[:segment_size]
+    yield bytes(buffer)
@@ -1,130 +1,583 @@
 # file_ops.py
+import errno
+import mmap
 import os
-import logging
-from encryption import AESEncryptor
+from logger import get_logger
+from block_store import BlockStore
+from compressor import (check_codec, choose_codec, compress_frames, decompress_chunks, decompress_frames,
+                        read_frame_index, read_frames)
+from encryption import (FLAG_FRAMED, AESEncryptor, BlockEncryptor, KeyCache, STREAM_HEADER_MAX_SIZE,
+                        is_stream_format, parse_stream_header, read_segments, stream_is_framed,
+                        stream_plaintext_size, stream_uses_raw_key)
 import base64
+import functools
+import secrets
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# Mapped pages are dropped every this many bytes during a zero-copy restore,
+# so RSS stays bounded however large the file is
+RELEASE_WINDOW = 8 * 1024 * 1024
 
 class FileManager:
-    def __init__(self, base_directory, db_manager, logger=None):
+    def __init__(self, base_directory, db_manager, logger=None, dedup=False, compression='auto', delta=False):
         self.base_directory = base_directory
         self.db_manager = db_manager
-        self.logger = logger or logging.getLogger("SecureFileStorage")
-
-    def _get_user_directory(self, username):
-        """Get or create a user-specific subdirectory."""
-        user_dir = os.path.join(self.base_directory, username)
-        if not os.path.exists(user_dir):
-            os.makedirs(user_dir)
-            self.logger.info(f"User directory created at {user_dir}")
-        return user_dir
-
-    def upload(self, username, source_path):
-        """Encrypt and upload a file."""
-        try:
-            # Ensure user tables exist
+        self.logger = get_logger('files', logger)
+        self.key_cache = KeyCache(logger=self.logger)
+        # Never held across a database read: a worker inside a transaction may be waiting for it
+        self._derive_lock = threading.Lock()
+        # New uploads go to the deduplicating block store; existing files are
+        # read from wherever their metadata says they live.
+        self.dedup = dedup
+        # New versions of existing files go to the block store, so re-uploads
+        # only encrypt and write the chunks that changed
+        self.delta = delta
+        self.block_store = BlockStore(base_directory, self.logger)
+        # Shard directories known to exist, so creating a file needs no stat
+        self._directories = set()
+        # 'auto' samples each upload to decide, 'none' disables compression
+        if compression != 'auto':
+            check_codec(compression)
+        self.compression = compression
+
+    def close(self):
+        """Release session state, zeroizing any cached keys."""
+        self.key_cache.clear()
+
+    def _get_encryptor(self, username, key_id, raw, key_row=None):
+        """Return an encryptor for one of the user's keys, deriving it at most once per session.
+
+        key_id is a key ID or a ('data', data_key_id) reference (see _key_ref).
+        key_row is an optional pre-fetched (aes_key, salt) pair; batch workers
+        pass it so they never touch the database connection themselves.
+        """
+        encryptor = self.key_cache.get(username, key_id, raw)
+        if encryptor is not None:
+            return encryptor
+
+        user_key, user_salt = key_row or self._load_key(username, key_id)
+        with self._derive_lock:
+            # Another worker may have derived the key while we waited
+            encryptor = self.key_cache.get(username, key_id, raw)
+            if encryptor is not None:
+                return encryptor
+
+            if raw:
+                encryptor = AESEncryptor.from_raw_key(user_key, self.logger)
+            else:
+                salt = base64.b64decode(user_salt) if isinstance(user_salt, str) else user_salt
+                encryptor = AESEncryptor(user_key, salt, None, self.logger)
+            self.key_cache.put(username, key_id, raw, encryptor)
+            return encryptor
+
+    def _get_block_encryptor(self, username, key_id, key_row=None):
+        """Return the block-store encryptor derived from one of the user's raw keys."""
+        encryptor = self._get_encryptor(username, key_id, raw=True, key_row=key_row)
+        with self._derive_lock:
+            block_encryptor = self.key_cache.get(username, key_id, 'blocks')
+            if block_encryptor is None:
+                block_encryptor = BlockEncryptor(encryptor)
+                self.key_cache.put(username, key_id, 'blocks', block_encryptor)
+            return block_encryptor
+
+    def _load_key(self, username, key_id):
+        """Fetch the (aes_key, salt) pair for key_id, or the newest key if key_id is None.
+
+        For a ('data', data_key_id) reference this is the unwrapped data key
+        and no salt; data keys are only ever used raw.
+        """
+        if isinstance(key_id, tuple):
+            return self._unwrap_data_key(username, key_id[1]), None
+        _, user_key, user_salt = self.db_manager.get_user_key(username, key_id)
+        if not user_key or not user_salt:
+            raise Exception(f"No encryption key or salt found for user '{username}'.")
+        return user_key, user_salt
+
+    def _unwrap_data_key(self, username, data_key_id):
+        """Unwrap one of the user's data keys with the key currently wrapping it."""
+        kek_id, wrapped_key = self.db_manager.get_data_key(username, data_key_id)
+        if wrapped_key is None:
+            raise Exception(f"No data key {data_key_id} found for user '{username}'.")
+        return self._get_encryptor(username, kek_id, raw=True).unwrap_key(wrapped_key, _wrap_context(username))
+
+    def _new_data_key(self):
+        """Return an encryptor for a fresh random data key; zeroize it once it is wrapped."""
+        user_key, _ = AESEncryptor.generate_key_and_salt()
+        return AESEncryptor.from_raw_key(user_key, self.logger)
+
+    def _wrap_data_keys(self, username, encryptors, wrapped=None):
+        """Wrap data keys with the user's current key, returning (key_id, wrapped_keys).
+
+        Call it before the transaction that stores them and again inside it with that result, which is only
+        wrapped again if another session rotated the key in between.
+        """
+        key_id = self.db_manager.get_current_key_id(username) if wrapped else None
+        if wrapped and wrapped[0] == key_id:
+            return wrapped
+        if key_id is None:
+            key_id = self._ensure_user_key(username)
+        kek = self._get_encryptor(username, key_id, raw=True)
+        context = _wrap_context(username)
+        return key_id, [kek.wrap_key(encryptor.key, context) for encryptor in encryptors]
+
+    def _block_key_ref(self, username):
+        """Return the reference of the data key the user's block store is sealed with, creating it on first use."""
+        data_key_id = self.db_manager.get_block_data_key_id(username)
+        if data_key_id is None:
+            encryptor = self._new_data_key()
+            try:
+                wrapped = self._wrap_data_keys(username, [encryptor])
+                with self.db_manager.transaction():
+                    key_id, (wrapped_key,) = self._wrap_data_keys(username, [encryptor], wrapped)
+                    data_key_id = self.db_manager.insert_block_data_key(username, key_id, wrapped_key)
+            finally:
+                encryptor.zeroize()
+        return ('data', data_key_id)
+
+    def _ensure_user_key(self, username):
+        """Make sure the user has tables and a data key, returning the current key ID."""
+        # A user with a key is registered already; once cached this costs no query
+        key_id = self.db_manager.get_user_key_id(username)
+        if key_id is not None:
+            return key_id
+        with self.db_manager.transaction():
             self.db_manager.initialize_user_tables(username)
-
-            # Get the user's AES key and salt or generate new ones
-            self.logger.info(f"Getting user key and salt for {username}")
-            user_key, user_salt = self.db_manager.get_user_key_and_salt(username)
-            self.logger.debug(f"User key and salt: {user_key}, {user_salt}")
-            if user_key is None or user_salt is None:
+            key_id = self.db_manager.get_user_key_id(username)
+            if key_id is None:
                 # Generate a new AES key and salt for the user
                 user_key, user_salt = AESEncryptor.generate_key_and_salt()
-                self.logger.debug(f"Generated new user key and salt: {user_key}, {user_salt}")
                 self.db_manager.insert_user_key_and_salt(username, user_key, user_salt)
-                self.logger.info(f"Inserted new user key and salt for {username}")
+                self.logger.info("Inserted new user key and salt for %s", username)
+                key_id = self.db_manager.get_user_key_id(username)
+        return key_id
+
+    def _new_file_path(self, username):
+        """Return a fresh path username/ab/cd/<random id>.enc, relative to the storage directory."""
+        file_id = secrets.token_hex(16)
+        return os.path.join(username, file_id[:2], file_id[2:4], f"{file_id}.enc")
+
+    def _resolve_path(self, encrypted_path):
+        """Return the absolute path of a stored encrypted_path; pre-layout rows hold absolute paths already."""
+        return os.path.join(self.base_directory, encrypted_path)
+
+    def _ensure_directory(self, directory):
+        """Create directory once per session; later calls are a set lookup."""
+        if directory not in self._directories:
+            os.makedirs(directory, exist_ok=True)
+            self._directories.add(directory)
+
+    def _encrypt_to(self, encryptor, source_path, target_path, key_id=None, codec='none'):
+        """Stream-compress and encrypt source_path into target_path, replacing it atomically.
+
+        Compressed files are written in independent frames, so ranges can be read without decompressing from the start.
+        """
+        temp_path = f"{target_path}.tmp"
+        try:
+            with open(source_path, 'rb') as src, open(temp_path, 'wb') as dst:
+                chunks, flags = read_segments(src), 0
+                if codec != 'none':
+                    chunks, flags = compress_frames(chunks, codec), FLAG_FRAMED
+                for record in encryptor.encrypt_stream(chunks, key_id=key_id, flags=flags):
+                    dst.write(record)
+            os.replace(temp_path, target_path)
+        except Exception:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    def _decrypt_to(self, get_encryptor, encrypted_path, output_path, codec='none'):
+        """Decrypt and decompress encrypted_path into output_path, streaming segmented files.
+
+        get_encryptor(raw) is called once the header shows which key the file was sealed with.
+        """
+        temp_path = f"{output_path}.tmp"
+        try:
+            with open(self._resolve_path(encrypted_path), 'rb') as src:
+                header = src.read(STREAM_HEADER_MAX_SIZE)
+                src.seek(0)
+                if is_stream_format(header) and codec == 'none':
+                    self._decrypt_mapped(get_encryptor(stream_uses_raw_key(header)), src, temp_path)
+                else:
+                    with open(temp_path, 'wb') as dst:
+                        if is_stream_format(header):
+                            encryptor = get_encryptor(stream_uses_raw_key(header))
+                            if stream_is_framed(header):
+                                index = _read_frame_index(encryptor, src, header)
+                                chunks = decompress_frames(encryptor.decrypt_stream(src), codec, index)
+                            else:
+                                chunks = decompress_chunks(encryptor.decrypt_stream(src), codec)
+                            for chunk in chunks:
+                                dst.write(chunk)
+                        else:
+                            dst.write(get_encryptor(False).decrypt_bytes(src.read()))
+            os.replace(temp_path, output_path)
+        except Exception:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
 
-            # Use this key and salt for encryption
-            salt = base64.b64decode(user_salt) if isinstance(user_salt, str) else user_salt
-            encryptor = AESEncryptor(user_key, salt, None, self.logger)
+    def _decrypt_mapped(self, encryptor, src, temp_path):
+        """Decrypt an uncompressed segmented file from a read-only mmap into an mmap of temp_path.
+
+        Finished pages are released every RELEASE_WINDOW bytes, so memory stays bounded.
+        """
+        with mmap.mmap(src.fileno(), 0, access=mmap.ACCESS_READ) as source, memoryview(source) as source_view:
+            size = stream_plaintext_size(parse_stream_header(source_view), len(source))
+            with open(temp_path, 'wb+') as dst:
+                _preallocate(dst.fileno(), size)
+                if not size:
+                    # Nothing to map, but the empty final segment's tag still has to verify
+                    for _ in encryptor.decrypt_stream_into(source_view, bytearray()):
+                        pass
+                    return
+                with mmap.mmap(dst.fileno(), size) as target, memoryview(target) as target_view:
+                    read_released = written_released = 0
+                    for read, written in encryptor.decrypt_stream_into(source_view, target_view):
+                        if written - written_released >= RELEASE_WINDOW:
+                            read_released = _release_pages(source, read_released, read)
+                            written_released = _release_pages(target, written_released, written)
+
+    def _upload_file(self, encryptor, source_path, target_path, key_id):
+        """Compress and encrypt one upload into its .enc file at the stored target_path, returning the codec used."""
+        codec = choose_codec(source_path, self.compression)
+        target_path = self._resolve_path(target_path)
+        self._ensure_directory(os.path.dirname(target_path))
+        self._encrypt_to(encryptor, source_path, target_path, key_id, codec)
+        return codec
+
+    def _upload_blocks(self, block_encryptor, source_path, known=None):
+        """Store one upload in the block store, returning (manifest, new_blocks, codec)."""
+        codec = choose_codec(source_path, self.compression)
+        manifest, new_blocks = self.block_store.store(block_encryptor, source_path, codec, known)
+        return manifest, new_blocks, codec
+
+    def _plan_version(self, username, filename, previous):
+        """Decide where the next version of filename goes: (use_blocks, target_path, known_blocks).
+
+        previous is the metadata row of the current version, or None.
+        """
+        if self.dedup or (self.delta and previous is not None):
+            known = self.db_manager.get_file_blocks(previous[0]) if previous and previous[8] == 'blocks' else None
+            return True, None, known
+        return False, self._new_file_path(username), None
+
+    def _commit_files(self, username, stored, wrapped=None):
+        """Record (filename, target_path, codec, encryptor) uploads in one transaction.
+
+        Each file's data key is wrapped under the user's current key, or taken from wrapped, then zeroized.
+        """
+        try:
+            encryptors = [encryptor for *_, encryptor in stored]
+            wrapped = wrapped or self._wrap_data_keys(username, encryptors)
+            with self.db_manager.transaction():
+                key_id, wrapped_keys = self._wrap_data_keys(username, encryptors, wrapped)
+                self.db_manager.insert_file_metadata_many(username, [
+                    (filename, target_path, key_id, codec, wrapped_key)
+                    for (filename, target_path, codec, _), wrapped_key in zip(stored, wrapped_keys)])
+        finally:
+            for *_, encryptor in stored:
+                encryptor.zeroize()
+
+    def _commit_manifests(self, username, key_id, block_key, block_encryptor, stored):
+        """Record (filename, source_path, manifest, codec) uploads in one transaction.
+
+        A file whose reused blocks a concurrent delete collected is stored again.
+        """
+        with self.db_manager.transaction():
+            for filename, _, manifest, codec in stored:
+                self.db_manager.insert_file_manifest(username, filename, key_id, manifest, codec, block_key[1])
+            for _, source_path, manifest, codec in stored:
+                if self.block_store.missing(dict.fromkeys(address for address, *_ in manifest)):
+                    self.block_store.store(block_encryptor, source_path, codec)
+
+    def _restore_blocks(self, block_encryptor, file_id, output_path, manifest=None):
+        """Reassemble a block-store file into output_path."""
+        manifest = manifest if manifest is not None else self.db_manager.get_file_chunks(file_id)
+        self.block_store.restore(block_encryptor, manifest, output_path)
+
+    def upload(self, username, source_path):
+        """Encrypt and upload a file."""
+        try:
+            # Ensure user tables exist and get the user's current key
+            self.logger.info("Getting user key for %s", username)
+            key_id = self._ensure_user_key(username)
 
-            user_dir = self._get_user_directory(username)
-            self.logger.debug(f"User directory: {user_dir}")
             filename = os.path.basename(source_path)
-            self.logger.debug(f"Filename: {filename}")
-            target_path = os.path.join(user_dir, f"{filename}.enc")
-            self.logger.debug(f"Target path: {target_path}")
+            self.logger.debug("Filename: %s", filename)
+            previous = self.db_manager.retrieve_file_metadata(username, filename)
+            use_blocks, target_path, known = self._plan_version(username, filename, previous)
+
+            if use_blocks:
+                block_key = self._block_key_ref(username)
+                block_encryptor = self._get_block_encryptor(username, block_key)
+                manifest, new_blocks, codec = self._upload_blocks(block_encryptor, source_path, known)
+                self._commit_manifests(username, key_id, block_key, block_encryptor,
+                                       [(filename, source_path, manifest, codec)])
+                self.logger.info("File '%s' uploaded to the block store (%s of %s chunks new).",
+                                 filename, new_blocks, len(manifest))
+                print(f"File '{filename}' uploaded and encrypted successfully.")
+                return
 
-            with open(source_path, 'rb') as file:
-                data = file.read()
+            self.logger.debug("Target path: %s", target_path)
 
-            encrypted_data = encryptor.encrypt(data.decode('utf-8'))
-            self.logger.debug(f"Encrypted data: {encrypted_data}")
-            with open(target_path, 'w') as file:
-                file.write(encrypted_data)
+            # Each file gets its own random data key, used directly without PBKDF2
+            encryptor = self._new_data_key()
+            try:
+                codec = self._upload_file(encryptor, source_path, target_path, key_id)
+            except Exception:
+                encryptor.zeroize()
+                raise
 
-            # Insert file metadata into the database
-            key_id = self.db_manager.get_user_key_id(username)
-            self.db_manager.insert_file_metadata(username, filename, target_path, key_id)
+            # Insert file metadata and the wrapped data key into the database
+            self._commit_files(username, [(filename, target_path, codec, encryptor)])
 
-            self.logger.info(f"File '{filename}' uploaded and encrypted successfully.")
+            self.logger.info("File '%s' uploaded and encrypted successfully.", filename)
             print(f"File '{filename}' uploaded and encrypted successfully.")
         except Exception as e:
-            self.logger.error(f"Error during file upload: {e}")
+            self.logger.error("Error during file upload: %s", e)
             raise
 
-    def download(self, username, filename):
-        """Decrypt and download a file."""
+    def download(self, username, filename, version=None):
+        """Decrypt and download a file, or an older version of it."""
         try:
             # Retrieve file metadata
-            file_metadata = self.db_manager.retrieve_file_metadata(username, filename)
+            file_metadata = self.db_manager.retrieve_file_metadata(username, filename, version)
 
             if not file_metadata:
                 print(f"File '{filename}' not found or deleted.")
-                self.logger.warning(f"File '{filename}' not found or deleted.")
+                self.logger.warning("File '%s' not found or deleted.", filename)
                 return
 
             encrypted_path = file_metadata[2]
 
-            # Retrieve user's AES key and salt from the database
-            user_key, user_salt = self.db_manager.get_user_key_and_salt(username)
-            if not user_key or not user_salt:
-                raise Exception(f"No encryption key or salt found for user '{username}'.")
+            key_id = _key_ref(file_metadata)
+
+            output_path = os.path.join(os.getcwd(), filename)
+            if file_metadata[8] == 'blocks':
+                self._restore_blocks(self._get_block_encryptor(username, key_id), file_metadata[0], output_path)
+            else:
+                self._decrypt_to(functools.partial(self._get_encryptor, username, key_id), encrypted_path,
+                                 output_path, file_metadata[9])
 
-            encryptor = AESEncryptor(user_key, base64.b64decode(user_salt.encode()), None, self.logger)
+            self.db_manager.update_download_date(username, filename, file_metadata[0])
+            self.logger.info("File '%s' decrypted and downloaded successfully.", filename)
+            print(f"File '{filename}' decrypted and downloaded successfully to {output_path}.")
+        except Exception as e:
+            self.logger.error("Error during file download: %s", e)
+            raise
 
-            with open(encrypted_path, 'r') as file:
-                encrypted_data = file.read()
+    def read_range(self, username, filename, offset, length, version=None):
+        """Return up to length bytes of a stored file starting at offset, or None if it does not exist.
 
-            decrypted_data = encryptor.decrypt(encrypted_data)
-            output_path = os.path.join(os.getcwd(), filename)
+        Only the segments, frames or blocks the range spans are read and authenticated.
+        """
+        if offset < 0 or length < 0:
+            raise ValueError("Offset and length must not be negative.")
+        try:
+            file_metadata = self.db_manager.retrieve_file_metadata(username, filename, version)
+            if not file_metadata:
+                self.logger.warning("File '%s' not found or deleted.", filename)
+                return None
+            return self._read_range(username, file_metadata, offset, length)
+        except Exception as e:
+            self.logger.error("Error reading range of '%s': %s", filename, e)
+            raise
+
+    def _read_range(self, username, file_metadata, offset, length, key_row=None, manifest=None):
+        """Decrypt a range of the file described by file_metadata.
+
+        key_row and, for block-store files, the manifest can be passed in
+        pre-fetched, in which case the database is not touched.
+        """
+        key_id = _key_ref(file_metadata)
+        if file_metadata[8] == 'blocks':
+            manifest = manifest if manifest is not None else self.db_manager.get_file_chunks(file_metadata[0])
+            # Only the blocks overlapping the range, and where the first one starts
+            selected, start, position = [], offset, 0
+            for address, chunk_length, codec in manifest:
+                if position + chunk_length > offset and position < offset + length:
+                    start = min(start, position)
+                    selected.append((address, chunk_length, codec))
+                position += chunk_length
+            block_encryptor = self._get_block_encryptor(username, key_id, key_row=key_row)
+            return _slice_chunks(self.block_store.read_chunks(block_encryptor, selected), offset - start, length)
+
+        with open(self._resolve_path(file_metadata[2]), 'rb') as src:
+            header = src.read(STREAM_HEADER_MAX_SIZE)
+            src.seek(0)
+            if not is_stream_format(header):
+                encryptor = self._get_encryptor(username, key_id, False, key_row=key_row)
+                return encryptor.decrypt_bytes(src.read())[offset:offset + length]
+            encryptor = self._get_encryptor(username, key_id, stream_uses_raw_key(header), key_row=key_row)
+            if file_metadata[9] == 'none':
+                return encryptor.decrypt_range(src, offset, length)
+            if stream_is_framed(header):
+                index = _read_frame_index(encryptor, src, header)
+                return read_frames(_range_reader(encryptor, src), file_metadata[9], index, offset, length)
+            return _slice_chunks(decompress_chunks(encryptor.decrypt_stream(src), file_metadata[9]), offset, length)
+
+    def upload_many(self, username, source_paths, jobs=None, progress=None):
+        """Encrypt and upload several files in parallel, writing all metadata in one transaction.
+
+        progress(done, total, path) is called per file. Returns (succeeded, failed) with failed as (path, error) tuples.
+        """
+        encryptors = {}
+        try:
+            key_id = self._ensure_user_key(username)
+            block_key = block_encryptor = None
+
+            # plans maps each source path to its _plan_version() decision; seen maps
+            # stored names to the file they come from, so a path given twice is uploaded once
+            succeeded, failed, plans, seen = [], [], {}, {}
+            for source_path in source_paths:
+                filename = os.path.basename(source_path)
+                if filename in seen:
+                    if seen[filename] != os.path.abspath(source_path):
+                        failed.append((source_path, "duplicate file name in batch"))
+                    continue
+                seen[filename] = os.path.abspath(source_path)
+                previous = self.db_manager.retrieve_file_metadata(username, filename)
+                plans[source_path] = self._plan_version(username, filename, previous)
+                if plans[source_path][0] and block_encryptor is None:
+                    block_key = self._block_key_ref(username)
+                    block_encryptor = self._get_block_encryptor(username, block_key)
+
+            total = len(plans) + len(failed)
+            done = len(failed)
+            # Each .enc file gets its own data key
+            encryptors = {path: self._new_data_key() for path, plan in plans.items() if not plan[0]}
+            with ThreadPoolExecutor(max_workers=jobs or os.cpu_count()) as pool:
+                futures = {}
+                for path, (use_blocks, target, known) in plans.items():
+                    if use_blocks:
+                        futures[pool.submit(self._upload_blocks, block_encryptor, path, known)] = path
+                    else:
+                        futures[pool.submit(self._upload_file, encryptors[path], path, target, key_id)] = path
+                results = {}
+                for future in as_completed(futures):
+                    path = futures[future]
+                    try:
+                        results[path] = future.result()
+                        succeeded.append(path)
+                    except Exception as e:
+                        self.logger.error("Error uploading '%s': %s", path, e)
+                        failed.append((path, str(e)))
+                    done += 1
+                    if progress:
+                        progress(done, total, path)
+
+            stored = [(os.path.basename(path), plans[path][1], results[path], encryptors[path])
+                      for path in succeeded if not plans[path][0]]
+            # Wrapped before the transaction, which would otherwise hold the writer lock while deriving keys
+            wrapped = self._wrap_data_keys(username, [encryptor for *_, encryptor in stored])
+            with self.db_manager.transaction():
+                self._commit_manifests(username, key_id, block_key, block_encryptor,
+                                       [(os.path.basename(path), path, results[path][0], results[path][2])
+                                        for path in succeeded if plans[path][0]])
+                self._commit_files(username, stored, wrapped)
+            self.logger.info("Batch upload for '%s': %s succeeded, %s failed.", username, len(succeeded), len(failed))
+            return succeeded, failed
+        except Exception as e:
+            self.logger.error("Error during batch upload: %s", e)
+            raise
+        finally:
+            for encryptor in encryptors.values():
+                encryptor.zeroize()
 
-            with open(output_path, 'w') as file:
-                file.write(decrypted_data)
+    def download_many(self, username, filenames, jobs=None, progress=None, output_dir=None, version=None):
+        """Decrypt and download several files, or the given version of each, in parallel.
 
-            self.db_manager.update_download_date(username, filename)
-            self.logger.info(f"File '{filename}' decrypted and downloaded successfully.")
-            print(f"File '{filename}' decrypted and downloaded successfully to {output_path}.")
+        Download dates are recorded in one transaction at the end. Returns (succeeded, failed) like upload_many().
+        """
+        try:
+            output_dir = output_dir or os.getcwd()
+            succeeded, failed, work, key_rows, file_ids = [], [], {}, {}, {}
+            for filename in dict.fromkeys(filenames):
+                file_metadata = self.db_manager.retrieve_file_metadata(username, filename, version)
+                if not file_metadata:
+                    failed.append((filename, "not found or deleted"))
+                    continue
+                file_ids[filename] = file_metadata[0]
+                key_id = _key_ref(file_metadata)
+                if key_id not in key_rows:
+                    key_rows[key_id] = self._load_key(username, key_id)
+                output_path = os.path.join(output_dir, filename)
+                if file_metadata[8] == 'blocks':
+                    block_encryptor = self._get_block_encryptor(username, key_id, key_row=key_rows[key_id])
+                    manifest = self.db_manager.get_file_chunks(file_metadata[0])
+                    work[filename] = (self._restore_blocks, block_encryptor, file_metadata[0], output_path, manifest)
+                else:
+                    get_encryptor = functools.partial(self._get_encryptor, username, key_id,
+                                                      key_row=key_rows[key_id])
+                    work[filename] = (self._decrypt_to, get_encryptor, file_metadata[2], output_path, file_metadata[9])
+
+            total = len(work) + len(failed)
+            done = len(failed)
+            with ThreadPoolExecutor(max_workers=jobs or os.cpu_count()) as pool:
+                futures = {pool.submit(*task): filename for filename, task in work.items()}
+                for future in as_completed(futures):
+                    filename = futures[future]
+                    try:
+                        future.result()
+                        succeeded.append(filename)
+                    except Exception as e:
+                        self.logger.error("Error downloading '%s': %s", filename, e)
+                        failed.append((filename, str(e)))
+                    done += 1
+                    if progress:
+                        progress(done, total, filename)
+
+            self.db_manager.update_download_dates(username, succeeded, [file_ids[name] for name in succeeded])
+            self.logger.info("Batch download for '%s': %s succeeded, %s failed.", username, len(succeeded), len(failed))
+            return succeeded, failed
         except Exception as e:
-            self.logger.error(f"Error during file download: {e}")
+            self.logger.error("Error during batch download: %s", e)
             raise
 
     def delete(self, username, filename):
-        """Delete an encrypted file."""
+        """Delete an encrypted file and all its versions, returning True if it was deleted."""
         try:
             # Retrieve file metadata
             file_metadata = self.db_manager.retrieve_file_metadata(username, filename)
 
             if not file_metadata:
                 print(f"File '{filename}' not found.")
-                self.logger.warning(f"File '{filename}' not found.")
-                return
+                self.logger.warning("File '%s' not found.", filename)
+                return False
 
-            encrypted_path = file_metadata[2]
+            if file_metadata[8] == 'file' and not os.path.exists(self._resolve_path(file_metadata[2])):
+                self.logger.warning("File '%s' not found on disk.", filename)
+                print(f"File '{filename}' not found on disk.")
+                return False
 
-            if os.path.exists(encrypted_path):
-                os.remove(encrypted_path)
-                self.db_manager.mark_file_deleted(username, filename)
-                self.logger.info(f"File '{filename}' deleted successfully.")
-                print(f"File '{filename}' deleted successfully.")
+            versions = self.db_manager.list_file_versions(username, filename)
+            if any(version['storage'] == 'blocks' for version in versions):
+                self._delete_blocks(username, filename)
             else:
-                self.logger.warning(f"File '{filename}' not found on disk.")
-                print(f"File '{filename}' not found on disk.")
+                self.db_manager.mark_file_deleted(username, filename)
+            for version in versions:
+                if version['storage'] == 'file' and os.path.exists(self._resolve_path(version['encrypted_path'])):
+                    os.remove(self._resolve_path(version['encrypted_path']))
+            self.logger.info("File '%s' deleted successfully (%s versions).", filename, len(versions))
+            print(f"File '{filename}' deleted successfully.")
+            return True
         except Exception as e:
-            self.logger.error(f"Error during file deletion: {e}")
+            self.logger.error("Error during file deletion: %s", e)
             raise
 
+    def _delete_blocks(self, username, filename):
+        """Delete a block-store file and garbage collect the blocks nothing else references."""
+        # Unlinking happens under the writer lock and after the commit, so an
+        # upload can neither re-reference a block mid-collection nor be left
+        # pointing at one whose removal was rolled back.
+        with self.db_manager.pool.write_lock:
+            with self.db_manager.transaction():
+                orphaned = self.db_manager.release_file_chunks(username, filename)
+                self.db_manager.mark_file_deleted(username, filename)
+            self.db_manager.flush()
+            self.block_store.remove(orphaned)
+
     def list_files(self, username):
         """List all files and their metadata for the user."""
         try:
@@ -138,47 +591,117 @@ class FileManager:
                     print(f"  Last Downloaded: {file['download_date'] or 'Never'}")
                     print(f"  Shared With: {file['shared_user'] or 'Not shared'}")
                     print("--------------------")
-                self.logger.info(f"Listed files for user '{username}'.")
+                self.logger.info("Listed files for user '%s'.", username)
             else:
                 print(f"No files found for user '{username}'.")
-                self.logger.info(f"No files found for user '{username}'.")
+                self.logger.info("No files found for user '%s'.", username)
         except Exception as e:
-            self.logger.error(f"Error during listing files: {e}")
+            self.logger.error("Error during listing files: %s", e)
             e = 'Error during listing files, please contact the admin.'
             raise
 
+    def rotate_key(self, username):
+        """Replace the user's key with a new one by rewrapping the data keys in use, returning the new key ID.
+
+        Older keys are kept while files encrypted with them directly still need them.
+        """
+        try:
+            new_key, new_salt = AESEncryptor.generate_key_and_salt()
+            new_encryptor = AESEncryptor.from_raw_key(new_key, self.logger)
+            context = _wrap_context(username)
+            try:
+                with self.db_manager.transaction():
+                    rewrapped = []
+                    for data_key_id, kek_id, wrapped_key in self.db_manager.list_data_keys(username):
+                        data_key = self._get_encryptor(username, kek_id, raw=True).unwrap_key(wrapped_key, context)
+                        rewrapped.append((data_key_id, new_encryptor.wrap_key(data_key, context)))
+                    key_id, retired = self.db_manager.rotate_user_key(username, new_key, new_salt, rewrapped)
+            finally:
+                new_encryptor.zeroize()
+            for retired_id in retired:
+                self.key_cache.discard(username, retired_id)
+            self.logger.info("Key for '%s' rotated: %s data keys re-wrapped.", username, len(rewrapped))
+            print(f"Key for '{username}' rotated: {len(rewrapped)} file keys re-wrapped.")
+            return key_id
+        except Exception as e:
+            self.logger.error("Error rotating key for '%s': %s", username, e)
+            raise
+
+    def list_versions(self, username, filename):
+        """List the stored versions of a file, newest first, returning them."""
+        try:
+            versions = self.db_manager.list_file_versions(username, filename)
+            if versions:
+                print(f"Versions of '{filename}':")
+                for version in versions:
+                    current = '' if version['superseded_at'] else ' (current)'
+                    print(f"Version {version['version']}{current}")
+                    print(f"  Uploaded At: {version['uploaded_at']}")
+                    print(f"  Last Downloaded: {version['download_date'] or 'Never'}")
+                    print("--------------------")
+                self.logger.info("Listed %s versions of '%s'.", len(versions), filename)
+            else:
+                print(f"File '{filename}' not found.")
+                self.logger.info("No versions found for '%s'.", filename)
+            return versions
+        except Exception as e:
+            self.logger.error("Error listing versions of '%s': %s", filename, e)
+            raise
+
     def share(self, username, filename, shared_users):
-        """Share a file with other users."""
+        """Share a file with other users, returning False if it does not exist."""
         try:
             # Validate that the file exists
             file_metadata = self.db_manager.retrieve_file_metadata(username, filename)
             if not file_metadata:
                 print(f"File '{filename}' not found.")
-                self.logger.warning(f"File '{filename}' not found.")
-                return
+                self.logger.warning("File '%s' not found.", filename)
+                return False
 
             # Update the shared users in the database
             self.db_manager.update_shared_users(username, filename, shared_users)
-            self.logger.info(f"File '{filename}' shared with: {', '.join(shared_users)}")
+            self.logger.info("File '%s' shared with: %s", filename, ', '.join(shared_users))
+            return True
         except Exception as e:
-            self.logger.error(f"Error during file sharing: {e}")
+            self.logger.error("Error during file sharing: %s", e)
             raise
 
     def unshare_all(self, username, filename):
-        """Remove all sharing for a file."""
+        """Remove all sharing for a file, returning False if it does not exist."""
         try:
             # Validate that the file exists
             file_metadata = self.db_manager.retrieve_file_metadata(username, filename)
             if not file_metadata:
                 print(f"File '{filename}' not found.")
-                self.logger.warning(f"File '{filename}' not found.")
-                return
+                self.logger.warning("File '%s' not found.", filename)
+                return False
+
+            # Revoke every grant on the file
+            self.db_manager.remove_all_shares(username, filename)
+            self.logger.info("File '%s' is no longer shared with anyone.", filename)
+            return True
+        except Exception as e:
+            self.logger.error("Error during file unsharing: %s", e)
+            raise
 
-            # Update the shared users to an empty list in the database
-            self.db_manager.update_shared_users(username, filename, [])
-            self.logger.info(f"File '{filename}' is no longer shared with anyone.")
+    def list_shared_with_me(self, username):
+        """List the files other users have shared with this user."""
+        try:
+            files = self.db_manager.list_shared_with_me(username)
+
+            if files:
+                print(f"Files shared with '{username}':")
+                for file in files:
+                    print(f"File Name: {file['file_name']}")
+                    print(f"  Owner: {file['owner']}")
+                    print(f"  Uploaded At: {file['uploaded_at']}")
+                    print("--------------------")
+                self.logger.info("Listed files shared with '%s'.", username)
+            else:
+                print(f"No files have been shared with '{username}'.")
+                self.logger.info("No files shared with '%s'.", username)
         except Exception as e:
-            self.logger.error(f"Error during file unsharing: {e}")
+            self.logger.error("Error listing shared files: %s", e)
             raise
 
     def download_shared_file(self, owner_username, filename, requesting_username):
@@ -189,29 +712,87 @@ class FileManager:
 
             if not file_metadata:
                 print(f"File '{filename}' not found or not shared with you.")
-                self.logger.warning(f"File '{filename}' not found or not shared with user '{requesting_username}'.")
+                self.logger.warning("File '%s' not found or not shared with user '%s'.", filename, requesting_username)
                 return
 
             encrypted_path = file_metadata[2]
 
-            # Retrieve owner's AES key and salt from the database
-            user_key, user_salt = self.db_manager.get_user_key_and_salt(owner_username)
-            if not user_key or not user_salt:
-                raise Exception(f"No encryption key or salt found for user '{owner_username}'.")
-
-            encryptor = AESEncryptor(user_key, base64.b64decode(user_salt.encode()), None, self.logger)
-
-            with open(encrypted_path, 'r') as file:
-                encrypted_data = file.read()
+            key_id = _key_ref(file_metadata)
 
-            decrypted_data = encryptor.decrypt(encrypted_data)
+            # The file is sealed with the owner's key
             output_path = os.path.join(os.getcwd(), filename)
+            if file_metadata[8] == 'blocks':
+                self._restore_blocks(self._get_block_encryptor(owner_username, key_id), file_metadata[0],
+                                     output_path)
+            else:
+                self._decrypt_to(functools.partial(self._get_encryptor, owner_username, key_id), encrypted_path,
+                                 output_path, file_metadata[9])
 
-            with open(output_path, 'w') as file:
-                file.write(decrypted_data)
-
-            self.logger.info(f"Shared file '{filename}' decrypted and downloaded successfully.")
+            self.logger.info("Shared file '%s' decrypted and downloaded successfully.", filename)
             print(f"Shared file '{filename}' decrypted and downloaded successfully to {output_path}.")
         except Exception as e:
-            self.logger.error(f"Error during shared file download: {e}")
+            self.logger.error("Error during shared file download: %s", e)
             raise
+
+
+def _key_ref(file_metadata):
+    """Return the key a file is sealed with: ('data', data_key_id) for a wrapped data key, else its key ID."""
+    return ('data', file_metadata[11]) if file_metadata[11] is not None else file_metadata[3]
+
+def _range_reader(encryptor, src):
+    """Return read_at(offset, length) decrypting that plaintext range of the stream in src."""
+    def read_at(offset, length):
+        src.seek(0)
+        return encryptor.decrypt_range(src, offset, length)
+    return read_at
+
+def _read_frame_index(encryptor, src, header):
+    """Read the frame index of a framed stream, leaving src at its start."""
+    size = stream_plaintext_size(parse_stream_header(header), os.fstat(src.fileno()).st_size)
+    index = read_frame_index(_range_reader(encryptor, src), size)
+    src.seek(0)
+    return index
+
+def _wrap_context(username):
+    """Authenticated context binding a wrapped data key to its owner."""
+    return f"gicsfs data key:{username}".encode()
+
+def _slice_chunks(chunks, offset, length):
+    """Collect bytes [offset, offset + length) of a chunk stream, stopping as soon as the range is complete."""
+    if not length:
+        return b''
+    output, position = bytearray(), 0
+    for chunk in chunks:
+        if position + len(chunk) > offset:
+            output += chunk[max(0, offset - position):offset + length - position]
+            if len(output) >= length:
+                break
+        position += len(chunk)
+    return bytes(output)
+
+
+def _preallocate(fd, size):
+    """Reserve size bytes for fd up front; writing a sparse mmap on a full disk raises SIGBUS instead of an error."""
+    if size and hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(fd, 0, size)
+            return
+        except OSError as e:
+            # Filesystems without fallocate support fall back to a sparse file
+            if e.errno not in (errno.EINVAL, errno.EOPNOTSUPP):
+                raise
+    os.ftruncate(fd, size)
+
+
+def _release_pages(mapping, start, end):
+    """Drop the mapped pages in [start, end) from this process, returning the page-aligned end released.
+
+    For file-backed shared mappings this only unmaps the pages: their contents,
+    dirty or not, stay in the page cache.
+    """
+    end -= end % mmap.ALLOCATIONGRANULARITY
+    if end <= start:
+        return start
+    if hasattr(mmap, 'MADV_DONTNEED'):
+        mapping.madvise(mmap.MADV_DONTNEED, start, end - start)
+    return end
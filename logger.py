@@ -1,12 +1,84 @@
 # logger.py
+import atexit
 import logging
+import os
+import queue
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+LOGGER_NAME = "SecureFileStorage"
+
+# Environment variables read by Logger: a global level, and per-component
+# overrides such as "crypto=WARNING,db=DEBUG".
+LOG_LEVEL_ENV = "GICSFS_LOG_LEVEL"
+MODULE_LEVELS_ENV = "GICSFS_LOG_LEVELS"
+
+def get_logger(component, logger=None):
+    """
+    Return the logger for one component, e.g. SecureFileStorage.crypto, under the top-level logger of logger.
+    """
+    root_name = logger.name.split('.')[0] if logger is not None else LOGGER_NAME
+    return logging.getLogger(f"{root_name}.{component}")
+
+class Summary:
+    """
+    Size-capped, lazily rendered description of a payload for log messages.
+
+    Only the length and a short prefix are ever formatted, and only if the
+    record is actually emitted.
+    """
+    __slots__ = ('data', 'limit')
+
+    def __init__(self, data, limit=8):
+        self.data = data
+        self.limit = limit
+
+    def __str__(self):
+        prefix = self.data[:self.limit]
+        if isinstance(prefix, str):
+            return f"<{len(self.data)} chars {prefix!r}...>"
+        return f"<{len(self.data)} bytes {bytes(prefix).hex()}...>"
+
+def parse_module_levels(spec):
+    """Parse "component=LEVEL,..." into a {component: level} dict, skipping bad entries."""
+    levels = {}
+    for entry in (spec or '').split(','):
+        component, _, level = entry.partition('=')
+        level = level.strip().upper()
+        if component.strip() and isinstance(logging.getLevelName(level), int):
+            levels[component.strip()] = level
+    return levels
 
 class Logger:
-    def __init__(self, log_file):
-        self.logger = logging.getLogger("SecureFileStorage")
-        self.logger.setLevel(logging.INFO)
-        fh = logging.FileHandler(log_file)
-        fh.setLevel(logging.INFO)
+    def __init__(self, log_file, level=None, module_levels=None, max_bytes=10 * 1024 * 1024, backup_count=5):
+        """
+        Log to a rotating file from a QueueListener thread, so callers never block on file I/O.
+
+        :param level: level of the top-level logger; defaults to $GICSFS_LOG_LEVEL or INFO
+        :param module_levels: {component: level} overrides, merged over $GICSFS_LOG_LEVELS
+        """
+        self.logger = logging.getLogger(LOGGER_NAME)
+        self.logger.setLevel(level or os.environ.get(LOG_LEVEL_ENV, 'INFO').upper())
+        levels = parse_module_levels(os.environ.get(MODULE_LEVELS_ENV))
+        levels.update(module_levels or {})
+        for component, component_level in levels.items():
+            get_logger(component).setLevel(component_level)
+
+        self.listener = None
+        if any(isinstance(handler, QueueHandler) for handler in self.logger.handlers):
+            return  # Already set up in this process
+
+        fh = RotatingFileHandler(log_file, maxBytes=max_bytes, backupCount=backup_count)
         formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
         fh.setFormatter(formatter)
-        self.logger.addHandler(fh)
+
+        log_queue = queue.SimpleQueue()
+        self.logger.addHandler(QueueHandler(log_queue))
+        self.listener = QueueListener(log_queue, fh, respect_handler_level=True)
+        self.listener.start()
+        atexit.register(self.close)
+
+    def close(self):
+        """Write out queued records and stop the background writer."""
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
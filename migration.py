@@ -0,0 +1,241 @@
+# migration.py
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from logger import get_logger
+from encryption import (FLAG_FRAMED, STREAM_HEADER_MAX_SIZE, is_stream_format, parse_stream_header, read_segments,
+                        stream_uses_raw_key)
+
+# Files handled per batch; the checkpoint is saved after each one
+BATCH_SIZE = 64
+
+class RateLimiter:
+    """Token bucket capping a shared rate, e.g. bytes per second, across threads; None or 0 means unlimited."""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or rate
+        self._tokens = self.burst
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, amount):
+        if not self.rate:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate) - amount
+            self._last = now
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+class BatchJob:
+    """Walk every stored .enc file on a thread pool in checkpointed batches, under a rate and CPU budget.
+
+    _process() returns the path a row no longer uses, '' if there was nothing to do, or None on failure.
+    """
+
+    job = None
+    # Only visit files encrypted directly with a user key
+    legacy_only = False
+    # Also visit block-store files
+    include_blocks = False
+
+    def __init__(self, file_manager, jobs=None, rate_limit=None, cpu_share=1.0, batch_size=BATCH_SIZE, logger=None):
+        """
+        :param jobs: worker threads, defaults to the CPU count
+        :param rate_limit: bytes per second of disk I/O across all workers, unlimited if None
+        :param cpu_share: fraction (0, 1] of the time each worker may be busy
+        """
+        if not 0 < cpu_share <= 1:
+            raise ValueError("cpu_share must be in (0, 1].")
+        self.file_manager = file_manager
+        self.db_manager = file_manager.db_manager
+        self.logger = get_logger('migration', logger or file_manager.logger)
+        self.jobs = jobs or os.cpu_count()
+        self.limiter = RateLimiter(rate_limit)
+        self.cpu_share = cpu_share
+        self.batch_size = batch_size
+
+    def run(self, restart=False, progress=None, stop=None):
+        """Process files until none are left or stop (a threading.Event) is set.
+
+        progress(processed, failed, position) is called after every batch.
+        Returns a dict with the processed and failed counts and the last file ID handled.
+        """
+        if restart:
+            self.db_manager.clear_checkpoint(self.job)
+        position, processed, failed = self.db_manager.get_checkpoint(self.job)
+        if position:
+            self.logger.info("Resuming %s after file %s (%s done, %s failed).", self.job, position, processed,
+                             failed)
+        # Left over by an interrupted run
+        self._purge()
+        try:
+            with ThreadPoolExecutor(max_workers=self.jobs, thread_name_prefix=f'gicsfs-{self.job}') as pool:
+                while not (stop and stop.is_set()):
+                    rows = self.db_manager.list_stored_files(position, self.batch_size,
+                                                             legacy_only=self.legacy_only,
+                                                             include_blocks=self.include_blocks)
+                    if not rows:
+                        break
+                    outcomes = list(pool.map(self._run_one, rows))
+                    previous, position = position, rows[-1][0]
+                    processed += sum(1 for outcome in outcomes if outcome is not None)
+                    failed += sum(1 for outcome in outcomes if outcome is None)
+                    self.db_manager.save_checkpoint(self.job, position, processed, failed)
+                    # Files retired by earlier batches; this batch's wait for the next one
+                    self._purge(previous)
+                    if progress:
+                        progress(processed, failed, position)
+        finally:
+            try:
+                self._purge()
+            except Exception as e:
+                self.logger.warning("Could not remove retired files of %s; the next run will: %s", self.job, e)
+        self.logger.info("%s stopped after file %s: %s processed, %s failed.", self.job, position, processed, failed)
+        return {'processed': processed, 'failed': failed, 'position': position}
+
+    def _run_one(self, row):
+        busy = time.thread_time()
+        try:
+            return self._process(row)
+        finally:
+            if self.cpu_share < 1:
+                time.sleep((time.thread_time() - busy) * (1 / self.cpu_share - 1))
+
+    def _process(self, row):
+        raise NotImplementedError
+
+    def _new_path(self, owner):
+        """Allocate a sharded path for a new copy of one of owner's files, returning (stored, absolute)."""
+        files = self.file_manager
+        new_path = files._new_file_path(owner)
+        absolute = files._resolve_path(new_path)
+        files._ensure_directory(os.path.dirname(absolute))
+        return new_path, absolute
+
+    def _throttled(self, chunks, passes=2):
+        """Yield chunks, charging the rate limit passes bytes of disk I/O per byte: a read and a write by default."""
+        for chunk in chunks:
+            self.limiter.consume(passes * len(chunk))
+            yield chunk
+
+    @staticmethod
+    def _row_key(row):
+        """The key reference of a list_stored_files() row, as _key_ref() gives for a metadata row."""
+        _, _, _, _, key_id, data_key_id, *_ = row
+        return ('data', data_key_id) if data_key_id is not None else key_id
+
+    def _purge(self, up_to=None):
+        """Delete the files and data keys retired by this job, from rows up to up_to if given.
+
+        A file is kept while another live row still names it, e.g. a version sharing it.
+        """
+        retired = self.db_manager.list_retired_files(self.job, up_to)
+        if not retired:
+            return
+        referenced = self.db_manager.referenced_paths(path for _, path in retired)
+        for retired_id, path in retired:
+            if path not in referenced:
+                try:
+                    os.remove(self.file_manager._resolve_path(path))
+                except FileNotFoundError:
+                    pass
+            self.db_manager.release_retired_file(retired_id)
+
+    @staticmethod
+    def _discard(path):
+        if os.path.exists(path):
+            os.remove(path)
+
+class Migrator(BatchJob):
+    """Re-encrypt legacy .enc files, or every one with reencrypt_all, under new data keys at new sharded paths."""
+
+    def __init__(self, file_manager, jobs=None, rate_limit=None, cpu_share=1.0, reencrypt_all=False,
+                 batch_size=BATCH_SIZE, logger=None):
+        super().__init__(file_manager, jobs, rate_limit, cpu_share, batch_size, logger)
+        self.reencrypt_all = reencrypt_all
+        self.legacy_only = not reencrypt_all
+        self.job = 'reencrypt-all' if reencrypt_all else 'reencrypt'
+
+    def _process(self, row):
+        """Re-encrypt one file, returning the old path to remove, '' if skipped, or None on failure."""
+        file_id, owner, file_name, path, *_ = row
+        files = self.file_manager
+        new_path, absolute = self._new_path(owner)
+        encryptor = files._new_data_key()
+        try:
+            self._reencrypt(owner, self._row_key(row), files._resolve_path(path), absolute, encryptor)
+            # Wrapped first, so the writer lock is never held while waiting to derive a key
+            wrapped = files._wrap_data_keys(owner, [encryptor])
+            with self.db_manager.transaction():
+                key_id, (wrapped_key,) = files._wrap_data_keys(owner, [encryptor], wrapped)
+                swapped = self.db_manager.replace_file_encryption(file_id, path, new_path, key_id, wrapped_key,
+                                                                   self.job)
+            if not swapped:
+                # Deleted or replaced meanwhile; the row no longer needs this copy
+                os.remove(absolute)
+                return ''
+            self.logger.info("Re-encrypted file %s ('%s' of %s).", file_id, file_name, owner)
+            return path
+        except Exception as e:
+            self.logger.error("Error re-encrypting file %s ('%s' of %s): %s", file_id, file_name, owner, e)
+            self._discard(absolute)
+            return None
+        finally:
+            encryptor.zeroize()
+
+    def _reencrypt(self, owner, key_ref, path, new_path, encryptor):
+        """Stream path through decryption and re-encryption under encryptor into new_path."""
+        files = self.file_manager
+        with open(path, 'rb') as src, open(new_path, 'wb') as dst:
+            header = src.read(STREAM_HEADER_MAX_SIZE)
+            src.seek(0)
+            flags = 0
+            if is_stream_format(header):
+                chunks = files._get_encryptor(owner, key_ref, stream_uses_raw_key(header)).decrypt_stream(src)
+                flags = parse_stream_header(header).flags & FLAG_FRAMED
+            else:
+                # Legacy base64 blobs are decrypted whole, as downloads do
+                chunks = [files._get_encryptor(owner, key_ref, False).decrypt_bytes(src.read())]
+            # The stored payload, compressed or not, is carried over as-is
+            for record in encryptor.encrypt_stream(self._throttled(chunks), flags=flags):
+                dst.write(record)
+            dst.flush()
+            os.fsync(dst.fileno())
+
+class Relayout(BatchJob):
+    """Move .enc files stored at absolute paths into the sharded layout by hard link or copy, without decrypting."""
+
+    job = 'relayout'
+
+    def _process(self, row):
+        """Move one file, returning the old path to remove, '' if skipped, or None on failure."""
+        file_id, owner, file_name, path, *_ = row
+        if not os.path.isabs(path):
+            return ''
+        new_path, absolute = self._new_path(owner)
+        try:
+            try:
+                os.link(path, absolute)
+            except OSError:
+                self._copy(path, absolute)
+            if not self.db_manager.relocate_file(file_id, path, new_path, self.job):
+                os.remove(absolute)
+                return ''
+            self.logger.info("Moved file %s ('%s' of %s) to %s.", file_id, file_name, owner, new_path)
+            return path
+        except Exception as e:
+            self.logger.error("Error moving file %s ('%s' of %s): %s", file_id, file_name, owner, e)
+            self._discard(absolute)
+            return None
+
+    def _copy(self, path, new_path):
+        with open(path, 'rb') as src, open(new_path, 'wb') as dst:
+            for segment in self._throttled(read_segments(src)):
+                dst.write(segment)
+            dst.flush()
+            os.fsync(dst.fileno())
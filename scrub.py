@@ -0,0 +1,155 @@
+# scrub.py
+import os
+import string
+import time
+from logger import get_logger
+from compressor import decompress
+from encryption import STREAM_HEADER_MAX_SIZE, is_stream_format, stream_uses_raw_key
+from migration import BATCH_SIZE, BatchJob
+
+# Files younger than this are not reported as orphans: an upload writes its
+# file before its row is committed
+ORPHAN_GRACE_PERIOD = 3600
+
+class Scrubber(BatchJob):
+    """Authenticate every live file and look for orphans, without writing plaintext or repairing anything.
+
+    Problems are logged and collected in problems; a completed pass clears the checkpoint.
+    """
+
+    job = 'scrub'
+    include_blocks = True
+
+    def __init__(self, file_manager, jobs=None, rate_limit=None, cpu_share=1.0, batch_size=BATCH_SIZE, logger=None):
+        super().__init__(file_manager, jobs, rate_limit, cpu_share, batch_size, logger)
+        self.logger = get_logger('scrub', logger or file_manager.logger)
+        self.problems = []
+        # Blocks already verified this run; delta versions share most of theirs
+        self._verified = set()
+
+    def run(self, restart=False, progress=None, stop=None):
+        """Check files until the pass is complete or stop is set, then look for orphans.
+
+        Returns the dict of BatchJob.run() with the problems found by this
+        run added under 'problems'.
+        """
+        self.problems = []
+        outcome = super().run(restart, progress, stop)
+        if not (stop and stop.is_set()):
+            self._find_orphans()
+            self.db_manager.clear_checkpoint(self.job)
+        self._verified.clear()
+        outcome['problems'] = self.problems
+        return outcome
+
+    def _process(self, row):
+        """Check one file, returning '' if it is intact or None if it was reported."""
+        file_id, owner, file_name, path, *_, storage = row
+        try:
+            problem = self._check_blocks(row) if storage == 'blocks' else self._check_file(row)
+        except Exception as e:
+            problem = 'corrupt', self.file_manager._resolve_path(path) if path else None, str(e)
+        if problem is None:
+            return ''
+        # Deleted, re-encrypted or moved since it was listed
+        rows = self.db_manager.list_stored_files(file_id - 1, 1, include_blocks=True)
+        if not rows or rows[0][:4] != row[:4]:
+            return ''
+        self._report(*problem, file_id, owner, file_name)
+        return None
+
+    def _check_file(self, row):
+        """Authenticate a .enc file, returning (kind, path, error) if it is missing or corrupt."""
+        _, owner, _, path, *_ = row
+        files = self.file_manager
+        path = files._resolve_path(path)
+        try:
+            src = open(path, 'rb')
+        except FileNotFoundError:
+            return 'missing', path, "file not found"
+        with src:
+            header = src.read(STREAM_HEADER_MAX_SIZE)
+            src.seek(0)
+            key_ref = self._row_key(row)
+            if is_stream_format(header):
+                encryptor = files._get_encryptor(owner, key_ref, stream_uses_raw_key(header))
+                for _ in self._throttled(encryptor.decrypt_stream(src), passes=1):
+                    pass
+            else:
+                blob = src.read()
+                self.limiter.consume(len(blob))
+                files._get_encryptor(owner, key_ref, False).decrypt_bytes(blob)
+        return None
+
+    def _check_blocks(self, row):
+        """Authenticate the blocks of a block-store file, returning (kind, path, error) for the first bad one."""
+        file_id, owner, *_ = row
+        store = self.file_manager.block_store
+        block_encryptor = self.file_manager._get_block_encryptor(owner, self._row_key(row))
+        for address, length, codec in self.db_manager.get_file_chunks(file_id):
+            if address in self._verified:
+                continue
+            path = store.block_path(address, codec)
+            try:
+                with open(path, 'rb') as src:
+                    blob = src.read()
+            except FileNotFoundError:
+                return 'missing', path, "block not found"
+            self.limiter.consume(len(blob))
+            try:
+                chunk = block_encryptor.open(address, blob, codec)
+                if codec != 'none':
+                    chunk = decompress(chunk, codec, limit=length)
+            except Exception as e:
+                return 'corrupt', path, str(e)
+            if len(chunk) != length or block_encryptor.address(chunk) != address:
+                return 'corrupt', path, "block does not match its address"
+            self._verified.add(address)
+        return None
+
+    def _find_orphans(self):
+        """Report .enc files and blocks under the storage directory that no row references."""
+        base_directory = self.file_manager.base_directory
+        if not os.path.isdir(base_directory):
+            return
+        cutoff = time.time() - ORPHAN_GRACE_PERIOD
+        for entry in sorted(os.scandir(base_directory), key=lambda entry: entry.name):
+            if entry.name == '.blocks':
+                self._find_orphan_blocks(entry.path, cutoff)
+            elif entry.is_dir():
+                self._find_orphan_files(entry.name, entry.path, cutoff)
+
+    def _find_orphan_files(self, owner, directory, cutoff):
+        """Check one user's directory, holding only that user's paths in memory."""
+        files = self.file_manager
+        live = {os.path.normpath(files._resolve_path(path)) for path in self.db_manager.list_file_paths(owner)}
+        for root, _, names in os.walk(directory):
+            for name in names:
+                path = os.path.join(root, name)
+                if (name.endswith(('.enc', '.enc.tmp')) and os.path.normpath(path) not in live
+                        and os.path.getmtime(path) < cutoff):
+                    self._report('orphaned', path, "no file row references it", owner=owner)
+
+    def _find_orphan_blocks(self, block_directory, cutoff):
+        """Check the block store one ab/ prefix directory at a time."""
+        store = self.file_manager.block_store
+        for prefix in sorted(os.listdir(block_directory)):
+            if len(prefix) != 2 or not set(prefix) <= set(string.hexdigits.lower()):
+                continue
+            known = self.db_manager.list_block_addresses(prefix)
+            for root, _, names in os.walk(os.path.join(block_directory, prefix)):
+                for name in names:
+                    address = name.partition('.')[0]
+                    path = os.path.join(root, name)
+                    expected = store.block_path(address, known[address]) if address in known else None
+                    if path != expected and os.path.getmtime(path) < cutoff:
+                        self._report('orphaned', path, "no block row references it")
+
+    def _report(self, kind, path, error, file_id=None, owner=None, file_name=None):
+        self.problems.append({'kind': kind, 'path': path, 'file_id': file_id, 'owner': owner,
+                              'file_name': file_name, 'error': error})
+        if file_id is None:
+            self.logger.warning("%s: %s (%s).", kind.capitalize(), path, error)
+        else:
+            self.logger.warning("%s: file %s ('%s' of %s) at %s: %s", kind.capitalize(), file_id, file_name, owner,
+                                path, error)
@@ -0,0 +1,66 @@
+# tests/conftest.py
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def db(tmp_path):
+    """An unlocked database in a temporary directory."""
+    pytest.importorskip('pysqlcipher3')
+    from db_manager import SQLiteManager
+    db_manager = SQLiteManager(str(tmp_path / 'test.db'))
+    db_manager.connect('test-password')
+    yield db_manager
+    db_manager.close()
+
+
+@pytest.fixture
+def files(tmp_path, db):
+    """A FileManager storing uncompressed .enc files under tmp_path/storage."""
+    from file_ops import FileManager
+    file_manager = FileManager(str(tmp_path / 'storage'), db, compression='none')
+    yield file_manager
+    file_manager.close()
+
+
+@pytest.fixture
+def source(tmp_path):
+    """Write a source file for upload and return its path."""
+    directory = tmp_path / 'sources'
+    directory.mkdir()
+
+    def write(name, data):
+        path = directory / name
+        path.write_bytes(data)
+        return str(path)
+    return write
+
+
+@pytest.fixture
+def output(tmp_path, monkeypatch):
+    """An empty directory that downloads land in."""
+    directory = tmp_path / 'output'
+    directory.mkdir()
+    monkeypatch.chdir(directory)
+    return directory
+
+
+@pytest.fixture
+def legacy_upload(files):
+    """Store a file the way uploads did before data keys, encrypted directly with the owner's key."""
+    def upload(name, data, path=None, owner='alice'):
+        key_id = files._ensure_user_key(owner)
+        path = path or f"legacy/{owner}/{name}.enc"
+        source = files._resolve_path(f"{path}.src")
+        os.makedirs(os.path.dirname(source), exist_ok=True)
+        with open(source, 'wb') as dst:
+            dst.write(data)
+        files._encrypt_to(files._get_encryptor(owner, key_id, False), source, files._resolve_path(path), key_id)
+        os.remove(source)
+        files.db_manager.insert_file_metadata(owner, name, path, key_id)
+        return path
+    return upload
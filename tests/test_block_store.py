@@ -0,0 +1,100 @@
+# tests/test_block_store.py
+import os
+import zlib
+
+import pytest
+from Crypto.Cipher import AES
+
+from block_store import BlockStore
+from encryption import NONCE_SIZE, AESEncryptor, BlockEncryptor
+
+
+@pytest.fixture
+def store(tmp_path):
+    return BlockStore(str(tmp_path), min_size=1024, avg_size=4096, max_size=16384)
+
+
+@pytest.fixture
+def block_encryptor():
+    return BlockEncryptor(AESEncryptor.from_raw_key(os.urandom(32)))
+
+
+def stored_blocks(store):
+    return sorted(name for _, _, names in os.walk(store.block_directory) for name in names)
+
+
+def test_store_and_restore(tmp_path, store, block_encryptor):
+    data = os.urandom(100000)
+    source = tmp_path / 'source'
+    source.write_bytes(data)
+    manifest, new_blocks = store.store(block_encryptor, str(source))
+    assert new_blocks == len(manifest) > 1
+    assert sum(length for _, length, *_ in manifest) == len(data)
+    store.restore(block_encryptor, [(address, length, codec) for address, length, _, codec in manifest],
+                  str(tmp_path / 'restored'))
+    assert (tmp_path / 'restored').read_bytes() == data
+
+
+def test_edit_only_stores_changed_chunks(tmp_path, store, block_encryptor):
+    data = bytearray(os.urandom(200000))
+    source = tmp_path / 'source'
+    source.write_bytes(data)
+    first, _ = store.store(block_encryptor, str(source))
+    data[100000:100010] = os.urandom(10)
+    source.write_bytes(data)
+    second, new_blocks = store.store(block_encryptor, str(source))
+    assert 0 < new_blocks <= 3 < len(second)
+    assert len({entry[0] for entry in first} & {entry[0] for entry in second}) >= len(second) - 3
+
+
+def test_tampered_block_fails(tmp_path, store, block_encryptor):
+    source = tmp_path / 'source'
+    source.write_bytes(os.urandom(5000))
+    manifest, _ = store.store(block_encryptor, str(source))
+    address, length, _, codec = manifest[0]
+    path = store.block_path(address, codec)
+    blob = bytearray(open(path, 'rb').read())
+    blob[-1] ^= 1
+    with open(path, 'wb') as f:
+        f.write(blob)
+    with pytest.raises(ValueError):
+        list(store.read_chunks(block_encryptor, [(address, length, codec)]))
+
+
+def test_delete_collects_unreferenced_blocks(files, source, output):
+    files.dedup = True
+    data = os.urandom(3 * 1024 * 1024)
+    files.upload('alice', source('a.bin', data))
+    files.upload('alice', source('b.bin', data))
+    blocks = stored_blocks(files.block_store)
+    assert blocks
+    files.delete('alice', 'a.bin')
+    assert stored_blocks(files.block_store) == blocks
+    files.download('alice', 'b.bin')
+    assert (output / 'b.bin').read_bytes() == data
+    files.delete('alice', 'b.bin')
+    assert stored_blocks(files.block_store) == []
+
+
+def test_nonce_depends_on_payload_and_codec(block_encryptor):
+    chunk = bytes(5000)
+    address = block_encryptor.address(chunk)
+    raw = block_encryptor.seal(address, chunk)
+    compressed = block_encryptor.seal(address, zlib.compress(chunk), 'zlib')
+    nonce = slice(1, 1 + NONCE_SIZE)
+    assert raw[nonce] != compressed[nonce]
+    assert block_encryptor.seal(address, chunk) == raw
+    assert block_encryptor.open(address, compressed, 'zlib') == zlib.compress(chunk)
+    with pytest.raises(ValueError):
+        block_encryptor.open(address, compressed, 'lzma')
+
+
+def test_address_nonce_blocks_are_rejected(block_encryptor):
+    chunk = os.urandom(3000)
+    address = block_encryptor.address(chunk)
+    address_bytes = bytes.fromhex(address)
+    cipher = AES.new(block_encryptor.block_key, AES.MODE_GCM, nonce=address_bytes[:NONCE_SIZE])
+    cipher.update(address_bytes)
+    ciphertext, tag = cipher.encrypt_and_digest(chunk)
+    with pytest.raises(ValueError):
+        block_encryptor.open(address, ciphertext + tag)
@@ -0,0 +1,73 @@
+# tests/test_compressor.py
+import os
+
+import pytest
+
+from compressor import (CODECS, OUTPUT_SIZE, compress, compress_chunks, compress_frames, decompress, decompress_chunks,
+                        decompress_frames, read_frame_index, read_frames)
+
+
+@pytest.mark.parametrize('codec', ['none', *CODECS])
+def test_round_trip(codec):
+    chunks = [os.urandom(1000) + bytes(5000) for _ in range(20)]
+    compressed = list(compress_chunks(chunks, codec))
+    assert b''.join(decompress_chunks(compressed, codec)) == b''.join(chunks)
+
+
+@pytest.mark.parametrize('codec', list(CODECS))
+def test_output_is_bounded(codec):
+    size = 8 * OUTPUT_SIZE + 123
+    compressed = compress(bytes(size), codec)
+    pieces = [len(piece) for piece in decompress_chunks([compressed], codec)]
+    assert sum(pieces) == size
+    assert max(pieces) <= OUTPUT_SIZE
+
+
+@pytest.mark.parametrize('codec', list(CODECS))
+def test_decompress_limit(codec):
+    compressed = compress(bytes(10000), codec)
+    assert decompress(compressed, codec, limit=10000) == bytes(10000)
+    with pytest.raises(ValueError):
+        decompress(compressed, codec, limit=9999)
+
+
+def test_unknown_codec():
+    with pytest.raises(ValueError):
+        list(decompress_chunks([b''], 'brotli'))
+
+
+def _framed(data, codec, frame_size):
+    return b''.join(compress_frames([data[i:i + 1000] for i in range(0, len(data), 1000)], codec, frame_size))
+
+
+@pytest.mark.parametrize('codec', list(CODECS))
+@pytest.mark.parametrize('size', [0, 1, 4096, 10000])
+def test_frames_round_trip(codec, size):
+    data = bytes(range(256)) * (size // 256) + os.urandom(size % 256)
+    framed = _framed(data, codec, 4096)
+    index = read_frame_index(lambda offset, length: framed[offset:offset + length], len(framed))
+    assert len(index.offsets) - 1 == -(-size // 4096)
+    pieces = [framed[i:i + 777] for i in range(0, len(framed), 777)]
+    assert b''.join(decompress_frames(pieces, codec, index)) == data
+
+
+@pytest.mark.parametrize('offset, length', [(0, 10), (4090, 20), (8192, 4096), (9990, 100), (20000, 5), (0, 20000)])
+def test_read_frames_reads_only_the_frames_spanned(offset, length):
+    data = os.urandom(5000) + bytes(5000)
+    framed = _framed(data, 'zlib', 4096)
+    reads = []
+
+    def read_at(position, size):
+        reads.append((position, size))
+        return framed[position:position + size]
+    index = read_frame_index(read_at, len(framed))
+    reads.clear()
+    assert read_frames(read_at, 'zlib', index, offset, length) == data[offset:offset + length]
+    frames = range(offset // 4096, min(-(-(offset + length) // 4096), len(index.offsets) - 1))
+    assert sum(size for _, size in reads) == sum(index.offsets[i + 1] - index.offsets[i] for i in frames)
+
+
+def test_truncated_frame_index():
+    framed = _framed(bytes(10000), 'zlib', 4096)
+    with pytest.raises(ValueError):
+        read_frame_index(lambda offset, length: framed[offset:offset + length], len(framed) - 4)
@@ -0,0 +1,25 @@
+# tests/test_config_manager.py
+from config_manager import ConfigManager
+
+
+def test_github_sessions_are_kept_per_os_user(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    config_manager = ConfigManager()
+    config_manager.set_github_session('alice-session', os_user='alice')
+    config_manager.set_github_session('bob-session', os_user='bob')
+    assert config_manager.get_github_session('alice') == 'alice-session'
+    assert config_manager.get_github_session('carol') is None
+
+    config_manager.clear_github_session('alice')
+    reloaded = ConfigManager()
+    assert reloaded.get_github_session('alice') is None
+    assert reloaded.get_github_session('bob') == 'bob-session'
+
+
+def test_unkeyed_session_is_not_reused(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    config_manager = ConfigManager()
+    config_manager.set('github_session', 'from-an-older-version')
+    assert config_manager.get_github_session('alice') is None
+    config_manager.clear_github_session('alice')
+    assert ConfigManager().get('github_session') is None
@@ -0,0 +1,48 @@
+# tests/test_db_manager.py
+import hashlib
+import threading
+import time
+
+import pytest
+
+
+def test_pool_stretches_the_password_once(tmp_path, monkeypatch):
+    pytest.importorskip('pysqlcipher3')
+    import db_manager
+    calls, derive = [], hashlib.pbkdf2_hmac
+
+    def pbkdf2_hmac(*args):
+        calls.append(args)
+        return derive(*args)
+    monkeypatch.setattr(db_manager.hashlib, 'pbkdf2_hmac', pbkdf2_hmac)
+    manager = db_manager.SQLiteManager(str(tmp_path / 'test.db'))
+    manager.connect('test-password')
+    pool = manager.pool
+    threads = [threading.Thread(target=lambda: pool.reader().execute("SELECT 1")) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(pool._readers) == 4
+    assert len(calls) == 1
+    assert 'test-password' not in vars(pool).values()
+    manager.close()
+    assert not any(pool._raw_key)
+
+
+def test_idle_session_flushes_download_dates(tmp_path, files, source, output):
+    from db_manager import SQLiteManager
+    files.upload('alice', source('a.txt', b'data'))
+    other = SQLiteManager(str(tmp_path / 'test.db'))
+    other.connect('test-password')
+    try:
+        files.db_manager.flush_interval = 1.0
+        files.download('alice', 'a.txt')
+        assert other.retrieve_file_metadata('alice', 'a.txt')[5] is None
+        deadline = time.monotonic() + 10
+        while other.retrieve_file_metadata('alice', 'a.txt')[5] is None and time.monotonic() < deadline:
+            other.cache.clear()
+            time.sleep(0.05)
+        assert other.retrieve_file_metadata('alice', 'a.txt')[5] is not None
+    finally:
+        other.close()
@@ -0,0 +1,75 @@
+# tests/test_encryption.py
+import io
+import os
+
+import pytest
+
+from encryption import AESEncryptor, STREAM_HEADER_V2, parse_stream_header, stream_plaintext_size
+
+SEGMENT = 64
+
+
+def encrypt(encryptor, data, segment_size=SEGMENT):
+    return b''.join(bytes(part) for part in encryptor.encrypt_stream([data], segment_size=segment_size, key_id=7))
+
+
+def decrypt(encryptor, blob):
+    return b''.join(bytes(chunk) for chunk in encryptor.decrypt_stream(io.BytesIO(blob)))
+
+
+@pytest.fixture
+def encryptor():
+    return AESEncryptor.from_raw_key(os.urandom(32))
+
+
+@pytest.mark.parametrize('size', [0, 1, SEGMENT - 1, SEGMENT, 3 * SEGMENT, 3 * SEGMENT + 5])
+def test_stream_round_trip(encryptor, size):
+    data = os.urandom(size)
+    blob = encrypt(encryptor, data)
+    header = parse_stream_header(blob)
+    assert (header.version, header.segment_size, header.key_id) == (2, SEGMENT, 7)
+    assert stream_plaintext_size(header, len(blob)) == size
+    assert decrypt(encryptor, blob) == data
+
+
+def test_header_is_authenticated(encryptor):
+    blob = bytearray(encrypt(encryptor, os.urandom(100)))
+    # The key ID is not used to decrypt, only bound into every segment's AAD
+    blob[STREAM_HEADER_V2.size - 9] ^= 1
+    with pytest.raises(ValueError):
+        decrypt(encryptor, bytes(blob))
+
+
+def test_tampered_segment_fails(encryptor):
+    blob = bytearray(encrypt(encryptor, os.urandom(3 * SEGMENT)))
+    blob[STREAM_HEADER_V2.size + SEGMENT + 20] ^= 1
+    with pytest.raises(ValueError):
+        decrypt(encryptor, bytes(blob))
+
+
+def test_truncation_at_segment_boundary_fails(encryptor):
+    blob = encrypt(encryptor, os.urandom(3 * SEGMENT))
+    record = SEGMENT + 16
+    with pytest.raises(ValueError):
+        decrypt(encryptor, blob[:STREAM_HEADER_V2.size + 2 * record])
+
+
+def test_reordered_segments_fail(encryptor):
+    blob = encrypt(encryptor, os.urandom(3 * SEGMENT))
+    start, record = STREAM_HEADER_V2.size, SEGMENT + 16
+    swapped = blob[:start] + blob[start + record:start + 2 * record] + blob[start:start + record] + blob[start + 2 * record:]
+    with pytest.raises(ValueError):
+        decrypt(encryptor, swapped)
+
+
+def test_wrong_key_fails(encryptor):
+    blob = encrypt(encryptor, os.urandom(10))
+    with pytest.raises(ValueError):
+        decrypt(AESEncryptor.from_raw_key(os.urandom(32)), blob)
+
+
+@pytest.mark.parametrize('offset,length', [(0, 10), (SEGMENT - 3, 6), (2 * SEGMENT, SEGMENT), (150, 1000)])
+def test_decrypt_range(encryptor, offset, length):
+    data = os.urandom(3 * SEGMENT + 5)
+    blob = encrypt(encryptor, data)
+    assert encryptor.decrypt_range(io.BytesIO(blob), offset, length) == data[offset:offset + length]
@@ -0,0 +1,39 @@
+# tests/test_file_ops.py
+import os
+
+
+def test_upload_download_round_trip(files, source, output):
+    data = os.urandom(3 * 1024 * 1024 + 17)
+    files.upload('alice', source('report.bin', data))
+    files.download('alice', 'report.bin')
+    assert (output / 'report.bin').read_bytes() == data
+
+
+def test_download_missing_file(files, output):
+    files.download('alice', 'missing.bin')
+    assert not list(output.iterdir())
+
+
+def test_compressed_round_trip_and_ranges(tmp_path, db, source, output):
+    from file_ops import FileManager
+    files = FileManager(str(tmp_path / 'storage'), db, compression='zlib')
+    data = b''.join(b'line %d of the log\n' % i for i in range(300000))
+    files.upload('alice', source('app.log', data))
+    files.download('alice', 'app.log')
+    assert (output / 'app.log').read_bytes() == data
+    for offset, length in [(0, 100), (len(data) - 5000, 5000), (2 * 1024 * 1024 - 3, 10), (len(data), 10)]:
+        assert files.read_range('alice', 'app.log', offset, length) == data[offset:offset + length]
+    files.close()
+
+
+def test_upload_many_uploads_a_repeated_path_once(tmp_path, files, source, output):
+    path = source('a.txt', b'first')
+    other = tmp_path / 'other'
+    other.mkdir()
+    (other / 'a.txt').write_bytes(b'other')
+    succeeded, failed = files.upload_many('alice', [path, path, os.path.relpath(path), str(other / 'a.txt')])
+    assert succeeded == [path]
+    assert failed == [(str(other / 'a.txt'), "duplicate file name in batch")]
+    assert len(files.db_manager.list_file_versions('alice', 'a.txt')) == 1
+    files.download('alice', 'a.txt')
+    assert (output / 'a.txt').read_bytes() == b'first'
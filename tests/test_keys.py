@@ -0,0 +1,93 @@
+# tests/test_keys.py
+import pytest
+
+
+@pytest.fixture
+def open_session(tmp_path):
+    """Open another FileManager on the same database and storage, as a second process would."""
+    from db_manager import SQLiteManager
+    from file_ops import FileManager
+    sessions = []
+
+    def open_():
+        db_manager = SQLiteManager(str(tmp_path / 'test.db'))
+        db_manager.connect('test-password')
+        file_manager = FileManager(str(tmp_path / 'storage'), db_manager, compression='none')
+        sessions.append(file_manager)
+        return file_manager
+    yield open_
+    for file_manager in sessions:
+        file_manager.close()
+        file_manager.db_manager.close()
+
+
+def test_rotation_keeps_files_readable(files, source, output):
+    files.upload('alice', source('a.txt', b'before'))
+    old_key_id = files.db_manager.get_user_key_id('alice')
+    new_key_id = files.rotate_key('alice')
+    assert new_key_id != old_key_id
+    assert files.db_manager.get_user_key('alice', old_key_id) == (None, None, None)
+    files.upload('alice', source('b.txt', b'after'))
+    files.download('alice', 'a.txt')
+    files.download('alice', 'b.txt')
+    assert (output / 'a.txt').read_bytes() == b'before'
+    assert (output / 'b.txt').read_bytes() == b'after'
+
+
+def test_upload_after_rotation_by_another_session(files, source, output, open_session):
+    files.upload('alice', source('a.txt', b'first'))
+    open_session().rotate_key('alice')
+    # files still has the retired key ID cached
+    files.upload('alice', source('b.txt', b'second'))
+
+    fresh = open_session()
+    fresh.download('alice', 'a.txt')
+    fresh.download('alice', 'b.txt')
+    assert (output / 'a.txt').read_bytes() == b'first'
+    assert (output / 'b.txt').read_bytes() == b'second'
+
+
+def test_delete_drops_data_keys(files, source, output):
+    for name in ('a.txt', 'b.txt', 'c.txt'):
+        files.upload('alice', source(name, name.encode()))
+    files.upload('alice', source('a.txt', b'a2'))
+    assert len(files.db_manager.list_data_keys('alice')) == 4
+    deleted = files.db_manager.retrieve_file_metadata('alice', 'a.txt', 1)
+    files.delete('alice', 'a.txt')
+    files.delete('alice', 'b.txt')
+    assert files.db_manager.get_data_key('alice', deleted[11]) == (None, None)
+    assert [row[0] for row in files.db_manager.list_data_keys('alice')] == [
+        files.db_manager.retrieve_file_metadata('alice', 'c.txt')[11]]
+    assert files.db_manager.conn.execute("SELECT COUNT(*) FROM data_keys").fetchone()[0] == 1
+
+    old_key_id = files.db_manager.get_user_key_id('alice')
+    files.rotate_key('alice')
+    assert files.db_manager.get_user_key('alice', old_key_id) == (None, None, None)
+    files.download('alice', 'c.txt')
+    assert (output / 'c.txt').read_bytes() == b'c.txt'
+
+
+def test_migration_drops_data_keys_of_deleted_files(tmp_path):
+    pytest.importorskip('pysqlcipher3')
+    from db_manager import SQLiteManager
+
+    class OlderManager(SQLiteManager):
+        MIGRATIONS = SQLiteManager.MIGRATIONS[:SQLiteManager.MIGRATIONS.index('_migrate_deleted_file_keys')]
+
+    path = str(tmp_path / 'test.db')
+    old = OlderManager(path)
+    old.connect('test-password')
+    for name in ('a.txt', 'b.txt'):
+        old.insert_file_metadata('alice', name, f"{name}.enc", 1, wrapped_key=b'wrapped')
+    # As deletion left them before
+    with old.transaction():
+        old.conn.execute("UPDATE files SET delete_date = CURRENT_TIMESTAMP WHERE file_name = 'a.txt'")
+    old.close()
+
+    db_manager = SQLiteManager(path)
+    db_manager.connect('test-password')
+    try:
+        live = db_manager.retrieve_file_metadata('alice', 'b.txt')[11]
+        assert db_manager.conn.execute("SELECT id FROM data_keys").fetchall() == [(live,)]
+    finally:
+        db_manager.close()
@@ -0,0 +1,39 @@
+# tests/test_layout.py
+import os
+import re
+
+from migration import Relayout
+
+
+def test_uploads_use_the_sharded_layout(files, source):
+    files.upload('alice', source('a.txt', b'one'))
+    files.upload('alice', source('a.txt', b'two'))
+    paths = [entry['encrypted_path'] for entry in files.db_manager.list_file_versions('alice', 'a.txt')]
+    assert len(set(paths)) == 2
+    for path in paths:
+        assert re.fullmatch(r'alice/([0-9a-f]{2})/([0-9a-f]{2})/\1\2[0-9a-f]{28}\.enc', path)
+        assert os.path.exists(files._resolve_path(path))
+
+
+def test_relayout_moves_absolute_paths(tmp_path, files, output, legacy_upload):
+    old = tmp_path / 'old'
+    # Re-uploads before versioning overwrote one .enc file, so both versions name it
+    shared = legacy_upload('a.txt', b'first', str(old / 'a.enc'))
+    for i in range(5):
+        legacy_upload(f"f{i}.txt", b'%d' % i, str(old / f"f{i}.enc"))
+    legacy_upload('a.txt', b'second', shared)
+
+    outcome = Relayout(files, jobs=2, batch_size=2).run()
+    assert outcome['processed'] == 7 and outcome['failed'] == 0
+    assert not os.listdir(old)
+    rows = files.db_manager.list_stored_files(0, 100)
+    assert all(not os.path.isabs(row[3]) and os.path.exists(files._resolve_path(row[3])) for row in rows)
+    files.download('alice', 'a.txt', version=1)
+    assert (output / 'a.txt').read_bytes() == b'second'
+    files.download('alice', 'f3.txt')
+    assert (output / 'f3.txt').read_bytes() == b'3'
+
+    # Rows already in the layout are left alone
+    paths = sorted(row[3] for row in rows)
+    Relayout(files).run(restart=True)
+    assert sorted(row[3] for row in files.db_manager.list_stored_files(0, 100)) == paths
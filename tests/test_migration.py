@@ -0,0 +1,93 @@
+# tests/test_migration.py
+import os
+import threading
+
+import pytest
+
+from migration import Migrator
+
+
+def stored_files(files):
+    return sorted(name for _, _, names in os.walk(files.base_directory) for name in names)
+
+
+def test_migration_keeps_files_shared_by_versions(files, output, legacy_upload):
+    # Re-uploads before versioning overwrote one .enc file, so both versions name it
+    path = legacy_upload('a.txt', b'first')
+    for i in range(10):
+        legacy_upload(f"f{i}.txt", b'%d' % i)
+    legacy_upload('a.txt', b'second', path)
+
+    outcome = Migrator(files, jobs=2, batch_size=3).run()
+    assert outcome == {'processed': 12, 'failed': 0, 'position': outcome['position']}
+    assert files.db_manager.list_stored_files(0, 100, legacy_only=True) == []
+    files.download('alice', 'a.txt')
+    assert (output / 'a.txt').read_bytes() == b'second'
+    files.download('alice', 'a.txt', version=1)
+    assert (output / 'a.txt').read_bytes() == b'second'
+    assert len(stored_files(files)) == 12
+
+
+def test_interrupted_run_leaves_no_retired_files(files, output, legacy_upload, monkeypatch):
+    for i in range(10):
+        legacy_upload(f"f{i}.txt", b'%d' % i)
+    migrator = Migrator(files, jobs=1, batch_size=3)
+    process = migrator._process
+    calls = []
+
+    def interrupt_on_fifth(row):
+        calls.append(row)
+        if len(calls) == 5:
+            raise KeyboardInterrupt
+        return process(row)
+    monkeypatch.setattr(migrator, '_process', interrupt_on_fifth)
+    with pytest.raises(KeyboardInterrupt):
+        migrator.run()
+    assert len(stored_files(files)) == 10
+
+    assert Migrator(files, jobs=1, batch_size=3).run()['failed'] == 0
+    assert files.db_manager.list_stored_files(0, 100, legacy_only=True) == []
+    assert len(stored_files(files)) == 10
+    files.download('alice', 'f7.txt')
+    assert (output / 'f7.txt').read_bytes() == b'7'
+
+
+def test_retired_data_key_outlives_the_swap(files, source, output, monkeypatch):
+    files.upload('alice', source('a.txt', b'data'))
+    old_row = files.db_manager.retrieve_file_metadata('alice', 'a.txt')
+    crashed = Migrator(files, reencrypt_all=True)
+    # As if the process died before removing anything
+    monkeypatch.setattr(crashed, '_purge', lambda up_to=None: None)
+    crashed.run()
+    assert files.db_manager.retrieve_file_metadata('alice', 'a.txt')[2] != old_row[2]
+    assert files.db_manager.get_data_key('alice', old_row[11]) != (None, None)
+    assert os.path.exists(files._resolve_path(old_row[2]))
+
+    Migrator(files, reencrypt_all=True, batch_size=1).run(restart=True)
+    assert files.db_manager.get_data_key('alice', old_row[11]) == (None, None)
+    assert not os.path.exists(files._resolve_path(old_row[2]))
+    files.download('alice', 'a.txt')
+    assert (output / 'a.txt').read_bytes() == b'data'
+
+
+def test_parallel_migration_of_many_users_finishes(files, output, legacy_upload):
+    from db_manager import SQLiteManager
+    from file_ops import FileManager
+    for i in range(40):
+        for name in ('a.txt', 'b.txt'):
+            legacy_upload(name, f"user{i} {name}".encode(), owner=f"user{i}")
+    # A fresh session starts with cold keys, so workers derive them while others hold the writer lock.
+    # It is left open on a hang, so teardown does not wait on its locks.
+    db_manager = SQLiteManager(files.db_manager.db_path)
+    db_manager.connect('test-password')
+    session = FileManager(files.base_directory, db_manager, compression='none')
+    outcomes = []
+    worker = threading.Thread(target=lambda: outcomes.append(Migrator(session, jobs=8).run()), daemon=True)
+    worker.start()
+    worker.join(60)
+    assert not worker.is_alive(), "migration deadlocked"
+    session.close()
+    db_manager.close()
+    assert outcomes[0]['processed'] == 80 and outcomes[0]['failed'] == 0
+    files.download('user7', 'b.txt')
+    assert (output / 'b.txt').read_bytes() == b'user7 b.txt'
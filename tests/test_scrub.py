@@ -0,0 +1,53 @@
+# tests/test_scrub.py
+import os
+import time
+
+from scrub import ORPHAN_GRACE_PERIOD, Scrubber
+
+
+def flip_last_byte(path):
+    with open(path, 'r+b') as f:
+        f.seek(-1, os.SEEK_END)
+        last = f.read(1)
+        f.seek(-1, os.SEEK_END)
+        f.write(bytes([last[0] ^ 1]))
+
+
+def stored_path(files, file_name):
+    return files._resolve_path(files.db_manager.retrieve_file_metadata('alice', file_name)[2])
+
+
+def test_intact_files_have_no_problems(files, source):
+    files.upload('alice', source('a.txt', b'a' * 5000))
+    files.dedup = True
+    files.upload('alice', source('b.bin', os.urandom(200000)))
+    outcome = Scrubber(files).run()
+    assert outcome['failed'] == 0 and outcome['problems'] == []
+
+
+def test_reports_corrupt_missing_and_orphaned_files(files, source):
+    for name in ('a.txt', 'b.txt', 'c.txt'):
+        files.upload('alice', source(name, name.encode() * 1000))
+    flip_last_byte(stored_path(files, 'a.txt'))
+    os.remove(stored_path(files, 'b.txt'))
+    old = time.time() - ORPHAN_GRACE_PERIOD - 60
+    orphan = os.path.join(os.path.dirname(stored_path(files, 'c.txt')), 'orphan.enc')
+    recent = orphan[:-len('.enc')] + '-recent.enc'
+    for path in (orphan, recent):
+        with open(path, 'wb') as f:
+            f.write(b'stray')
+    os.utime(orphan, (old, old))
+
+    problems = Scrubber(files).run()['problems']
+    assert sorted((problem['kind'], problem['file_name'] or problem['path']) for problem in problems) == [
+        ('corrupt', 'a.txt'), ('missing', 'b.txt'), ('orphaned', orphan)]
+
+
+def test_reports_tampered_blocks(files, source):
+    files.dedup = True
+    files.upload('alice', source('a.bin', os.urandom(200000)))
+    block = next(os.path.join(root, names[0]) for root, _, names in os.walk(files.block_store.block_directory)
+                 if names)
+    flip_last_byte(block)
+    problems = Scrubber(files).run()['problems']
+    assert [(problem['kind'], problem['file_name']) for problem in problems] == [('corrupt', 'a.bin')]
@@ -0,0 +1,61 @@
+# tests/test_versions.py
+import pytest
+
+
+def download_dates(files, file_name):
+    versions = files.db_manager.list_file_versions('alice', file_name)
+    return {entry['version']: entry['download_date'] for entry in versions}
+
+
+def test_reupload_keeps_versions(files, source, output):
+    files.upload('alice', source('notes.txt', b'first'))
+    files.upload('alice', source('notes.txt', b'second'))
+    assert [entry['version'] for entry in files.db_manager.list_file_versions('alice', 'notes.txt')] == [2, 1]
+    files.download('alice', 'notes.txt', version=1)
+    assert (output / 'notes.txt').read_bytes() == b'first'
+    files.download('alice', 'notes.txt')
+    assert (output / 'notes.txt').read_bytes() == b'second'
+
+
+def test_download_date_is_recorded_on_the_version_read(files, source, output):
+    files.upload('alice', source('notes.txt', b'first'))
+    files.upload('alice', source('notes.txt', b'second'))
+    files.download('alice', 'notes.txt', version=1)
+    dates = download_dates(files, 'notes.txt')
+    assert dates[1] is not None and dates[2] is None
+
+    files.upload('alice', source('todo.txt', b'first'))
+    files.upload('alice', source('todo.txt', b'second'))
+    files.download_many('alice', ['todo.txt'], version=1)
+    dates = download_dates(files, 'todo.txt')
+    assert dates[1] is not None and dates[2] is None
+
+
+def test_migration_chains_reuploads_into_versions(tmp_path):
+    pytest.importorskip('pysqlcipher3')
+    from db_manager import SQLiteManager
+
+    class UnversionedManager(SQLiteManager):
+        MIGRATIONS = SQLiteManager.MIGRATIONS[:SQLiteManager.MIGRATIONS.index('_migrate_file_versions')]
+
+    path = str(tmp_path / 'test.db')
+    old = UnversionedManager(path)
+    old.connect('test-password')
+    with old.transaction():
+        old.conn.execute("INSERT INTO users (username) VALUES ('alice')")
+        old.conn.executemany("INSERT INTO files (owner, file_name, encrypted_path) VALUES ('alice', ?, ?)",
+                             [('a.txt', 'a1.enc'), ('b.txt', 'b1.enc'), ('a.txt', 'a2.enc'), ('a.txt', 'a3.enc')])
+    old.close()
+
+    db_manager = SQLiteManager(path)
+    db_manager.connect('test-password')
+    try:
+        versions = db_manager.list_file_versions('alice', 'a.txt')
+        assert [(entry['version'], entry['encrypted_path']) for entry in versions] == [
+            (3, 'a3.enc'), (2, 'a2.enc'), (1, 'a1.enc')]
+        assert versions[0]['superseded_at'] is None and versions[1]['superseded_at'] is not None
+        assert db_manager.retrieve_file_metadata('alice', 'a.txt')[2] == 'a3.enc'
+        assert db_manager.retrieve_file_metadata('alice', 'a.txt', 1)[2] == 'a1.enc'
+        assert [entry['version'] for entry in db_manager.list_file_versions('alice', 'b.txt')] == [1]
+    finally:
+        db_manager.close()